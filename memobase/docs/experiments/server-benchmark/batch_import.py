@@ -0,0 +1,89 @@
+"""
+Measure a bulk import through `POST /blobs/batch_insert`.
+
+Creates `--users` users, then imports `--messages` chat blobs spread over them,
+`--batch-size` blobs per request and `--concurrency` requests in flight:
+
+    python batch_import.py --messages 1000000 --users 10000
+"""
+
+import time
+import asyncio
+import argparse
+import httpx
+from context_under_insert import (
+    PREFIX,
+    create_user,
+    chat_blob_data,
+    timed,
+    summarize,
+    print_summary,
+)
+
+
+async def main(args):
+    async with httpx.AsyncClient(
+        base_url=args.url,
+        headers={"Authorization": f"Bearer {args.token}"},
+        limits=httpx.Limits(max_connections=args.concurrency),
+        timeout=120,
+    ) as client:
+        users = []
+        for i in range(0, args.users, args.concurrency):
+            users.extend(
+                await asyncio.gather(
+                    *[
+                        create_user(client)
+                        for _ in range(min(args.concurrency, args.users - i))
+                    ]
+                )
+            )
+
+        # message i goes to user i % users, so every request touches many users
+        batches = asyncio.Queue()
+        for start in range(0, args.messages, args.batch_size):
+            end = min(start + args.batch_size, args.messages)
+            batches.put_nowait(
+                [
+                    {
+                        "user_id": users[i % len(users)],
+                        "blob_type": "chat",
+                        "blob_data": chat_blob_data(i),
+                    }
+                    for i in range(start, end)
+                ]
+            )
+
+        latencies, errors = [], []
+
+        async def import_worker():
+            while not batches.empty():
+                blobs = batches.get_nowait()
+                ok, cost = await timed(
+                    client,
+                    "POST",
+                    f"{PREFIX}/blobs/batch_insert",
+                    json={"blobs": blobs},
+                )
+                (latencies if ok else errors).append(cost)
+
+        start = time.perf_counter()
+        await asyncio.gather(*[import_worker() for _ in range(args.concurrency)])
+        duration = time.perf_counter() - start
+
+    imported = len(latencies) * args.batch_size
+    print_summary(f"POST {PREFIX}/blobs/batch_insert", summarize(latencies), duration)
+    print(f"  errors: {len(errors)}")
+    print(f"  imported: ~{imported} messages in {duration:.1f}s")
+    print(f"  throughput: ~{imported / duration:.0f} messages/s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="http://localhost:8019")
+    parser.add_argument("--token", default="secret")
+    parser.add_argument("--messages", type=int, default=100000)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=8)
+    asyncio.run(main(parser.parse_args()))
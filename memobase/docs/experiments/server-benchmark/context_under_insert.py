@@ -0,0 +1,137 @@
+"""
+Measure `GET /users/context` latency while `POST /blobs/insert` is under load.
+
+Run it against the same server before and after a change to compare the
+p50/p95/p99 of the context endpoint, e.g.:
+
+    python context_under_insert.py --insert-concurrency 32 --duration 60
+"""
+
+import time
+import asyncio
+import argparse
+import statistics
+import numpy as np
+import httpx
+
+PREFIX = "/api/v1"
+
+
+def summarize(latencies: list[float]) -> dict:
+    if not latencies:
+        return {"count": 0}
+    return {
+        "count": len(latencies),
+        "mean_ms": statistics.mean(latencies),
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p95_ms": float(np.percentile(latencies, 95)),
+        "p99_ms": float(np.percentile(latencies, 99)),
+        "max_ms": max(latencies),
+    }
+
+
+def print_summary(name: str, stats: dict, duration: float):
+    print(f"\n{name}")
+    if not stats["count"]:
+        print("  no successful requests")
+        return
+    print(f"  requests: {stats['count']} ({stats['count'] / duration:.1f} req/s)")
+    for k in ["mean_ms", "p50_ms", "p95_ms", "p99_ms", "max_ms"]:
+        print(f"  {k}: {stats[k]:.2f}")
+
+
+async def create_user(client: httpx.AsyncClient) -> str:
+    r = await client.post(f"{PREFIX}/users", json={})
+    r.raise_for_status()
+    return r.json()["data"]["id"]
+
+
+async def timed(client: httpx.AsyncClient, method: str, url: str, **kwargs):
+    start = time.perf_counter()
+    r = await client.request(method, url, **kwargs)
+    cost = (time.perf_counter() - start) * 1000
+    ok = r.status_code == 200 and r.json().get("errno") == 0
+    return ok, cost
+
+
+def chat_blob_data(i: int, message_chars: int = 0) -> dict:
+    content = f"Hi, I'm benchmarking memobase #{i}"
+    if message_chars > len(content):
+        content += " " + "lorem ipsum " * ((message_chars - len(content)) // 12)
+    return {
+        "messages": [
+            {"role": "user", "content": content},
+            {"role": "assistant", "content": "Nice, tell me more about it"},
+        ]
+    }
+
+
+async def insert_worker(
+    client, user_id, deadline, latencies, errors, message_chars: int = 0
+):
+    i = 0
+    while time.perf_counter() < deadline:
+        blob = {"blob_type": "chat", "blob_data": chat_blob_data(i, message_chars)}
+        ok, cost = await timed(
+            client, "POST", f"{PREFIX}/blobs/insert/{user_id}", json=blob
+        )
+        (latencies if ok else errors).append(cost)
+        i += 1
+
+
+async def context_worker(client, user_id, deadline, latencies, errors):
+    while time.perf_counter() < deadline:
+        ok, cost = await timed(
+            client,
+            "GET",
+            f"{PREFIX}/users/context/{user_id}",
+            params={"max_token_size": 500},
+        )
+        (latencies if ok else errors).append(cost)
+
+
+async def main(args):
+    limits = httpx.Limits(
+        max_connections=args.insert_concurrency + args.context_concurrency
+    )
+    async with httpx.AsyncClient(
+        base_url=args.url,
+        headers={"Authorization": f"Bearer {args.token}"},
+        limits=limits,
+        timeout=60,
+    ) as client:
+        insert_users = [
+            await create_user(client) for _ in range(args.insert_concurrency)
+        ]
+        context_user = await create_user(client)
+
+        insert_latencies, insert_errors = [], []
+        context_latencies, context_errors = [], []
+        deadline = time.perf_counter() + args.duration
+        await asyncio.gather(
+            *[
+                insert_worker(client, uid, deadline, insert_latencies, insert_errors)
+                for uid in insert_users
+            ],
+            *[
+                context_worker(
+                    client, context_user, deadline, context_latencies, context_errors
+                )
+                for _ in range(args.context_concurrency)
+            ],
+        )
+
+    print_summary("POST /blobs/insert", summarize(insert_latencies), args.duration)
+    print(f"  errors: {len(insert_errors)}")
+    print_summary("GET /users/context", summarize(context_latencies), args.duration)
+    print(f"  errors: {len(context_errors)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="http://localhost:8019")
+    parser.add_argument("--token", default="secret")
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--insert-concurrency", type=int, default=16)
+    parser.add_argument("--context-concurrency", type=int, default=4)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,84 @@
+"""
+Compare the latency and throughput of the embedding providers.
+
+Calls the providers directly, without the server. The remote provider is the
+one configured in `config.yaml` (`embedding_provider`/`embedding_model`), the
+local one runs `--local-model` in-process. Run it from `src/server/api`:
+
+    PYTHONPATH=. python ../../../docs/experiments/server-benchmark/embedding_providers.py \
+        --local-model BAAI/bge-small-en-v1.5
+"""
+
+import memobase_server.env
+
+# Done setting up env
+import time
+import random
+import asyncio
+import argparse
+from memobase_server.env import CONFIG
+from memobase_server.llms.embeddings import FACTORIES
+from context_under_insert import summarize
+
+WORDS = "the user said they moved to berlin last year and started learning piano with a friend from work".split()
+
+
+def random_texts(n: int, words: int) -> list[str]:
+    return [" ".join(random.choices(WORDS, k=words)) for _ in range(n)]
+
+
+async def measure_latency(provider, model: str, args) -> dict:
+    latencies = []
+    for _ in range(args.requests):
+        texts = random_texts(1, args.words)
+        start = time.perf_counter()
+        await provider(model, texts, "query")
+        latencies.append((time.perf_counter() - start) * 1000)
+    return summarize(latencies)
+
+
+async def measure_throughput(provider, model: str, args) -> float:
+    done = 0
+    deadline = time.perf_counter() + args.duration
+
+    async def worker():
+        nonlocal done
+        while time.perf_counter() < deadline:
+            await provider(model, random_texts(args.batch_size, args.words), "document")
+            done += args.batch_size
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(args.concurrency)])
+    return done / (time.perf_counter() - start)
+
+
+async def main(args):
+    providers = [(CONFIG.embedding_provider, CONFIG.embedding_model)]
+    if args.local_model:
+        providers.append(("local", args.local_model))
+    for name, model in providers:
+        provider = FACTORIES[name]
+        # the first call loads the model of the local provider
+        dim = (await provider(model, ["warm up"], "document")).shape[-1]
+        print(f"\n{name} ({model}, dim {dim})")
+        stats = await measure_latency(provider, model, args)
+        print(
+            f"  single query: p50 {stats['p50_ms']:.1f}ms, p95 {stats['p95_ms']:.1f}ms, "
+            f"p99 {stats['p99_ms']:.1f}ms"
+        )
+        throughput = await measure_throughput(provider, model, args)
+        print(
+            f"  documents: {throughput:.1f} texts/s "
+            f"(batch {args.batch_size}, concurrency {args.concurrency})"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--local-model", type=str, default=None)
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--words", type=int, default=40)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,59 @@
+"""
+Measure the throughput of `POST /blobs/insert`.
+
+Every client inserts chat blobs for its own user as fast as it can, run it
+against the same server before and after a change to compare inserts/sec:
+
+    python insert_throughput.py --concurrency 64 --duration 60
+"""
+
+import time
+import asyncio
+import argparse
+import httpx
+from context_under_insert import (
+    PREFIX,
+    create_user,
+    insert_worker,
+    summarize,
+    print_summary,
+)
+
+
+async def main(args):
+    async with httpx.AsyncClient(
+        base_url=args.url,
+        headers={"Authorization": f"Bearer {args.token}"},
+        limits=httpx.Limits(max_connections=args.concurrency),
+        timeout=60,
+    ) as client:
+        users = [await create_user(client) for _ in range(args.concurrency)]
+
+        latencies, errors = [], []
+        deadline = time.perf_counter() + args.duration
+        await asyncio.gather(
+            *[
+                insert_worker(
+                    client, uid, deadline, latencies, errors, args.message_chars
+                )
+                for uid in users
+            ]
+        )
+
+    print_summary(f"POST {PREFIX}/blobs/insert", summarize(latencies), args.duration)
+    print(f"  errors: {len(errors)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="http://localhost:8019")
+    parser.add_argument("--token", default="secret")
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument(
+        "--message-chars",
+        type=int,
+        default=0,
+        help="pad the user message to this many characters",
+    )
+    asyncio.run(main(parser.parse_args()))
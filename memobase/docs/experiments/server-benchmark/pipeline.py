@@ -0,0 +1,130 @@
+"""
+Measure the whole pipeline: `/blobs/insert` -> buffer flush -> `/users/context`.
+
+Meant for a server running the stand-in LLM and embeddings (`llm_style: stand_in`,
+`embedding_provider: stand_in`), so the numbers only depend on the server. Each
+client owns a user and loops: insert `--blobs-per-flush` chat blobs, flush the
+buffer and wait for it, read the context with the latest chats. It prints the
+flushes/sec, the p50/p95/p99 of every stage and the DB connections in use,
+scraped from the server's Prometheus endpoint:
+
+    python pipeline.py --concurrency 32 --duration 60
+"""
+
+import re
+import json
+import time
+import asyncio
+import argparse
+import httpx
+import numpy as np
+from context_under_insert import PREFIX, chat_blob_data, create_user, timed, summarize
+
+POOL_GAUGE = re.compile(r"^memobase_server_db_pool_checked_out\S*\s+([\d.e+-]+)$")
+
+
+async def pipeline_worker(client, user_id, deadline, args, stages, errors):
+    i = 0
+    while time.perf_counter() < deadline:
+        for _ in range(args.blobs_per_flush):
+            blob = {"blob_type": "chat", "blob_data": chat_blob_data(i)}
+            ok, cost = await timed(
+                client, "POST", f"{PREFIX}/blobs/insert/{user_id}", json=blob
+            )
+            (stages["insert"] if ok else errors["insert"]).append(cost)
+            i += 1
+        ok, cost = await timed(
+            client,
+            "POST",
+            f"{PREFIX}/users/buffer/{user_id}/chat",
+            params={"wait_process": True},
+        )
+        (stages["flush"] if ok else errors["flush"]).append(cost)
+        params = {"max_token_size": 500}
+        if not args.no_chats:
+            # profile filtering and event search with the latest chats
+            params["chats_str"] = json.dumps(chat_blob_data(i)["messages"])
+        ok, cost = await timed(
+            client, "GET", f"{PREFIX}/users/context/{user_id}", params=params
+        )
+        (stages["context"] if ok else errors["context"]).append(cost)
+
+
+async def pool_sampler(metrics_url: str, deadline: float, samples: list[float]):
+    async with httpx.AsyncClient(timeout=5) as client:
+        while time.perf_counter() < deadline:
+            try:
+                r = await client.get(metrics_url)
+                values = [
+                    float(m.group(1))
+                    for m in map(POOL_GAUGE.match, r.text.splitlines())
+                    if m
+                ]
+                if values:
+                    samples.append(sum(values))
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.5)
+
+
+async def main(args):
+    async with httpx.AsyncClient(
+        base_url=args.url,
+        headers={"Authorization": f"Bearer {args.token}"},
+        limits=httpx.Limits(max_connections=args.concurrency),
+        timeout=120,
+    ) as client:
+        users = [await create_user(client) for _ in range(args.concurrency)]
+
+        stages = {"insert": [], "flush": [], "context": []}
+        errors = {"insert": [], "flush": [], "context": []}
+        pool_samples = []
+        start = time.perf_counter()
+        deadline = start + args.duration
+        await asyncio.gather(
+            *[
+                pipeline_worker(client, uid, deadline, args, stages, errors)
+                for uid in users
+            ],
+            pool_sampler(args.metrics_url, deadline, pool_samples),
+        )
+        elapsed = time.perf_counter() - start
+
+    print(f"\nflushes/sec: {len(stages['flush']) / elapsed:.2f}")
+    for name, latencies in stages.items():
+        stats = summarize(latencies)
+        if not stats["count"]:
+            print(f"{name}: no successful requests, {len(errors[name])} errors")
+            continue
+        print(
+            f"{name}: p50 {stats['p50_ms']:.1f}ms, p95 {stats['p95_ms']:.1f}ms, "
+            f"p99 {stats['p99_ms']:.1f}ms ({stats['count']} ok, {len(errors[name])} errors)"
+        )
+    if pool_samples:
+        print(
+            f"DB pool checked out: mean {np.mean(pool_samples):.1f}, "
+            f"max {max(pool_samples):.0f} of {args.pool_capacity} "
+            f"({max(pool_samples) / args.pool_capacity * 100:.0f}%)"
+        )
+    else:
+        print(f"DB pool: no samples from {args.metrics_url}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="http://localhost:8019")
+    parser.add_argument("--token", default="secret")
+    parser.add_argument("--metrics-url", default="http://localhost:9464/metrics")
+    parser.add_argument("--duration", type=float, default=60)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--blobs-per-flush", type=int, default=4)
+    parser.add_argument(
+        "--no-chats", action="store_true", help="read the context without chats"
+    )
+    parser.add_argument(
+        "--pool-capacity",
+        type=int,
+        default=125,
+        help="pool_size + max_overflow of the server's DB engine",
+    )
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,136 @@
+"""
+Measure the timeline reads of a user with a long history.
+
+Writes `--gists` synthetic event gists of one user straight into the DB of
+`DATABASE_URL`, spread over the last `--days` days, then times the query of
+`get_user_event_gists` (the latest gists of `/users/context` without chats) and
+prints its plan, with the timeline index and without it (dropped in a
+transaction that is rolled back). Run it from `src/server/api` with the
+server's env, on a DB you can lock for a while:
+
+    PYTHONPATH=. python ../../../docs/experiments/server-benchmark/timeline.py \
+        --gists 100000
+"""
+
+import memobase_server.env
+
+# Done setting up env
+import time
+import uuid
+import asyncio
+import argparse
+import numpy as np
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import delete, insert, text
+from memobase_server.env import CONFIG
+from memobase_server.connectors import AsyncSession, close_connection, explain_query
+from memobase_server.controllers.event_gist import select_user_event_gists_timeline
+from memobase_server.models.database import (
+    DEFAULT_PROJECT_ID,
+    User,
+    UserEvent,
+    UserEventGist,
+)
+from context_under_insert import summarize
+
+INSERT_BATCH = 2000
+TIMELINE_INDEX = "idx_user_event_gists_project_id_user_id_created_at"
+
+
+async def create_user_gists(size: int, days: int, rng) -> uuid.UUID:
+    user_id, event_id = uuid.uuid4(), uuid.uuid4()
+    async with AsyncSession() as session:
+        await session.execute(
+            insert(User), [{"id": user_id, "project_id": DEFAULT_PROJECT_ID}]
+        )
+        await session.execute(
+            insert(UserEvent),
+            [
+                {
+                    "id": event_id,
+                    "user_id": user_id,
+                    "project_id": DEFAULT_PROJECT_ID,
+                    "event_data": {},
+                }
+            ],
+        )
+        await session.commit()
+    now = datetime.now(timezone.utc)
+    start = time.perf_counter()
+    for offset in range(0, size, INSERT_BATCH):
+        n = min(INSERT_BATCH, size - offset)
+        # the stored rows are as wide as real ones
+        embeddings = rng.normal(size=(n, CONFIG.embedding_dim)).astype(np.float32)
+        ages = rng.uniform(0, days * 24 * 60 * 60, size=n)
+        async with AsyncSession() as session:
+            await session.execute(
+                insert(UserEventGist),
+                [
+                    {
+                        "id": uuid.uuid4(),
+                        "user_id": user_id,
+                        "event_id": event_id,
+                        "project_id": DEFAULT_PROJECT_ID,
+                        "gist_data": {"content": f"- synthetic gist {offset + i}"},
+                        "embedding": embeddings[i],
+                        "token_size": 5,
+                        "created_at": now - timedelta(seconds=float(ages[i])),
+                    }
+                    for i in range(n)
+                ],
+            )
+            await session.commit()
+    async with AsyncSession() as session:
+        await session.execute(text("ANALYZE user_event_gists"))
+        await session.commit()
+    print(f"inserted {size} gists in {time.perf_counter() - start:.1f}s")
+    return user_id
+
+
+async def time_timeline(args, user_id, drop_index: bool) -> tuple[dict, str]:
+    stmt = select_user_event_gists_timeline(
+        user_id, DEFAULT_PROJECT_ID, args.topk, args.time_range_in_days
+    )
+    latencies = []
+    async with AsyncSession() as session:
+        if drop_index:
+            await session.execute(text(f"DROP INDEX {TIMELINE_INDEX}"))
+        plan = await explain_query(session, stmt, analyze=True)
+        for _ in range(args.queries):
+            start = time.perf_counter()
+            await session.execute(stmt)
+            latencies.append((time.perf_counter() - start) * 1000)
+        await session.rollback()
+    return summarize(latencies), plan
+
+
+async def main(args):
+    rng = np.random.default_rng(0)
+    user_id = await create_user_gists(args.gists, args.days, rng)
+    try:
+        for name, drop_index in [("timeline index", False), ("no index", True)]:
+            stats, plan = await time_timeline(args, user_id, drop_index)
+            print(
+                f"\n{name}: p50 {stats['p50_ms']:.2f}ms, p95 {stats['p95_ms']:.2f}ms, "
+                f"p99 {stats['p99_ms']:.2f}ms"
+            )
+            print(plan)
+    finally:
+        async with AsyncSession() as session:
+            await session.execute(
+                delete(User).where(
+                    User.id == user_id, User.project_id == DEFAULT_PROJECT_ID
+                )
+            )
+            await session.commit()
+        await close_connection()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--gists", type=int, default=100000)
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--topk", type=int, default=60)
+    parser.add_argument("--time-range-in-days", type=int, default=180)
+    asyncio.run(main(parser.parse_args()))
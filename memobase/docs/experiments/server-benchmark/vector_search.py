@@ -0,0 +1,182 @@
+"""
+Measure event gist vector search at different numbers of gists per project.
+
+Writes synthetic gists straight into the DB of `DATABASE_URL`, spread over
+`--users` users of the root project, and times the search of one user with the
+previous query (threshold in WHERE) and the index-friendly one. Recall is
+against an exact scan. Run it from `src/server/api` with the server's env:
+
+    PYTHONPATH=. python ../../../docs/experiments/server-benchmark/vector_search.py \
+        --sizes 10000 100000 1000000
+"""
+
+import memobase_server.env
+
+# Done setting up env
+import time
+import uuid
+import asyncio
+import argparse
+import numpy as np
+from datetime import timedelta
+from sqlalchemy import delete, desc, func, insert, select, text
+from memobase_server.env import CONFIG
+from memobase_server.connectors import AsyncSession, close_connection
+from memobase_server.controllers.event_gist import search_event_gists_by_embedding
+from memobase_server.models.database import (
+    DEFAULT_PROJECT_ID,
+    User,
+    UserEvent,
+    UserEventGist,
+)
+from context_under_insert import summarize
+
+INSERT_BATCH = 2000
+
+
+def random_embeddings(centers: np.ndarray, n: int, rng) -> np.ndarray:
+    # clustered vectors, uniform ones have no neighbours worth finding
+    x = centers[rng.integers(len(centers), size=n)]
+    x = x + rng.normal(scale=0.3, size=x.shape) / np.sqrt(x.shape[1])
+    return (x / np.linalg.norm(x, axis=1, keepdims=True)).astype(np.float32)
+
+
+async def create_gists(size: int, num_users: int, centers, rng) -> list[str]:
+    user_ids = [uuid.uuid4() for _ in range(num_users)]
+    event_ids = [uuid.uuid4() for _ in range(num_users)]
+    async with AsyncSession() as session:
+        await session.execute(
+            insert(User),
+            [{"id": u, "project_id": DEFAULT_PROJECT_ID} for u in user_ids],
+        )
+        await session.execute(
+            insert(UserEvent),
+            [
+                {
+                    "id": e,
+                    "user_id": u,
+                    "project_id": DEFAULT_PROJECT_ID,
+                    "event_data": {},
+                }
+                for u, e in zip(user_ids, event_ids)
+            ],
+        )
+        await session.commit()
+    start = time.perf_counter()
+    for offset in range(0, size, INSERT_BATCH):
+        n = min(INSERT_BATCH, size - offset)
+        embeddings = random_embeddings(centers, n, rng)
+        owners = rng.integers(num_users, size=n)
+        async with AsyncSession() as session:
+            await session.execute(
+                insert(UserEventGist),
+                [
+                    {
+                        "id": uuid.uuid4(),
+                        "user_id": user_ids[o],
+                        "event_id": event_ids[o],
+                        "project_id": DEFAULT_PROJECT_ID,
+                        "gist_data": {"content": f"- synthetic gist {offset + i}"},
+                        "embedding": embeddings[i],
+                        "token_size": 5,
+                    }
+                    for i, o in enumerate(owners)
+                ],
+            )
+            await session.commit()
+    print(f"  inserted {size} gists in {time.perf_counter() - start:.1f}s")
+    return user_ids
+
+
+async def legacy_search(session, user_id, query_embedding, topk, threshold):
+    similarity_expr = 1 - UserEventGist.embedding.cosine_distance(query_embedding)
+    stmt = (
+        select(UserEventGist.id, similarity_expr.label("similarity"))
+        .where(
+            UserEventGist.user_id == user_id,
+            UserEventGist.project_id == DEFAULT_PROJECT_ID,
+            UserEventGist.created_at > func.now() - timedelta(days=21),
+            similarity_expr > threshold,
+            UserEventGist.embedding.is_not(None),
+        )
+        .order_by(desc("similarity"))
+        .limit(topk)
+    )
+    return (await session.execute(stmt)).all()
+
+
+async def run_size(args, size: int, centers, rng):
+    print(f"\n{size} gists, {args.users} users")
+    user_ids = await create_gists(size, args.users, centers, rng)
+    user_id = user_ids[0]
+    queries = random_embeddings(centers, args.queries, rng)
+    try:
+        legacy_latencies, ann_latencies, recalls = [], [], []
+        for q in queries:
+            async with AsyncSession() as session:
+                start = time.perf_counter()
+                await legacy_search(session, user_id, q, args.topk, args.threshold)
+                legacy_latencies.append((time.perf_counter() - start) * 1000)
+            async with AsyncSession() as session:
+                start = time.perf_counter()
+                found = await search_event_gists_by_embedding(
+                    session,
+                    user_id,
+                    DEFAULT_PROJECT_ID,
+                    q,
+                    args.topk,
+                    args.threshold,
+                    ef_search=args.ef_search,
+                )
+                ann_latencies.append((time.perf_counter() - start) * 1000)
+            async with AsyncSession() as session:
+                await session.execute(text("SET LOCAL enable_indexscan = off"))
+                exact = await search_event_gists_by_embedding(
+                    session,
+                    user_id,
+                    DEFAULT_PROJECT_ID,
+                    q,
+                    args.topk,
+                    args.threshold,
+                )
+            if exact:
+                hits = {g.id for g in found} & {g.id for g in exact}
+                recalls.append(len(hits) / len(exact))
+        for name, latencies in [("legacy", legacy_latencies), ("ann", ann_latencies)]:
+            stats = summarize(latencies)
+            print(
+                f"  {name}: p50 {stats['p50_ms']:.2f}ms, p95 {stats['p95_ms']:.2f}ms, "
+                f"p99 {stats['p99_ms']:.2f}ms"
+            )
+        if recalls:
+            print(f"  ann recall@{args.topk}: {np.mean(recalls):.3f}")
+    finally:
+        async with AsyncSession() as session:
+            await session.execute(
+                delete(User).where(
+                    User.id.in_(user_ids), User.project_id == DEFAULT_PROJECT_ID
+                )
+            )
+            await session.commit()
+
+
+async def main(args):
+    rng = np.random.default_rng(0)
+    centers = rng.normal(size=(256, CONFIG.embedding_dim))
+    centers /= np.linalg.norm(centers, axis=1, keepdims=True)
+    try:
+        for size in args.sizes:
+            await run_size(args, size, centers, rng)
+    finally:
+        await close_connection()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--topk", type=int, default=10)
+    parser.add_argument("--threshold", type=float, default=0.2)
+    parser.add_argument("--ef-search", type=int, default=None)
+    asyncio.run(main(parser.parse_args()))
@@ -8,7 +8,7 @@ from dataclasses import dataclass
 from urllib.parse import quote_plus
 from .blob import BlobData, Blob, BlobType, ChatBlob, OpenAICompatibleMessage
 from .user import UserProfile, UserProfileData, UserEventData, UserEventGistData
-from ..network import unpack_response
+from ..network import unpack_response, ETagCache
 from ..error import ServerError
 from ..utils import LOG
 
@@ -45,6 +45,8 @@ class AsyncMemoBaseClient:
             },
             timeout=60,
         )
+        # contexts fetched without chats, sent again only if the memory changed
+        self.context_cache = ETagCache()
 
     @property
     def client(self) -> httpx.AsyncClient:
@@ -129,6 +131,29 @@ class AsyncMemoBaseClient:
         r = unpack_response(await self._client.get(f"/project/usage?last_days={days}"))
         return r.data
 
+    async def insert_blobs(
+        self, blobs: list[tuple[str, Blob]], batch_size: int = 1000
+    ) -> list[str]:
+        """Insert `(user_id, blob)` pairs of many users, `batch_size` blobs per request.
+
+        The users must exist. Returns the blob ids in the input order.
+        """
+        ids = []
+        for i in range(0, len(blobs), batch_size):
+            r = unpack_response(
+                await self._client.post(
+                    "/blobs/batch_insert",
+                    json={
+                        "blobs": [
+                            {"user_id": user_id, **blob.to_request()}
+                            for user_id, blob in blobs[i : i + batch_size]
+                        ]
+                    },
+                )
+            )
+            ids.extend(r.data["ids"])
+        return ids
+
     async def close(self):
         await self._client.aclose()
 
@@ -379,9 +404,12 @@ class AsyncUser:
             params += f"&full_profile_and_only_search_event={'true' if full_profile_and_only_search_event else 'false'}"
         if fill_window_with_events is not None:
             params += f"&fill_window_with_events={'true' if fill_window_with_events else 'false'}"
-        r = unpack_response(
-            await self.project_client.client.get(
-                f"/users/context/{self.user_id}{params}"
-            )
+        path = f"/users/context/{self.user_id}{params}"
+        if chats:
+            r = unpack_response(await self.project_client.client.get(path))
+            return r.data["context"]
+        cache = self.project_client.context_cache
+        response = await self.project_client.client.get(
+            path, headers=cache.headers(path)
         )
-        return r.data["context"]
+        return cache.unpack(path, response)["context"]
@@ -9,7 +9,7 @@ from dataclasses import dataclass
 from urllib.parse import quote_plus
 from .blob import BlobData, Blob, BlobType, ChatBlob, OpenAICompatibleMessage
 from .user import UserProfile, UserProfileData, UserEventData, UserEventGistData
-from ..network import unpack_response
+from ..network import unpack_response, ETagCache
 from ..error import ServerError
 from ..utils import LOG
 
@@ -46,6 +46,8 @@ class MemoBaseClient:
             },
             timeout=60,
         )
+        # contexts fetched without chats, sent again only if the memory changed
+        self.context_cache = ETagCache()
 
     @property
     def client(self) -> httpx.Client:
@@ -126,6 +128,29 @@ class MemoBaseClient:
         r = unpack_response(self._client.get(f"/project/usage?last_days={days}"))
         return r.data
 
+    def insert_blobs(
+        self, blobs: list[tuple[str, Blob]], batch_size: int = 1000
+    ) -> list[str]:
+        """Insert `(user_id, blob)` pairs of many users, `batch_size` blobs per request.
+
+        The users must exist. Returns the blob ids in the input order.
+        """
+        ids = []
+        for i in range(0, len(blobs), batch_size):
+            r = unpack_response(
+                self._client.post(
+                    "/blobs/batch_insert",
+                    json={
+                        "blobs": [
+                            {"user_id": user_id, **blob.to_request()}
+                            for user_id, blob in blobs[i : i + batch_size]
+                        ]
+                    },
+                )
+            )
+            ids.extend(r.data["ids"])
+        return ids
+
 
 @dataclass
 class User:
@@ -361,7 +386,10 @@ class User:
             params += f"&full_profile_and_only_search_event={'true' if full_profile_and_only_search_event else 'false'}"
         if fill_window_with_events is not None:
             params += f"&fill_window_with_events={'true' if fill_window_with_events else 'false'}"
-        r = unpack_response(
-            self.project_client.client.get(f"/users/context/{self.user_id}{params}")
-        )
-        return r.data["context"]
+        path = f"/users/context/{self.user_id}{params}"
+        if chats:
+            r = unpack_response(self.project_client.client.get(path))
+            return r.data["context"]
+        cache = self.project_client.context_cache
+        response = self.project_client.client.get(path, headers=cache.headers(path))
+        return cache.unpack(path, response)["context"]
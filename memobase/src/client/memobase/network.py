@@ -1,3 +1,4 @@
+from collections import OrderedDict
 from httpx import Response
 from .core.type import BaseResponse
 
@@ -9,3 +10,32 @@ def unpack_response(response: Response) -> BaseResponse:
     r = BaseResponse.model_validate(response.json())
     r.raise_for_status()
     return r
+
+
+class ETagCache:
+    """The last data of GET paths, revalidated with `If-None-Match`."""
+
+    def __init__(self, max_size: int = 1000):
+        self.max_size = max_size
+        self.entries: OrderedDict[str, tuple[str, dict]] = OrderedDict()
+
+    def headers(self, path: str) -> dict:
+        if path not in self.entries:
+            return {}
+        return {"If-None-Match": self.entries[path][0]}
+
+    def unpack(self, path: str, response: Response) -> dict:
+        """The data of the response, or the cached one if it's not modified."""
+        if response.status_code == 304 and path in self.entries:
+            self.entries.move_to_end(path)
+            return self.entries[path][1]
+        data = unpack_response(response).data
+        etag = response.headers.get("ETag")
+        if etag:
+            self.entries[path] = (etag, data)
+            self.entries.move_to_end(path)
+            if len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        else:
+            self.entries.pop(path, None)
+        return data
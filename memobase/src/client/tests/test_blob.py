@@ -63,3 +63,21 @@ def test_flush_curd_client(api_client):
     print(u.event())
     mb.delete_user(uid)
     print("Deleted user")
+
+
+def test_blob_batch_insert_client(api_client):
+    a = api_client
+    u1 = a.add_user()
+    u2 = a.add_user()
+    blobs = [
+        (u1, DocBlob(content="test 1")),
+        (u2, DocBlob(content="test 2")),
+        (u1, DocBlob(content="test 3")),
+    ]
+    bids = a.insert_blobs(blobs, batch_size=2)
+    assert len(bids) == 3
+    assert a.get_user(u1).get(bids[2]).content == "test 3"
+    assert len(a.get_user(u1).get_all(BlobType.doc)) == 2
+    assert len(a.get_user(u2).get_all(BlobType.doc)) == 1
+    a.delete_user(u1)
+    a.delete_user(u2)
@@ -6,12 +6,19 @@ from contextlib import asynccontextmanager
 from fastapi import FastAPI, APIRouter
 from fastapi.openapi.utils import get_openapi
 from fastapi.middleware.cors import CORSMiddleware
+import asyncio
 from memobase_server.connectors import (
     close_connection,
     init_redis_pool,
 )
 from memobase_server import api_layer
-from memobase_server.env import LOG, TRACE_LOG
+from memobase_server.env import LOG, TRACE_LOG, CONFIG
+from memobase_server.controllers.buffer_background import (
+    start_flush_workers,
+    stop_flush_workers,
+)
+from memobase_server.local_cache import listen_project_invalidation
+from memobase_server.controllers.billing import run_billing_flusher
 from memobase_server.llms.embeddings import check_embedding_sanity
 from memobase_server.llms import llm_sanity_check
 from memobase_server.api_layer.docs import API_X_CODE_DOCS
@@ -23,8 +30,20 @@ async def lifespan(app: FastAPI):
     init_redis_pool()
     await check_embedding_sanity()
     await llm_sanity_check()
+    flush_stop_event = asyncio.Event()
+    flush_workers = start_flush_workers(CONFIG.buffer_flush_workers, flush_stop_event)
+    invalidation_listener = asyncio.create_task(
+        listen_project_invalidation(flush_stop_event)
+    )
+    billing_stop_event = asyncio.Event()
+    billing_flusher = asyncio.create_task(run_billing_flusher(billing_stop_event))
     LOG.info(f"Start Memobase Server {memobase_server.__version__} 🖼️")
     yield
+    await stop_flush_workers(flush_workers, flush_stop_event)
+    await invalidation_listener
+    # after the workers, so the tokens of their last LLM calls are billed
+    billing_stop_event.set()
+    await billing_flusher
     await close_connection()
 
 
@@ -173,6 +192,13 @@ router.post(
 )(api_layer.blob.insert_blob)
 
 
+router.post(
+    "/blobs/batch_insert",
+    tags=["blob"],
+    openapi_extra=API_X_CODE_DOCS["POST /blobs/batch_insert"],
+)(api_layer.blob.insert_blobs)
+
+
 router.get(
     "/blobs/{user_id}/{blob_id}",
     tags=["blob"],
@@ -0,0 +1,86 @@
+"""
+Fill `embedding` of the profiles written before it was stored.
+
+Run it once after migrating the DB (see `Migrations` in the server readme):
+
+    python backfill_profile_embeddings.py --batch-size 100
+
+It can run while the server is serving. Until all the profiles of a user are
+embedded, the `"vector"` profile filter of `/users/context` falls back to the LLM.
+"""
+
+import memobase_server.env
+
+# Done setting up env
+import asyncio
+import argparse
+from sqlalchemy import inspect, select, update
+from memobase_server.connectors import AsyncSession, close_connection
+from memobase_server.env import CONFIG, LOG
+from memobase_server.models.database import UserProfile
+from memobase_server.controllers.profile import embed_profile_lines
+from memobase_server.utils import profile_str_repr
+
+
+async def backfill(batch_size: int) -> int:
+    primary_key = [c.key for c in inspect(UserProfile).primary_key]
+    total = 0
+    while True:
+        async with AsyncSession() as session:
+            rows = (
+                await session.execute(
+                    select(
+                        UserProfile.user_id,
+                        UserProfile.content,
+                        UserProfile.attributes,
+                        *[getattr(UserProfile, k) for k in primary_key],
+                    )
+                    .where(UserProfile.embedding.is_(None))
+                    .limit(batch_size)
+                )
+            ).all()
+        if not rows:
+            return total
+        # embedded outside of the transaction, each project's usage on its own
+        projects = {}
+        for r in rows:
+            projects.setdefault(r.project_id, []).append(r)
+        rows, embeddings = [], []
+        for project_id, project_rows in projects.items():
+            embeddings += await embed_profile_lines(
+                str(project_rows[0].user_id),
+                project_id,
+                [profile_str_repr(r.content, r.attributes) for r in project_rows],
+            )
+            rows += project_rows
+        if any(e is None for e in embeddings):
+            LOG.error(f"Failed to embed profiles, stop after {total}")
+            return total
+        async with AsyncSession() as session:
+            await session.execute(
+                update(UserProfile),
+                [
+                    {**{k: getattr(r, k) for k in primary_key}, "embedding": e}
+                    for r, e in zip(rows, embeddings)
+                ],
+            )
+            await session.commit()
+        total += len(rows)
+        LOG.info(f"Backfilled {total} {UserProfile.__tablename__}")
+
+
+async def main(batch_size: int):
+    if not CONFIG.enable_event_embedding:
+        LOG.error("enable_event_embedding is false, profiles are not embedded")
+        return
+    try:
+        await backfill(batch_size)
+    finally:
+        await close_connection()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch-size", type=int, default=100)
+    args = parser.parse_args()
+    asyncio.run(main(args.batch_size))
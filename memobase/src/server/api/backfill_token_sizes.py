@@ -0,0 +1,72 @@
+"""
+Fill `token_size` of the profiles and event gists written before it was stored.
+
+Run it once after migrating the DB (see `Migrations` in the server readme):
+
+    python backfill_token_sizes.py --batch-size 1000
+
+It can run while the server is serving, rows without `token_size` are
+counted on read until they are filled.
+"""
+
+import memobase_server.env
+
+# Done setting up env
+import asyncio
+import argparse
+from sqlalchemy import inspect, select, update
+from memobase_server.connectors import AsyncSession, close_connection
+from memobase_server.env import LOG
+from memobase_server.models.database import UserProfile, UserEventGist
+from memobase_server.utils import get_token_lengths, profile_str_repr
+
+
+async def backfill(model, get_content, batch_size: int) -> int:
+    # the primary key has `created_at` too on tables created with `event_partitioning`
+    primary_key = [c.key for c in inspect(model).primary_key]
+    total = 0
+    while True:
+        async with AsyncSession() as session:
+            rows = (
+                (
+                    await session.execute(
+                        select(model)
+                        .where(model.token_size.is_(None))
+                        .limit(batch_size)
+                    )
+                )
+                .scalars()
+                .all()
+            )
+            if not rows:
+                return total
+            token_sizes = get_token_lengths([get_content(r) for r in rows])
+            await session.execute(
+                update(model),
+                [
+                    {**{k: getattr(r, k) for k in primary_key}, "token_size": t}
+                    for r, t in zip(rows, token_sizes)
+                ],
+            )
+            await session.commit()
+        total += len(rows)
+        LOG.info(f"Backfilled {total} {model.__tablename__}")
+
+
+async def main(batch_size: int):
+    try:
+        await backfill(
+            UserProfile,
+            lambda p: profile_str_repr(p.content, p.attributes),
+            batch_size,
+        )
+        await backfill(UserEventGist, lambda g: g.gist_data["content"], batch_size)
+    finally:
+        await close_connection()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+    asyncio.run(main(args.batch_size))
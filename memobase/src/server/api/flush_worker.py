@@ -0,0 +1,51 @@
+"""
+Standalone buffer flush workers.
+
+Run `python flush_worker.py --workers 4` on as many nodes as you need, and set
+`buffer_flush_workers: 0` in config.yaml of the API servers so that
+they only enqueue the flush tasks.
+"""
+
+import memobase_server.env
+
+# Done setting up env
+import signal
+import asyncio
+import argparse
+from memobase_server.connectors import close_connection, init_redis_pool
+from memobase_server.env import LOG
+from memobase_server.controllers.buffer_background import (
+    start_flush_workers,
+    stop_flush_workers,
+)
+from memobase_server.local_cache import listen_project_invalidation
+from memobase_server.controllers.billing import run_billing_flusher
+
+
+async def main(num_workers: int):
+    init_redis_pool()
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    workers = start_flush_workers(num_workers, stop_event)
+    # flushes read the project profile config, keep the local copy fresh
+    invalidation_listener = asyncio.create_task(listen_project_invalidation(stop_event))
+    billing_stop_event = asyncio.Event()
+    billing_flusher = asyncio.create_task(run_billing_flusher(billing_stop_event))
+    LOG.info(f"Start {num_workers} Memobase flush workers")
+    await stop_event.wait()
+    await stop_flush_workers(workers, stop_event)
+    await invalidation_listener
+    # after the workers, so the tokens of their last LLM calls are billed
+    billing_stop_event.set()
+    await billing_flusher
+    await close_connection()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+    asyncio.run(main(args.workers))
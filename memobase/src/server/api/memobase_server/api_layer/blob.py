@@ -4,13 +4,30 @@ import traceback
 
 from ..controllers import full as controllers
 
-from ..env import TelemetryKeyName, TRACE_LOG
+from ..env import TelemetryKeyName, TRACE_LOG, LOG
 from ..models.response import CODE
 from ..models.utils import Promise
 from ..models import response as res
 from ..telemetry.capture_key import capture_int_key
 
 
+async def check_project_token_left(project_id: str) -> Promise[None]:
+    p = await controllers.billing.get_project_billing(project_id)
+    if not p.ok():
+        return p
+    billing = p.data()
+
+    if billing.token_left is not None and billing.token_left < 0:
+        return Promise.reject(
+            CODE.SERVICE_UNAVAILABLE,
+            f"Your project reaches Memobase token limit, "
+            f"Left: {billing.token_left}, this project used: {billing.project_token_cost_month}. "
+            f"Your quota will be refilled on {billing.next_refill_at}. "
+            "\nhttps://www.memobase.io/pricing for more information.",
+        )
+    return Promise.resolve(None)
+
+
 async def insert_blob(
     request: Request,
     user_id: str = Path(..., description="The ID of the user to insert the blob for"),
@@ -25,33 +42,16 @@ async def insert_blob(
         capture_int_key, TelemetryKeyName.insert_blob_request, project_id=project_id
     )
 
-    p = await controllers.billing.get_project_billing(project_id)
+    p = await check_project_token_left(project_id)
     if not p.ok():
         return p.to_response(res.IdResponse)
-    billing = p.data()
-
-    if billing.token_left is not None and billing.token_left < 0:
-        return Promise.reject(
-            CODE.SERVICE_UNAVAILABLE,
-            f"Your project reaches Memobase token limit, "
-            f"Left: {billing.token_left}, this project used: {billing.project_token_cost_month}. "
-            f"Your quota will be refilled on {billing.next_refill_at}. "
-            "\nhttps://www.memobase.io/pricing for more information.",
-        ).to_response(res.IdResponse)
 
     try:
-        insert_result = await controllers.blob.insert_blob(
+        insert_result = await controllers.buffer.insert_blob_with_buffer(
             user_id, project_id, blob_data
         )
         if not insert_result.ok():
             return insert_result.to_response(res.BaseResponse)
-        bid = insert_result.data().id
-
-        pb = await controllers.buffer.insert_blob_to_buffer(
-            user_id, project_id, bid, blob_data.to_blob()
-        )
-        if not pb.ok():
-            return pb.to_response(res.BaseResponse)
 
         process_ids = await controllers.buffer.detect_buffer_full_or_not(
             user_id, project_id, blob_data.blob_type
@@ -98,6 +98,60 @@ async def insert_blob(
     )
 
 
+async def insert_blobs(
+    request: Request,
+    blobs_data: res.BlobsInsertData = Body(
+        ..., description="The blobs to insert, of one or many users"
+    ),
+    background_tasks: BackgroundTasks = BackgroundTasks(),
+) -> res.IdsResponse:
+    project_id = request.state.memobase_project_id
+    blobs = blobs_data.blobs
+    background_tasks.add_task(
+        capture_int_key,
+        TelemetryKeyName.insert_blob_request,
+        len(blobs),
+        project_id=project_id,
+    )
+
+    p = await check_project_token_left(project_id)
+    if not p.ok():
+        return p.to_response(res.IdsResponse)
+
+    try:
+        insert_result = await controllers.buffer.insert_blobs_with_buffers(
+            project_id, blobs
+        )
+        if not insert_result.ok():
+            return insert_result.to_response(res.IdsResponse)
+
+        batches = await controllers.buffer.split_full_buffers(
+            project_id, [(b.user_id, b.blob_type) for b in blobs]
+        )
+        if not batches.ok():
+            return batches.to_response(res.IdsResponse)
+        background_tasks.add_task(
+            controllers.buffer_background.flush_buffer_batches_in_background,
+            project_id,
+            batches.data(),
+        )
+    except Exception as e:
+        LOG.error(
+            f"Error inserting blobs of project {project_id}: {e}, {traceback.format_exc()}"
+        )
+        return Promise.reject(
+            CODE.INTERNAL_SERVER_ERROR, f"Error inserting blobs: {e}"
+        ).to_response(res.IdsResponse)
+
+    background_tasks.add_task(
+        capture_int_key,
+        TelemetryKeyName.insert_blob_success_request,
+        len(blobs),
+        project_id=project_id,
+    )
+    return insert_result.to_response(res.IdsResponse)
+
+
 async def get_blob(
     request: Request,
     user_id: str = Path(..., description="The ID of the user"),
@@ -1,16 +1,18 @@
 import json
+from typing import Literal, Optional
 
 from ..controllers import full as controllers
 
 from ..models.response import CODE
 from ..models.utils import Promise
 from ..models import response as res
-from fastapi import Request
-from fastapi import Path, Query
+from fastapi import Request, Response
+from fastapi import Path, Query, Header
 
 
 async def get_user_context(
     request: Request,
+    response: Response,
     user_id: str = Path(..., description="The ID of the user"),
     max_token_size: int = Query(
         1000,
@@ -83,10 +85,18 @@ Unless the user has relevant queries, do not actively mention those memories in
         True,
         description="""If you pass `chats_str` and set this to `False`, Memobase will search for relevant profiles and events at the same time.
 **NOTICE**
-- It will increase your latency by 2-5(based on the profile size) seconds, because Memobase will use LLM and Embedding to search for relevant profiles and events.
-- It will cost your Memobase tokens, roughly 100~1000 tokens per chat based on the profile size.
+- With `profile_filter_mode=vector`, the profiles are ranked by their embeddings, it adds no LLM call.
+- With `profile_filter_mode=llm`, it will increase your latency by 2-5(based on the profile size) seconds and cost your Memobase tokens, roughly 100~1000 tokens per chat based on the profile size.
 """,
     ),
+    profile_filter_mode: Optional[Literal["vector", "llm"]] = Query(
+        None,
+        description="How to search for relevant profiles with `chats_str`: `vector` ranks them by embedding similarity, `llm` asks a LLM to pick them (slower). Default is the server's `profile_filter_mode`.",
+    ),
+    if_none_match: Optional[str] = Header(
+        None,
+        description="The `ETag` of a previous response without `chats_str`. If the user's memory hasn't changed since, the response is `304 Not Modified` without a body.",
+    ),
     fill_window_with_events: bool = Query(
         False,
         description="If set to `True`, Memobase will fill the token window with the rest events.",
@@ -102,21 +112,32 @@ Unless the user has relevant queries, do not actively mention those memories in
         return Promise.reject(CODE.BAD_REQUEST, f"Invalid JSON: {e}").to_response(
             res.UserContextDataResponse
         )
-    p = await controllers.context.get_user_context(
+    p = await controllers.context.get_cached_user_context(
         user_id,
         project_id,
-        max_token_size,
-        prefer_topics,
-        only_topics,
-        max_subtopic_size,
-        topic_limits,
-        profile_event_ratio,
-        require_event_summary,
+        dict(
+            max_token_size=max_token_size,
+            prefer_topics=prefer_topics,
+            only_topics=only_topics,
+            max_subtopic_size=max_subtopic_size,
+            topic_limits=topic_limits,
+            profile_event_ratio=profile_event_ratio,
+            require_event_summary=require_event_summary,
+            event_similarity_threshold=event_similarity_threshold,
+            time_range_in_days=time_range_in_days,
+            customize_context_prompt=customize_context_prompt,
+            full_profile_and_only_search_event=full_profile_and_only_search_event,
+            fill_window_with_events=fill_window_with_events,
+            profile_filter_mode=profile_filter_mode,
+        ),
         chats,
-        event_similarity_threshold,
-        time_range_in_days,
-        customize_context_prompt=customize_context_prompt,
-        full_profile_and_only_search_event=full_profile_and_only_search_event,
-        fill_window_with_events=fill_window_with_events,
+        if_none_match=if_none_match,
     )
-    return p.to_response(res.UserContextDataResponse)
+    if not p.ok():
+        return p.to_response(res.UserContextDataResponse)
+    etag, context = p.data()["etag"], p.data()["context"]
+    if context is None:
+        return Response(status_code=304, headers={"ETag": etag})
+    if etag is not None:
+        response.headers["ETag"] = etag
+    return Promise.resolve(context).to_response(res.UserContextDataResponse)
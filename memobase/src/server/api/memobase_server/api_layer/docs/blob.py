@@ -170,6 +170,31 @@ func main() {
     ),
 )
 
+# Insert blobs in batch
+add_api_code_docs(
+    "POST",
+    "/blobs/batch_insert",
+    py_code(
+        """
+from memobase import MemoBaseClient
+from memobase.core.blob import ChatBlob
+
+client = MemoBaseClient(project_url='PROJECT_URL', api_key='PROJECT_TOKEN')
+
+blobs = [
+    (uid, ChatBlob(messages=[
+        {"role": "user", "content": "Hi, I'm here again"},
+        {"role": "assistant", "content": "Hi, Gus! How can I help you?"}
+    ])),
+    (another_uid, ChatBlob(messages=[
+        {"role": "user", "content": "I moved to Tokyo last month"}
+    ])),
+]
+bids = client.insert_blobs(blobs)
+"""
+    ),
+)
+
 # Get blob
 add_api_code_docs(
     "GET",
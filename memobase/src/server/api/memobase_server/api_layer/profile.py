@@ -1,6 +1,7 @@
 import json
-from fastapi import Request
-from fastapi import Path, Query, Body
+from typing import Optional
+from fastapi import Request, Response
+from fastapi import Path, Query, Body, Header
 from datetime import datetime
 from ..controllers import full as controllers
 from ..controllers.post_process.profile import filter_profiles_with_chats
@@ -13,6 +14,7 @@ from ..models import response as res
 
 async def get_user_profile(
     request: Request,
+    response: Response,
     user_id: str = Path(..., description="The ID of the user to get profiles for"),
     topk: int = Query(
         None, description="Number of profiles to retrieve, default is all"
@@ -41,6 +43,10 @@ async def get_user_profile(
         None,
         description='List of chats in OpenAI Message format, for example: [{"role": "user", "content": "Hello"}, {"role": "assistant", "content": "Hi"}]',
     ),
+    if_none_match: Optional[str] = Header(
+        None,
+        description="The `ETag` of a previous response without `chats_str`. If the user's memory hasn't changed since, the response is `304 Not Modified` without a body.",
+    ),
 ) -> res.UserProfileResponse:
     """Get the real-time user profiles for long term memory"""
     project_id = request.state.memobase_project_id
@@ -53,6 +59,24 @@ async def get_user_profile(
         return Promise.reject(
             CODE.BAD_REQUEST, f"Invalid JSON requests: {e}"
         ).to_response(res.UserProfileResponse)
+    etag = None
+    if not chats:
+        etag = await controllers.memory_version.get_user_memory_etag(
+            user_id,
+            project_id,
+            dict(
+                topk=topk,
+                max_token_size=max_token_size,
+                prefer_topics=prefer_topics,
+                only_topics=only_topics,
+                max_subtopic_size=max_subtopic_size,
+                topic_limits=topic_limits,
+            ),
+        )
+        if etag is not None and controllers.memory_version.etag_matches(
+            if_none_match, etag
+        ):
+            return Response(status_code=304, headers={"ETag": etag})
     p = await controllers.profile.get_user_profiles(user_id, project_id)
     if not p.ok():
         return p.to_response(res.UserProfileResponse)
@@ -77,6 +101,8 @@ async def get_user_profile(
         max_subtopic_size=max_subtopic_size,
         topic_limits=topic_limits,
     )
+    if p.ok() and etag is not None:
+        response.headers["ETag"] = etag
     return p.to_response(res.UserProfileResponse)
 
 
@@ -1,13 +1,29 @@
 import os
+import re
 import asyncio
 import redis.exceptions as redis_exceptions
 import redis.asyncio as redis
-from sqlalchemy import create_engine, text
+from sqlalchemy import create_engine, text, event
+from sqlalchemy.engine import make_url, URL
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.exc import OperationalError
+from sqlalchemy.sql.expression import Executable, ClauseElement
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.schema import CreateIndex
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from pgvector.asyncpg import register_vector
 from uuid import uuid4
-from .env import LOG
-from .models.database import REG, Project, UserEvent, UserEventGist
+from datetime import date, datetime, timezone
+from .env import LOG, CONFIG
+from .telemetry import telemetry_manager, GaugeMetricName
+from .models.database import (
+    REG,
+    Project,
+    UserProfile,
+    UserEvent,
+    UserEventGist,
+    BufferZone,
+)
 
 DATABASE_URL = os.getenv("DATABASE_URL")
 REDIS_URL = os.getenv("REDIS_URL")
@@ -22,9 +38,33 @@ LOG.info(f"Project ID: {PROJECT_ID}")
 LOG.info(f"Database URL: {DATABASE_URL}")
 LOG.info(f"Redis URL: {REDIS_URL}")
 
-# Create an engine
+
+def build_async_database_url(database_url: str) -> URL:
+    """Convert the psycopg2 style DATABASE_URL into an asyncpg one."""
+    url = make_url(database_url)
+    query = dict(url.query)
+    # asyncpg names libpq's `sslmode` as `ssl`
+    sslmode = query.pop("sslmode", None)
+    if sslmode is not None:
+        query["ssl"] = sslmode
+    return url.set(drivername="postgresql+asyncpg", query=query)
+
+
+# Sync engine, only used for startup (tables, root project) and scripts
 DB_ENGINE = create_engine(
     DATABASE_URL,
+    pool_size=5,
+    max_overflow=5,
+    pool_recycle=300,
+    pool_pre_ping=True,
+    pool_timeout=45,
+    pool_reset_on_return="commit",
+    echo_pool=False,
+)
+
+# Async engine, used by all the controllers on the request path
+ASYNC_DB_ENGINE = create_async_engine(
+    build_async_database_url(DATABASE_URL),
     pool_size=75,  # Increased from 50 to handle more concurrent operations
     max_overflow=50,  # Increased from 30 to provide more buffer
     pool_recycle=300,  # Reduced from 600 to recycle connections more frequently
@@ -34,8 +74,29 @@ DB_ENGINE = create_engine(
     echo_pool=False,  # Set to True for debugging pool issues
 )
 REDIS_POOL = None
+# pgvector >= 0.8.0 can keep scanning the HNSW index until enough rows pass the filters
+PGVECTOR_ITERATIVE_SCAN = False
+# `{table}_pYYYY_MM`, the partition of a month
+MONTHLY_PARTITION = re.compile(r"_p(\d{4})_(\d{2})$")
+
+
+@event.listens_for(ASYNC_DB_ENGINE.sync_engine, "connect")
+def register_vector_codec(dbapi_connection, connection_record):
+    # asyncpg needs the pgvector codec registered on every new connection
+    dbapi_connection.run_async(register_vector)
+
+
+@event.listens_for(ASYNC_DB_ENGINE.sync_engine, "checkout")
+@event.listens_for(ASYNC_DB_ENGINE.sync_engine, "checkin")
+def record_pool_usage(*args):
+    telemetry_manager.set_gauge_metric(
+        GaugeMetricName.DB_POOL_CHECKED_OUT, ASYNC_DB_ENGINE.pool.checkedout()
+    )
+
 
 Session = sessionmaker(bind=DB_ENGINE)
+# expire_on_commit=False: expired attributes can't be lazy-loaded in async code
+AsyncSession = async_sessionmaker(bind=ASYNC_DB_ENGINE, expire_on_commit=False)
 
 
 def create_pgvector_extension():
@@ -48,28 +109,218 @@ def create_pgvector_extension():
         LOG.error(f"Failed to create pgvector extension: {e}")
 
 
+def get_pgvector_version() -> tuple[int, ...]:
+    with Session() as session:
+        version = session.execute(
+            text("SELECT extversion FROM pg_extension WHERE extname = 'vector'")
+        ).scalar()
+    return tuple(int(v) for v in version.split(".")) if version else ()
+
+
+def get_partitioned_tables(conn) -> set[str]:
+    # an index of a partitioned table can't be built CONCURRENTLY
+    return set(
+        conn.execute(
+            text(
+                "SELECT c.relname FROM pg_partitioned_table p "
+                "JOIN pg_class c ON c.oid = p.partrelid"
+            )
+        ).scalars()
+    )
+
+
+def add_months(month: date, months: int) -> date:
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def maintain_event_partitions() -> list[str]:
+    """Create the monthly partitions of the event tables ahead of time, detach
+    and drop the ones older than `event_partition_retention_months`.
+
+    Only for tables created with `event_partitioning`. Rows outside every month
+    (e.g. imported with an old `created_at`) go to the `_default` partition.
+    Returns the dropped partitions.
+    """
+    this_month = datetime.now(timezone.utc).date().replace(day=1)
+    dropped = []
+    with DB_ENGINE.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        partitioned = get_partitioned_tables(conn)
+        for model in (UserEvent, UserEventGist):
+            table = model.__tablename__
+            if table not in partitioned:
+                continue
+            statements = [
+                f"CREATE TABLE IF NOT EXISTS {table}_default PARTITION OF {table} DEFAULT"
+            ]
+            for i in range(CONFIG.event_partition_premake_months + 1):
+                start = add_months(this_month, i)
+                statements.append(
+                    f"CREATE TABLE IF NOT EXISTS {table}_p{start:%Y_%m} "
+                    f"PARTITION OF {table} FOR VALUES "
+                    f"FROM ('{start} 00:00:00+00') TO ('{add_months(start, 1)} 00:00:00+00')"
+                )
+            if CONFIG.event_partition_retention_months > 0:
+                oldest = add_months(
+                    this_month, -CONFIG.event_partition_retention_months
+                )
+                partitions = conn.execute(
+                    text(
+                        "SELECT c.relname FROM pg_inherits i "
+                        "JOIN pg_class c ON c.oid = i.inhrelid "
+                        "WHERE i.inhparent = CAST(:table AS regclass)"
+                    ),
+                    {"table": table},
+                ).scalars()
+                for name in partitions:
+                    month = MONTHLY_PARTITION.search(name)
+                    if month and date(int(month[1]), int(month[2]), 1) < oldest:
+                        statements.append(
+                            f"ALTER TABLE {table} DETACH PARTITION {name}"
+                        )
+                        statements.append(f"DROP TABLE {name}")
+            for statement in statements:
+                try:
+                    conn.execute(text(statement))
+                except Exception as e:
+                    LOG.error(f"Failed to maintain partitions of {table}: {e}")
+                    continue
+                if statement.startswith("DROP TABLE"):
+                    dropped.append(statement.removeprefix("DROP TABLE "))
+    LOG.info("Event partitions created or already exist")
+    return dropped
+
+
+def create_vector_indexes():
+    """Build the HNSW indexes missing on existing tables, without blocking writes.
+
+    `create_all` only creates the indexes along with new tables.
+    """
+    global PGVECTOR_ITERATIVE_SCAN
+    try:
+        pgvector_version = get_pgvector_version()
+    except Exception as e:
+        LOG.error(f"Failed to get pgvector version: {e}")
+        return
+    PGVECTOR_ITERATIVE_SCAN = pgvector_version >= (0, 8, 0)
+    if pgvector_version < (0, 5, 0):
+        LOG.warning(f"pgvector {pgvector_version} has no HNSW index, search scans")
+        return
+    # CREATE INDEX CONCURRENTLY can't run in a transaction
+    with DB_ENGINE.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        partitioned = get_partitioned_tables(conn)
+        for model in (UserEvent, UserEventGist):
+            concurrently = "" if model.__tablename__ in partitioned else "CONCURRENTLY "
+            for index in model.__table__.indexes:
+                if index.dialect_options["postgresql"]["using"] != "hnsw":
+                    continue
+                try:
+                    conn.execute(
+                        text(
+                            f"CREATE INDEX {concurrently}IF NOT EXISTS {index.name} "
+                            f"ON {model.__tablename__} "
+                            "USING hnsw (embedding vector_cosine_ops) "
+                            f"WITH (m = {CONFIG.vector_index_m}, "
+                            f"ef_construction = {CONFIG.vector_index_ef_construction})"
+                        )
+                    )
+                except Exception as e:
+                    LOG.error(f"Failed to create vector index {index.name}: {e}")
+    LOG.info("Vector indexes created or already exist")
+
+
+def create_missing_indexes():
+    """Build the other indexes of the event and buffer tables missing on existing
+    tables, without blocking writes (timeline, event tags, idle buffers indexes).
+    """
+    with DB_ENGINE.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        partitioned = get_partitioned_tables(conn)
+        for model in (UserEvent, UserEventGist, BufferZone):
+            for index in model.__table__.indexes:
+                if index.dialect_options["postgresql"]["using"] == "hnsw":
+                    continue
+                ddl = str(
+                    CreateIndex(index, if_not_exists=True).compile(dialect=conn.dialect)
+                )
+                if model.__tablename__ not in partitioned:
+                    ddl = ddl.replace("CREATE INDEX", "CREATE INDEX CONCURRENTLY", 1)
+                try:
+                    conn.execute(text(ddl))
+                except Exception as e:
+                    LOG.error(f"Failed to create index {index.name}: {e}")
+    LOG.info("Indexes created or already exist")
+
+
 def create_tables():
     create_pgvector_extension()
 
     REG.metadata.create_all(DB_ENGINE)
     with Session() as session:
         Project.initialize_root_project(session)
+        UserProfile.check_legal_embedding_dim(session)
         UserEvent.check_legal_embedding_dim(session)
         UserEventGist.check_legal_embedding_dim(session)
+    create_vector_indexes()
+    create_missing_indexes()
+    maintain_event_partitions()
     LOG.info("Database tables created successfully")
 
 
 create_tables()
 
 
-def db_health_check() -> bool:
+async def set_vector_search_options(session, topk: int, ef_search: int = None):
+    """Tune the HNSW scan of the next searches in the transaction of `session`."""
+    ef_search = max(ef_search or CONFIG.vector_search_ef_search, topk)
+    await session.execute(text(f"SET LOCAL hnsw.ef_search = {int(ef_search)}"))
+    if PGVECTOR_ITERATIVE_SCAN:
+        # the user/time filters apply after the index scan, keep scanning until
+        # `topk` rows of the user are found
+        await session.execute(text("SET LOCAL hnsw.iterative_scan = relaxed_order"))
+
+
+def vector_search_order(distance):
+    """The ORDER BY of a search filtered by user, given its distance expression.
+
+    Before pgvector 0.8 the HNSW scan stops at `ef_search` rows of all the users,
+    and the filters drop most of them. Order by an expression the index can't serve,
+    so the rows of the user are found by their own index and ranked exactly.
+    """
+    if PGVECTOR_ITERATIVE_SCAN:
+        return distance
+    return distance + 0
+
+
+class Explain(Executable, ClauseElement):
+    """`EXPLAIN` a statement with its own bind parameters."""
+
+    inherit_cache = False
+
+    def __init__(self, statement, analyze: bool = False):
+        self.statement = statement
+        self.analyze = analyze
+
+
+@compiles(Explain, "postgresql")
+def compile_explain(element: Explain, compiler, **kw):
+    options = "(ANALYZE, BUFFERS) " if element.analyze else ""
+    return f"EXPLAIN {options}" + compiler.process(element.statement, **kw)
+
+
+async def explain_query(session, statement, analyze: bool = False) -> str:
+    """The query plan of `statement` in the transaction of `session`."""
+    rows = (await session.execute(Explain(statement, analyze))).all()
+    return "\n".join(row[0] for row in rows)
+
+
+async def db_health_check() -> bool:
     try:
-        conn = DB_ENGINE.connect()
-    except OperationalError as e:
+        async with ASYNC_DB_ENGINE.connect() as conn:
+            await conn.execute(text("SELECT 1"))
+    except (OperationalError, OSError) as e:
         LOG.error(f"Database connection failed: {e}")
         return False
     else:
-        conn.close()
         return True
 
 
@@ -85,6 +336,7 @@ async def redis_health_check() -> bool:
 
 
 async def close_connection():
+    await ASYNC_DB_ENGINE.dispose()
     DB_ENGINE.dispose()
     if REDIS_POOL is not None:
         await REDIS_POOL.aclose()
@@ -105,7 +357,7 @@ def get_redis_client() -> redis.Redis:
 
 def get_pool_status() -> dict:
     """Get current connection pool status for monitoring."""
-    pool = DB_ENGINE.pool
+    pool = ASYNC_DB_ENGINE.pool
     return {
         "size": pool.size(),
         "checked_in": pool.checkedin(),
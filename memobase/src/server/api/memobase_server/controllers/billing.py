@@ -1,4 +1,6 @@
+import asyncio
 from pydantic import ValidationError
+from sqlalchemy import select, update
 from ..models.utils import Promise
 from ..models.database import (
     ProjectBilling,
@@ -6,9 +8,11 @@ from ..models.database import (
     next_month_first_day,
 )
 from ..models.response import CODE, IdData, IdsData, UserProfilesData, BillingData
-from ..connectors import Session, ADMIN_URL
-from ..telemetry.capture_key import get_int_key, capture_int_key
+from ..connectors import AsyncSession, ADMIN_URL
+from ..telemetry.capture_key import get_int_key, capture_int_keys
 from ..env import (
+    CONFIG,
+    LOG,
     TelemetryKeyName,
     USAGE_TOKEN_LIMIT_MAP,
     BILLING_REFILL_AMOUNT_MAP,
@@ -18,14 +22,23 @@ from datetime import datetime, date
 from ..auth import admin_api
 
 
+def select_project_billing(project_id: str):
+    # Join instead of `ProjectBilling.billing`, lazy loading is not allowed in async sessions
+    return (
+        select(Billing)
+        .join(ProjectBilling, ProjectBilling.billing_id == Billing.id)
+        .where(ProjectBilling.project_id == project_id)
+    )
+
+
 async def get_project_billing(project_id: str) -> Promise[BillingData]:
     if ADMIN_URL is not None:
         return await admin_api.get_project_usage(project_id)
 
-    with Session() as session:
+    async with AsyncSession() as session:
         billing = (
-            session.query(ProjectBilling)
-            .filter(ProjectBilling.project_id == project_id)
+            (await session.execute(select_project_billing(project_id).limit(1)))
+            .scalars()
             .first()
         )
         if billing is None:
@@ -33,7 +46,6 @@ async def get_project_billing(project_id: str) -> Promise[BillingData]:
             # return Promise.reject(CODE.NOT_FOUND, "Billing not found").to_response(
             #     BillingData
             # )
-        billing = billing.billing
 
         this_month_token_costs_in = await get_int_key(
             TelemetryKeyName.llm_input_tokens, project_id, in_month=True
@@ -55,7 +67,7 @@ async def get_project_billing(project_id: str) -> Promise[BillingData]:
 
             billing.next_refill_at = next_month_first_day()
             billing.usage_left = usage_left_this_billing
-            session.commit()
+            await session.commit()
     billing_data = BillingData(
         token_left=usage_left_this_billing,
         next_refill_at=next_refill_date,
@@ -108,27 +120,149 @@ async def fallback_billing_data(project_id: str) -> Promise[BillingData]:
 async def project_cost_token_billing(
     project_id: str, input_tokens: int, output_tokens: int
 ) -> Promise[None]:
-    await capture_int_key(
-        TelemetryKeyName.llm_input_tokens, input_tokens, project_id=project_id
-    )
-    await capture_int_key(
-        TelemetryKeyName.llm_output_tokens, output_tokens, project_id=project_id
+    await capture_int_keys(
+        [
+            (TelemetryKeyName.llm_input_tokens, input_tokens, project_id),
+            (TelemetryKeyName.llm_output_tokens, output_tokens, project_id),
+        ]
     )
+    return await charge_project_usage(project_id, input_tokens, output_tokens)
+
+
+async def charge_project_usage(
+    project_id: str, input_tokens: int, output_tokens: int
+) -> Promise[None]:
     if ADMIN_URL is not None:
         return await admin_api.cost_project_usage(
             project_id, input_tokens, output_tokens
         )
-    with Session() as session:
-        _billing = (
-            session.query(ProjectBilling)
-            .filter(ProjectBilling.project_id == project_id)
-            .one_or_none()
-        )
-        if _billing is None:
+    async with AsyncSession() as session:
+        billing_id = (
+            await session.execute(
+                select(ProjectBilling.billing_id)
+                .where(ProjectBilling.project_id == project_id)
+                .limit(1)
+            )
+        ).scalar_one_or_none()
+        if billing_id is None:
             return Promise.reject(CODE.NOT_FOUND, "Billing not found")
-        billing = _billing.billing
-
-        if billing.usage_left is not None:
-            billing.usage_left -= input_tokens + output_tokens
-            session.commit()
+        # decrement in the UPDATE, concurrent charges of a project don't overwrite each other
+        await session.execute(
+            update(Billing)
+            .where(Billing.id == billing_id, Billing.usage_left.is_not(None))
+            .values(usage_left=Billing.usage_left - (input_tokens + output_tokens))
+            .execution_options(synchronize_session=False)
+        )
+        await session.commit()
     return Promise.resolve(None)
+
+
+# Write-behind billing: LLM calls add their tokens here, `flush_token_billing`
+# writes them with one Redis pipeline and one charge per project.
+# project id -> [input tokens, output tokens]
+_unrecorded_tokens: dict[str, list[int]] = {}
+_uncharged_tokens: dict[str, list[int]] = {}
+# project id -> failed flushes in a row
+_unrecorded_failures: dict[str, int] = {}
+_uncharged_failures: dict[str, int] = {}
+
+
+def add_pending_tokens(
+    pending: dict[str, list[int]],
+    project_id: str,
+    input_tokens: int,
+    output_tokens: int,
+):
+    tokens = pending.setdefault(project_id, [0, 0])
+    tokens[0] += input_tokens
+    tokens[1] += output_tokens
+
+
+def retry_pending_tokens(
+    pending: dict[str, list[int]],
+    failures: dict[str, int],
+    project_id: str,
+    tokens: list[int],
+    error: str,
+):
+    """Put the tokens back for the next flush, or drop them after too many failures."""
+    failures[project_id] = failures.get(project_id, 0) + 1
+    if failures[project_id] > CONFIG.billing_flush_max_retries:
+        failures.pop(project_id)
+        LOG.error(
+            f"[billing] Drop tokens {tokens} of project {project_id} after "
+            f"{CONFIG.billing_flush_max_retries} retries: {error}"
+        )
+        return
+    LOG.error(f"[billing] Failed to bill project {project_id}, retry later: {error}")
+    add_pending_tokens(pending, project_id, *tokens)
+
+
+def record_token_billing(project_id: str, input_tokens: int, output_tokens: int):
+    """Bill the tokens of a LLM call, at the next flush unless it's disabled."""
+    if CONFIG.billing_flush_interval_s <= 0:
+        asyncio.create_task(
+            project_cost_token_billing(project_id, input_tokens, output_tokens)
+        )
+        return
+    add_pending_tokens(_unrecorded_tokens, project_id, input_tokens, output_tokens)
+    add_pending_tokens(_uncharged_tokens, project_id, input_tokens, output_tokens)
+
+
+async def flush_token_billing():
+    """Write the pending tokens, the failed writes are retried at the next flushes."""
+    global _unrecorded_tokens, _uncharged_tokens
+    unrecorded, _unrecorded_tokens = _unrecorded_tokens, {}
+    uncharged, _uncharged_tokens = _uncharged_tokens, {}
+    if unrecorded:
+        try:
+            await capture_int_keys(
+                [
+                    (name, tokens[i], project_id)
+                    for project_id, tokens in unrecorded.items()
+                    for i, name in enumerate(
+                        [
+                            TelemetryKeyName.llm_input_tokens,
+                            TelemetryKeyName.llm_output_tokens,
+                        ]
+                    )
+                ],
+                atomic=True,
+            )
+            for project_id in unrecorded:
+                _unrecorded_failures.pop(project_id, None)
+        except Exception as e:
+            for project_id, tokens in unrecorded.items():
+                retry_pending_tokens(
+                    _unrecorded_tokens, _unrecorded_failures, project_id, tokens, e
+                )
+    for project_id, tokens in uncharged.items():
+        try:
+            p = await charge_project_usage(project_id, *tokens)
+            if p.ok():
+                _uncharged_failures.pop(project_id, None)
+                continue
+            if p.code() == CODE.NOT_FOUND:
+                # a project without billing will never be charged
+                LOG.warning(f"[billing] Skip charging project {project_id}: {p.msg()}")
+                continue
+            error = p.msg()
+        except Exception as e:
+            error = e
+        retry_pending_tokens(
+            _uncharged_tokens, _uncharged_failures, project_id, tokens, error
+        )
+
+
+async def run_billing_flusher(stop_event: asyncio.Event):
+    """Flush the pending tokens every `billing_flush_interval_s`, and once more on stop."""
+    if CONFIG.billing_flush_interval_s <= 0:
+        return
+    while not stop_event.is_set():
+        try:
+            await asyncio.wait_for(
+                stop_event.wait(), timeout=CONFIG.billing_flush_interval_s
+            )
+        except asyncio.TimeoutError:
+            pass
+        await flush_token_billing()
@@ -1,52 +1,273 @@
-from sqlalchemy import func
+import uuid
+import asyncio
+import pydantic
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import func, select, update, delete, insert
 from pydantic import BaseModel
-from ..env import CONFIG, BufferStatus, TRACE_LOG
+from ..env import CONFIG, BufferStatus, TRACE_LOG, LOG
 from ..utils import (
-    get_blob_token_size,
+    aget_blob_token_size,
+    aget_blob_token_sizes,
     pack_blob_from_db,
 )
 from ..models.utils import Promise
-from ..models.response import CODE, ChatModalResponse, IdsData
-from ..models.database import BufferZone, GeneralBlob
+from ..models.response import (
+    CODE,
+    ChatModalResponse,
+    IdsData,
+    IdData,
+    BlobData,
+    UserBlobData,
+)
+from ..models.database import BufferZone, GeneralBlob, User
 from ..models.blob import BlobType, Blob
-from ..connectors import Session, log_pool_status
+from ..connectors import AsyncSession, PROJECT_ID, get_redis_client, log_pool_status
 from .modal import BLOBS_PROCESS
 
+BUFFER_TOKENS_TTL = 60 * 60 * 24
+
+# Only touch the counter if it exists, a missing counter is rebuilt from the buffer rows
+REDIS_LUA_INCRBY_IF_EXISTS = """
+if redis.call("exists", KEYS[1]) == 1 then
+    local v = redis.call("incrby", KEYS[1], ARGV[1])
+    redis.call("expire", KEYS[1], ARGV[2])
+    return v
+end
+return nil
+"""
+
+
+def get_buffer_tokens_key(user_id: str, project_id: str, blob_type: BlobType) -> str:
+    return f"memobase:buffer_tokens:{PROJECT_ID}:{project_id}:{user_id}:{blob_type}"
+
+
+async def add_buffer_tokens(
+    user_id: str, project_id: str, blob_type: BlobType, token_size: int
+) -> int | None:
+    """Add to the buffered tokens counter of the user, returns None if the counter is missing"""
+    async with get_redis_client() as redis_client:
+        return await redis_client.eval(
+            REDIS_LUA_INCRBY_IF_EXISTS,
+            1,
+            get_buffer_tokens_key(user_id, project_id, blob_type),
+            token_size,
+            BUFFER_TOKENS_TTL,
+        )
+
+
+def update_buffer_status(buffer_ids: list[str], status: str):
+    return (
+        update(BufferZone)
+        .where(BufferZone.id.in_(buffer_ids))
+        .values(status=status)
+        .execution_options(synchronize_session=False)
+    )
+
+
+async def claim_buffer_ids(
+    session,
+    user_id: str,
+    project_id: str,
+    blob_type: BlobType,
+    buffer_ids: list[str],
+    from_status: str = BufferStatus.idle,
+) -> tuple[list[str], int]:
+    """Atomically move buffers from `from_status` to processing.
+
+    Concurrent callers block on the row locks and re-check the status after,
+    so every buffer is only returned to one caller.
+    Returns the claimed ids and their total token size.
+    """
+    claimed = (
+        await session.execute(
+            update(BufferZone)
+            .where(
+                BufferZone.user_id == user_id,
+                BufferZone.blob_type == str(blob_type),
+                BufferZone.project_id == project_id,
+                BufferZone.status == from_status,
+                BufferZone.id.in_(buffer_ids),
+            )
+            .values(status=BufferStatus.processing)
+            .returning(BufferZone.id, BufferZone.token_size)
+            .execution_options(synchronize_session=False)
+        )
+    ).all()
+    return [row.id for row in claimed], sum(row.token_size for row in claimed)
+
+
+async def keep_buffers_leased(buffer_ids: list[str], interval_s: float):
+    """Renew `updated_at` of processing buffers, so they won't be reclaimed."""
+    while True:
+        await asyncio.sleep(interval_s)
+        try:
+            async with AsyncSession() as session:
+                await session.execute(
+                    update(BufferZone)
+                    .where(
+                        BufferZone.id.in_(buffer_ids),
+                        BufferZone.status == BufferStatus.processing,
+                    )
+                    .values(updated_at=func.now())
+                    .execution_options(synchronize_session=False)
+                )
+                await session.commit()
+        except Exception as e:
+            LOG.error(f"Failed to renew the lease of buffers: {e}")
+
 
 async def get_buffer_capacity(
     user_id: str, project_id: str, blob_type: BlobType
 ) -> Promise[int]:
-    with Session() as session:
+    async with AsyncSession() as session:
         buffer_count = (
-            session.query(BufferZone.id)
-            .filter_by(
-                user_id=user_id,
-                blob_type=str(blob_type),
-                project_id=project_id,
-                status=BufferStatus.idle,
+            await session.execute(
+                select(func.count(BufferZone.id)).where(
+                    BufferZone.user_id == user_id,
+                    BufferZone.blob_type == str(blob_type),
+                    BufferZone.project_id == project_id,
+                    BufferZone.has_status(BufferStatus.idle),
+                )
             )
-            .count()
-        )
+        ).scalar_one()
     return Promise.resolve(buffer_count)
 
 
 async def insert_blob_to_buffer(
     user_id: str, project_id: str, blob_id: str, blob_data: Blob
 ) -> Promise[None]:
-    with Session() as session:
+    token_size = await aget_blob_token_size(blob_data)
+    async with AsyncSession() as session:
         buffer = BufferZone(
             user_id=user_id,
             blob_id=blob_id,
             blob_type=blob_data.type,
-            token_size=get_blob_token_size(blob_data),
+            token_size=token_size,
             project_id=project_id,
             status=BufferStatus.idle,
         )
         session.add(buffer)
-        session.commit()
+        await session.commit()
+    await add_buffer_tokens(user_id, project_id, blob_data.type, token_size)
     return Promise.resolve(None)
 
 
+async def insert_blob_with_buffer(
+    user_id: str, project_id: str, blob: BlobData
+) -> Promise[IdData]:
+    """Insert the blob and its buffer row in one transaction."""
+    try:
+        blob_parsed = blob.to_blob()
+    except pydantic.ValidationError as e:
+        return Promise.reject(CODE.BAD_REQUEST, f"Unable to parse blob: {e}")
+    token_size = await aget_blob_token_size(blob_parsed)
+    async with AsyncSession() as session:
+        blob_db = GeneralBlob(
+            blob_type=blob_parsed.type,
+            blob_data=blob_parsed.get_blob_data(),
+            additional_fields=blob_parsed.fields,
+            user_id=user_id,
+            project_id=project_id,
+        )
+        # `blob_id` references the blob, the unit of work inserts the blob first
+        buffer = BufferZone(
+            user_id=user_id,
+            blob_id=blob_db.id,
+            blob_type=blob_parsed.type,
+            token_size=token_size,
+            project_id=project_id,
+            status=BufferStatus.idle,
+        )
+        session.add_all([blob_db, buffer])
+        await session.commit()
+        b_id = blob_db.id
+    await add_buffer_tokens(user_id, project_id, blob_parsed.type, token_size)
+    return Promise.resolve(IdData(id=b_id))
+
+
+async def insert_blobs_with_buffers(
+    project_id: str, blobs: list[UserBlobData]
+) -> Promise[IdsData]:
+    """Insert the blobs of many users and their buffer rows in one transaction.
+
+    Rows are written with multi-row INSERTs, the buffered tokens counters are updated
+    once per user and blob type.
+    """
+    blob_rows, buffer_rows = [], []
+    buffered_tokens: dict[tuple[str, BlobType], int] = {}
+    now = datetime.now(timezone.utc)
+    blobs_parsed = []
+    for i, blob in enumerate(blobs):
+        try:
+            blobs_parsed.append(blob.to_blob())
+        except (pydantic.ValidationError, NotImplementedError) as e:
+            return Promise.reject(CODE.BAD_REQUEST, f"Unable to parse blob {i}: {e}")
+    token_sizes = await aget_blob_token_sizes(blobs_parsed)
+    for i, (blob, blob_parsed, token_size) in enumerate(
+        zip(blobs, blobs_parsed, token_sizes)
+    ):
+        blob_id = uuid.uuid4()
+        blob_rows.append(
+            {
+                "id": blob_id,
+                "blob_type": str(blob_parsed.type),
+                "blob_data": blob_parsed.get_blob_data(),
+                "additional_fields": blob_parsed.fields,
+                "user_id": blob.user_id,
+                "project_id": project_id,
+            }
+        )
+        buffer_rows.append(
+            {
+                "id": uuid.uuid4(),
+                "blob_id": blob_id,
+                "blob_type": str(blob_parsed.type),
+                "token_size": token_size,
+                "user_id": blob.user_id,
+                "project_id": project_id,
+                "status": BufferStatus.idle,
+                # rows of one statement share now(), keep the request order for flushes
+                "created_at": now + timedelta(microseconds=i),
+            }
+        )
+        key = (blob.user_id, blob_parsed.type)
+        buffered_tokens[key] = buffered_tokens.get(key, 0) + token_size
+    if not blob_rows:
+        return Promise.resolve(IdsData(ids=[]))
+
+    user_ids = {row["user_id"] for row in blob_rows}
+    async with AsyncSession() as session:
+        exist_user_ids = (
+            await session.execute(
+                select(User.id).where(
+                    User.project_id == project_id, User.id.in_(user_ids)
+                )
+            )
+        ).scalars()
+        missing_user_ids = user_ids - set(exist_user_ids)
+        if missing_user_ids:
+            return Promise.reject(
+                CODE.NOT_FOUND,
+                f"Users not found: {', '.join(str(u) for u in missing_user_ids)}",
+            )
+        await session.execute(insert(GeneralBlob), blob_rows)
+        await session.execute(insert(BufferZone), buffer_rows)
+        await session.commit()
+
+    async with get_redis_client() as redis_client:
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for (user_id, blob_type), token_size in buffered_tokens.items():
+                pipe.eval(
+                    REDIS_LUA_INCRBY_IF_EXISTS,
+                    1,
+                    get_buffer_tokens_key(user_id, project_id, blob_type),
+                    token_size,
+                    BUFFER_TOKENS_TTL,
+                )
+            await pipe.execute()
+    return Promise.resolve(IdsData(ids=[row["id"] for row in blob_rows]))
+
+
 async def wait_insert_done_then_flush(
     user_id: str, project_id: str, blob_type: BlobType
 ) -> Promise[ChatModalResponse | None]:
@@ -66,20 +287,34 @@ async def wait_insert_done_then_flush(
 async def detect_buffer_full_or_not(
     user_id: str, project_id: str, blob_type: BlobType
 ) -> Promise[IdsData | None]:
-    with Session() as session:
+    buffer_tokens_key = get_buffer_tokens_key(user_id, project_id, blob_type)
+    async with get_redis_client() as redis_client:
+        buffered_tokens = await redis_client.get(buffer_tokens_key)
+    if (
+        buffered_tokens is not None
+        and int(buffered_tokens) <= CONFIG.max_chat_blob_buffer_token_size
+    ):
+        return Promise.resolve(IdsData(ids=[]))
+
+    # The counter is missing or says full, confirm with the buffer rows and resync it
+    async with AsyncSession() as session:
         # 1. if buffer size reach maximum, flush it
         buffer_zone = (
-            session.query(BufferZone.id, BufferZone.token_size)
-            .filter_by(
-                user_id=user_id,
-                blob_type=str(blob_type),
-                project_id=project_id,
-                status=BufferStatus.idle,
+            await session.execute(
+                select(BufferZone.id, BufferZone.token_size).where(
+                    BufferZone.user_id == user_id,
+                    BufferZone.blob_type == str(blob_type),
+                    BufferZone.project_id == project_id,
+                    BufferZone.has_status(BufferStatus.idle),
+                )
             )
-            .all()
-        )
+        ).all()
         buffer_ids = [row.id for row in buffer_zone]
         buffer_token_size = sum(row.token_size for row in buffer_zone)
+        async with get_redis_client() as redis_client:
+            await redis_client.set(
+                buffer_tokens_key, buffer_token_size, ex=BUFFER_TOKENS_TTL
+            )
         if (
             buffer_token_size
             and buffer_token_size > CONFIG.max_chat_blob_buffer_token_size
@@ -94,23 +329,89 @@ async def detect_buffer_full_or_not(
     return Promise.resolve(IdsData(ids=[]))
 
 
+def cut_buffer_batches(rows) -> tuple[list[list[str]], list[str]]:
+    """Cut the buffer rows (in insert order) whenever a batch exceeds
+    `max_chat_blob_buffer_token_size`. Returns the full batches and the rest."""
+    batches, batch_ids, batch_token_size = [], [], 0
+    for row in rows:
+        batch_ids.append(row.id)
+        batch_token_size += row.token_size
+        if batch_token_size > CONFIG.max_chat_blob_buffer_token_size:
+            batches.append(batch_ids)
+            batch_ids, batch_token_size = [], 0
+    return batches, batch_ids
+
+
+async def split_full_buffers(
+    project_id: str, user_blob_types: list[tuple[str, BlobType]]
+) -> Promise[list[tuple[str, BlobType, list[str]]]]:
+    """Cut the idle buffers of many users into flush batches.
+
+    Buffers are cut in insert order whenever a batch exceeds
+    `max_chat_blob_buffer_token_size`, same as inserting the blobs one by one.
+    The rest stay idle. Returns `(user_id, blob_type, buffer_ids)` batches.
+    """
+    user_blob_types = set(user_blob_types)
+    if not user_blob_types:
+        return Promise.resolve([])
+    async with AsyncSession() as session:
+        buffer_zone = (
+            await session.execute(
+                select(
+                    BufferZone.id,
+                    BufferZone.user_id,
+                    BufferZone.blob_type,
+                    BufferZone.token_size,
+                )
+                .where(
+                    BufferZone.project_id == project_id,
+                    BufferZone.user_id.in_({u for u, _ in user_blob_types}),
+                    BufferZone.blob_type.in_({str(t) for _, t in user_blob_types}),
+                    BufferZone.has_status(BufferStatus.idle),
+                )
+                .order_by(BufferZone.created_at)
+            )
+        ).all()
+
+    idle_buffers: dict[tuple[str, BlobType], list] = {}
+    for row in buffer_zone:
+        key = (row.user_id, BlobType(row.blob_type))
+        if key in user_blob_types:
+            idle_buffers.setdefault(key, []).append(row)
+
+    batches = []
+    async with get_redis_client() as redis_client:
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for (user_id, blob_type), rows in idle_buffers.items():
+                full_batches, _ = cut_buffer_batches(rows)
+                batches.extend((user_id, blob_type, ids) for ids in full_batches)
+                # resync the counter, the batches are subtracted when claimed
+                pipe.set(
+                    get_buffer_tokens_key(user_id, project_id, blob_type),
+                    sum(row.token_size for row in rows),
+                    ex=BUFFER_TOKENS_TTL,
+                )
+            await pipe.execute()
+    return Promise.resolve(batches)
+
+
 async def get_unprocessed_buffer_ids(
     user_id: str,
     project_id: str,
     blob_type: BlobType,
     select_status: str = BufferStatus.idle,
 ) -> Promise[IdsData]:
-    with Session() as session:
+    async with AsyncSession() as session:
         buffer_ids = (
-            session.query(BufferZone.id)
-            .filter_by(
-                user_id=user_id,
-                blob_type=str(blob_type),
-                project_id=project_id,
-                status=select_status,
+            await session.execute(
+                select(BufferZone.id).where(
+                    BufferZone.user_id == user_id,
+                    BufferZone.blob_type == str(blob_type),
+                    BufferZone.project_id == project_id,
+                    BufferZone.has_status(select_status),
+                )
             )
-            .all()
-        )
+        ).all()
         return Promise.resolve(IdsData(ids=[row.id for row in buffer_ids]))
 
 
@@ -121,7 +422,6 @@ async def flush_buffer_by_ids(
     buffer_ids: list[str],
     select_status: str = BufferStatus.idle,
 ) -> Promise[ChatModalResponse | None]:
-    # FIXME: parallel calling will cause duplicated flush
     if blob_type not in BLOBS_PROCESS:
         return Promise.reject(CODE.BAD_REQUEST, f"Blob type {blob_type} not supported")
     if not len(buffer_ids):
@@ -130,41 +430,41 @@ async def flush_buffer_by_ids(
     # Log initial pool status
     log_pool_status(f"flush_buffer_by_ids_start_{blob_type}")
 
-    with Session() as session:
+    async with AsyncSession() as session:
+        claimed_token_size = 0
+        if select_status != BufferStatus.processing:
+            # Claim before reading, parallel callers must not flush the same buffers
+            buffer_ids, claimed_token_size = await claim_buffer_ids(
+                session, user_id, project_id, blob_type, buffer_ids, select_status
+            )
         # Join BufferZone with GeneralBlob to get all data in one query
         buffer_blob_data = (
-            session.query(
-                BufferZone.id.label("buffer_id"),
-                BufferZone.blob_id,
-                BufferZone.token_size,
-                BufferZone.created_at.label("buffer_created_at"),
-                GeneralBlob.created_at,
-                GeneralBlob.blob_data,
-            )
-            .join(GeneralBlob, BufferZone.blob_id == GeneralBlob.id)
-            .filter(
-                BufferZone.user_id == user_id,
-                BufferZone.blob_type == str(blob_type),
-                BufferZone.project_id == project_id,
-                GeneralBlob.user_id == user_id,
-                GeneralBlob.project_id == project_id,
-                BufferZone.status == select_status,
-                BufferZone.id.in_(buffer_ids),
+            await session.execute(
+                select(
+                    BufferZone.id.label("buffer_id"),
+                    BufferZone.blob_id,
+                    BufferZone.token_size,
+                    BufferZone.created_at.label("buffer_created_at"),
+                    GeneralBlob.created_at,
+                    GeneralBlob.blob_data,
+                )
+                .join(GeneralBlob, BufferZone.blob_id == GeneralBlob.id)
+                .where(
+                    BufferZone.user_id == user_id,
+                    BufferZone.blob_type == str(blob_type),
+                    BufferZone.project_id == project_id,
+                    GeneralBlob.user_id == user_id,
+                    GeneralBlob.project_id == project_id,
+                    BufferZone.status == BufferStatus.processing,
+                    BufferZone.id.in_(buffer_ids),
+                )
+                .order_by(BufferZone.created_at)
             )
-            .order_by(BufferZone.created_at)
-            .all()
-        )
-        # Update buffer status to processing
+        ).all()
         process_buffer_ids = [row.buffer_id for row in buffer_blob_data]
-        if select_status != BufferStatus.processing:
-            session.query(BufferZone).filter(
-                BufferZone.id.in_(process_buffer_ids),
-            ).update(
-                {BufferZone.status: BufferStatus.processing},
-                synchronize_session=False,
-            )
 
         if not buffer_blob_data:
+            await session.commit()
             TRACE_LOG.info(
                 project_id,
                 user_id,
@@ -181,8 +481,13 @@ async def flush_buffer_by_ids(
             f"Flush {blob_type} buffer with {len(buffer_blob_data)} blobs and total token size({total_token_size})",
         )
 
-        session.commit()
+        await session.commit()
+    if select_status == BufferStatus.idle and claimed_token_size:
+        await add_buffer_tokens(user_id, project_id, blob_type, -claimed_token_size)
 
+    lease_task = asyncio.create_task(
+        keep_buffers_leased(process_buffer_ids, CONFIG.buffer_flush_lease_s / 3)
+    )
     try:
         # Pack blobs from the joined data
 
@@ -190,37 +495,35 @@ async def flush_buffer_by_ids(
         p = await BLOBS_PROCESS[blob_type](user_id, project_id, blobs)
         if not p.ok():
             # Rollback buffer status to failed if the process failed
-            with Session() as session:
-                session.query(BufferZone).filter(
-                    BufferZone.id.in_(process_buffer_ids),
-                ).update(
-                    {BufferZone.status: BufferStatus.failed},
-                    synchronize_session=False,
+            async with AsyncSession() as session:
+                await session.execute(
+                    update_buffer_status(process_buffer_ids, BufferStatus.failed)
                 )
-                session.commit()
+                await session.commit()
             return p
-        with Session() as session:
+        async with AsyncSession() as session:
             try:
                 # Update buffer status to done
-                session.query(BufferZone).filter(
-                    BufferZone.id.in_(process_buffer_ids),
-                ).update(
-                    {BufferZone.status: BufferStatus.done},
-                    synchronize_session=False,
+                await session.execute(
+                    update_buffer_status(process_buffer_ids, BufferStatus.done)
                 )
                 if blob_type == BlobType.chat and not CONFIG.persistent_chat_blobs:
-                    session.query(GeneralBlob).filter(
-                        GeneralBlob.id.in_(blob_ids),
-                        GeneralBlob.project_id == project_id,
-                    ).delete(synchronize_session=False)
-                session.commit()
+                    await session.execute(
+                        delete(GeneralBlob)
+                        .where(
+                            GeneralBlob.id.in_(blob_ids),
+                            GeneralBlob.project_id == project_id,
+                        )
+                        .execution_options(synchronize_session=False)
+                    )
+                await session.commit()
                 TRACE_LOG.info(
                     project_id,
                     user_id,
                     f"Flushed {blob_type} buffer(size: {len(buffer_blob_data)})",
                 )
             except Exception as e:
-                session.rollback()
+                await session.rollback()
                 TRACE_LOG.error(
                     project_id,
                     user_id,
@@ -232,14 +535,11 @@ async def flush_buffer_by_ids(
         return p
 
     except Exception as e:
-        with Session() as session:
-            session.query(BufferZone).filter(
-                BufferZone.id.in_(process_buffer_ids),
-            ).update(
-                {BufferZone.status: BufferStatus.failed},
-                synchronize_session=False,
+        async with AsyncSession() as session:
+            await session.execute(
+                update_buffer_status(process_buffer_ids, BufferStatus.failed)
             )
-            session.commit()
+            await session.commit()
         TRACE_LOG.error(
             project_id,
             user_id,
@@ -247,6 +547,8 @@ async def flush_buffer_by_ids(
         )
         log_pool_status(f"flush_buffer_by_ids_exception_{blob_type}")
         raise e
+    finally:
+        lease_task.cancel()
 
 
 async def flush_buffer(
@@ -1,16 +1,28 @@
+import json
+import time
 import uuid
 import asyncio
 import traceback
-from sqlalchemy import func
-from pydantic import BaseModel
-from ..env import CONFIG, BufferStatus, TRACE_LOG
-from ..models.utils import Promise
-from ..models.response import CODE, ChatModalResponse, IdsData, UUID
-from ..models.database import BufferZone, GeneralBlob
-from ..models.blob import BlobType, Blob
-from ..connectors import Session, PROJECT_ID, get_redis_client
+from datetime import timedelta
+from sqlalchemy import func, select, update
+from ..env import CONFIG, BufferStatus, TRACE_LOG, LOG
+from ..models.database import BufferZone
+from ..models.blob import BlobType
+from ..connectors import AsyncSession, PROJECT_ID, get_redis_client
+from ..telemetry import (
+    telemetry_manager,
+    CounterMetricName,
+    HistogramMetricName,
+    GaugeMetricName,
+)
 from .modal import BLOBS_PROCESS
-from .buffer import flush_buffer_by_ids
+from .buffer import (
+    flush_buffer_by_ids,
+    claim_buffer_ids,
+    add_buffer_tokens,
+    cut_buffer_batches,
+)
+from .compaction import run_compaction_scheduler
 
 REDIS_LUA_CHECK_AND_DELETE_LOCK = """
 if redis.call("get", KEYS[1]) == ARGV[1] then
@@ -20,21 +32,66 @@ else
 end
 """
 
+REDIS_LUA_CHECK_AND_EXPIRE_LOCK = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("expire", KEYS[1], ARGV[2])
+else
+    return 0
+end
+"""
+
 
 def get_user_lock_key(user_id: str, project_id: str, scope: str) -> str:
     return f"memobase:user_lock:{PROJECT_ID}:{scope}:{project_id}:{user_id}"
 
 
-def get_user_buffer_queue_key(user_id: str, project_id: str, scope: str) -> str:
-    return f"memobase:user_buffer_queue:{PROJECT_ID}:{scope}:{project_id}:{user_id}"
+def get_flush_queue_key() -> str:
+    return f"memobase:flush_queue:{PROJECT_ID}"
+
+
+def get_flush_processing_key(worker_id: str) -> str:
+    return f"memobase:flush_queue_processing:{PROJECT_ID}:{worker_id}"
+
+
+def get_flush_worker_key(worker_id: str) -> str:
+    return f"memobase:flush_worker:{PROJECT_ID}:{worker_id}"
 
 
-def pack_ids_to_str(ids: list[str]) -> str:
-    return "::".join([str(i) for i in ids])
+def get_flush_workers_key() -> str:
+    return f"memobase:flush_workers:{PROJECT_ID}"
 
 
-def unpack_ids_from_str(ids_str: str) -> list[str]:
-    return [i.strip() for i in ids_str.split("::") if i.strip()]
+def get_idle_flush_lock_key() -> str:
+    return f"memobase:idle_flush_scheduler:{PROJECT_ID}"
+
+
+def pack_flush_task(
+    user_id: str, project_id: str, blob_type: BlobType, buffer_ids: list[str]
+) -> str:
+    return json.dumps(
+        {
+            "user_id": str(user_id),
+            "project_id": project_id,
+            "blob_type": str(blob_type),
+            "buffer_ids": [str(i) for i in buffer_ids],
+            "enqueued_at": time.time(),
+        }
+    )
+
+
+async def enqueue_flush_task(
+    user_id: str, project_id: str, blob_type: BlobType, buffer_ids: list[str]
+) -> None:
+    async with get_redis_client() as redis_client:
+        queue_size = await redis_client.rpush(
+            get_flush_queue_key(),
+            pack_flush_task(user_id, project_id, blob_type, buffer_ids),
+        )
+    TRACE_LOG.info(
+        project_id,
+        user_id,
+        f"[background] Enqueued {len(buffer_ids)} buffer IDs to queue (queue size: {queue_size})",
+    )
 
 
 async def flush_buffer_by_ids_in_background(
@@ -45,231 +102,420 @@ async def flush_buffer_by_ids_in_background(
     if blob_type not in BLOBS_PROCESS:
         return
 
-    # 1. mark buffer as processing
-    with Session() as session:
-        buffer_blob_data = (
-            session.query(BufferZone.id)
-            .filter(
-                BufferZone.user_id == user_id,
-                BufferZone.blob_type == str(blob_type),
-                BufferZone.project_id == project_id,
-                BufferZone.status == BufferStatus.idle,
-                BufferZone.id.in_(buffer_ids),
-            )
-            .order_by(BufferZone.created_at)
-            .all()
+    # 1. claim buffers as processing, `updated_at` is the start of their lease
+    async with AsyncSession() as session:
+        actual_buffer_ids, claimed_token_size = await claim_buffer_ids(
+            session, user_id, project_id, blob_type, buffer_ids
         )
-        actual_buffer_ids = [row.id for row in buffer_blob_data]
-        if not len(actual_buffer_ids):
-            return
-        session.query(BufferZone).filter(
-            BufferZone.id.in_(actual_buffer_ids),
-        ).update(
-            {BufferZone.status: BufferStatus.processing},
-            synchronize_session=False,
+        await session.commit()
+    if not len(actual_buffer_ids):
+        return
+    await add_buffer_tokens(user_id, project_id, blob_type, -claimed_token_size)
+
+    # 2. hand the buffer ids to the flush workers.
+    # If this fails, the buffers stay `processing` and are reclaimed after the lease
+    try:
+        await enqueue_flush_task(user_id, project_id, blob_type, actual_buffer_ids)
+    except Exception as e:
+        TRACE_LOG.error(
+            project_id,
+            user_id,
+            f"[background] Error enqueue buffer ids: {e}: {traceback.format_exc()}",
         )
 
-        session.commit()
 
-    # 2. add actual buffer ids to a redis queue
-    buffer_queue_key = get_user_buffer_queue_key(
-        user_id, project_id, f"flush_buffer_background_{blob_type}"
-    )
-    buffer_ids_str = pack_ids_to_str(actual_buffer_ids)
+async def flush_buffer_batches_in_background(
+    project_id: str, batches: list[tuple[str, BlobType, list[str]]]
+) -> None:
+    """Claim the buffer batches of many users and enqueue them with one RPUSH."""
+    batches = [b for b in batches if b[1] in BLOBS_PROCESS and len(b[2])]
+    if not batches:
+        return
 
+    async with AsyncSession() as session:
+        claimed = (
+            await session.execute(
+                update(BufferZone)
+                .where(
+                    BufferZone.project_id == project_id,
+                    BufferZone.has_status(BufferStatus.idle),
+                    BufferZone.id.in_([i for b in batches for i in b[2]]),
+                )
+                .values(status=BufferStatus.processing)
+                .returning(BufferZone.id, BufferZone.token_size)
+                .execution_options(synchronize_session=False)
+            )
+        ).all()
+        await session.commit()
+    claimed_token_sizes = {row.id: row.token_size for row in claimed}
+
+    tasks = []
+    claimed_by_user: dict[tuple[str, BlobType], int] = {}
+    for user_id, blob_type, buffer_ids in batches:
+        actual_buffer_ids = [i for i in buffer_ids if i in claimed_token_sizes]
+        if not len(actual_buffer_ids):
+            continue
+        claimed_by_user[(user_id, blob_type)] = claimed_by_user.get(
+            (user_id, blob_type), 0
+        ) + sum(claimed_token_sizes[i] for i in actual_buffer_ids)
+        tasks.append(pack_flush_task(user_id, project_id, blob_type, actual_buffer_ids))
+    if not tasks:
+        return
+    for (user_id, blob_type), token_size in claimed_by_user.items():
+        await add_buffer_tokens(user_id, project_id, blob_type, -token_size)
+
+    # If this fails, the buffers stay `processing` and are reclaimed after the lease
     try:
         async with get_redis_client() as redis_client:
-            await redis_client.rpush(buffer_queue_key, buffer_ids_str)
+            queue_size = await redis_client.rpush(get_flush_queue_key(), *tasks)
+        LOG.info(
+            f"[background] Enqueued {len(tasks)} flush tasks of project {project_id} (queue size: {queue_size})"
+        )
+    except Exception as e:
+        LOG.error(
+            f"[background] Error enqueue flush tasks of project {project_id}: {e}: {traceback.format_exc()}"
+        )
 
-            queue_size = await redis_client.llen(buffer_queue_key)
 
-            TRACE_LOG.info(
-                project_id,
-                user_id,
-                f"[background] Enqueued {len(actual_buffer_ids)} buffer IDs to queue (queue size: {queue_size})",
-            )
+async def renew_user_lock(user_key: str, lock_value: str, lease_s: int):
+    # the buffer rows are renewed by `flush_buffer_by_ids` itself
+    while True:
+        await asyncio.sleep(lease_s / 3)
+        try:
+            async with get_redis_client() as redis_client:
+                await redis_client.eval(
+                    REDIS_LUA_CHECK_AND_EXPIRE_LOCK, 1, user_key, lock_value, lease_s
+                )
+        except Exception as e:
+            LOG.error(f"[flush worker] Failed to renew lock {user_key}: {e}")
 
-        await flush_buffer_background_running(user_id, project_id, blob_type)
-    except Exception as e:
-        TRACE_LOG.error(
-            project_id,
-            user_id,
-            f"[background] Error enqueue buffer ids: {e}: {traceback.format_exc()}",
-        )
 
+async def process_flush_task(task: dict, lease_s: int) -> bool:
+    """Flush the buffers of one queued task.
 
-async def flush_buffer_background_running(
-    user_id: str,
-    project_id: str,
-    blob_type: BlobType,
-    asleep_waiting_s: float = 0.1,  # Increased from 0.001 to reduce CPU usage
-    max_iterations: int = 200,  # Maximum 200 tasks for this run, return after it reaches.
-    process_interval_s: float = 60 * 5,  # Reduced from 10 minutes to 5 minutes
-    max_processing_time_s: float = 60 * 15,  # Maximum 15 minutes total processing time
-    max_consecutive_errors=5,  # Stop after 5 consecutive errors
-):
+    Returns False if the same user is being flushed by another worker, retry it later.
+    """
+    user_id = task["user_id"]
+    project_id = task["project_id"]
+    blob_type = BlobType(task["blob_type"])
+    buffer_ids = task["buffer_ids"]
+
+    # One flush per user at a time, profile/event merges must not interleave
     user_key = get_user_lock_key(
         user_id, project_id, f"flush_buffer_background_{blob_type}"
     )
-    buffer_queue_key = get_user_buffer_queue_key(
-        user_id, project_id, f"flush_buffer_background_{blob_type}"
-    )
-
-    __lock_value = str(uuid.uuid4())
-    start_time = asyncio.get_event_loop().time()
-
-    # Shorter lock timeout with renewal
+    lock_value = str(uuid.uuid4())
     async with get_redis_client() as redis_client:
-        acquired = await redis_client.set(
-            user_key, __lock_value, nx=True, ex=process_interval_s
+        acquired = await redis_client.set(user_key, lock_value, nx=True, ex=lease_s)
+    if not acquired:
+        TRACE_LOG.debug(project_id, user_id, "[background] Lock already acquired")
+        return False
+
+    renew_task = asyncio.create_task(renew_user_lock(user_key, lock_value, lease_s))
+    processing_start = time.time()
+    try:
+        p = await flush_buffer_by_ids(
+            user_id,
+            project_id,
+            blob_type,
+            buffer_ids,
+            select_status=BufferStatus.processing,
         )
-        if not acquired:
+        if not p.ok():
+            TRACE_LOG.error(
+                project_id,
+                user_id,
+                f"[background] Error flushing buffer by ids: {p.msg()}",
+            )
+        else:
             TRACE_LOG.debug(
                 project_id,
                 user_id,
-                f"[background] Lock already acquired",
+                f"[background] Processed batch in {time.time() - processing_start:.2f}s",
             )
-            return
-
-    try:
-        iteration_count = 0
-        consecutive_errors = 0
-
-        while iteration_count < max_iterations:
-            current_time = asyncio.get_event_loop().time()
-
-            # Check if we've exceeded maximum processing time
-            if current_time - start_time > max_processing_time_s:
-                TRACE_LOG.warning(
-                    project_id,
-                    user_id,
-                    f"[background] Maximum processing time ({max_processing_time_s}s) exceeded",
-                )
-                break
-
-            # Check lock and get next batch
+    except Exception as e:
+        TRACE_LOG.error(
+            project_id,
+            user_id,
+            f"[background] Unknown Error flushing buffer by ids: {e}\n{traceback.format_exc()}",
+        )
+    finally:
+        renew_task.cancel()
+        try:
             async with get_redis_client() as redis_client:
-                lock_value = await redis_client.get(user_key)
-                if lock_value is None or lock_value != __lock_value:  # Lock is expired
-                    TRACE_LOG.debug(
-                        project_id,
-                        user_id,
-                        "[background] Lock expired",
-                    )
-                    break
-
-                buffer_ids_str = await redis_client.lpop(buffer_queue_key)
-                if buffer_ids_str is None:  # Queue is empty
-                    TRACE_LOG.debug(
-                        project_id,
-                        user_id,
-                        "[background] Queue empty",
-                    )
-                    break
-
-                # Renew lock timeout if needed
-                await redis_client.expire(user_key, process_interval_s)
-                current_queue_size = await redis_client.llen(buffer_queue_key)
-
-            TRACE_LOG.info(
+                await redis_client.eval(
+                    REDIS_LUA_CHECK_AND_DELETE_LOCK, 1, user_key, lock_value
+                )
+        except Exception as e:
+            TRACE_LOG.error(
                 project_id,
                 user_id,
-                f"[background]({iteration_count}/{max_iterations}) Processing buffer (left queue size: {current_queue_size})",
+                f"[background] Failed to release lock: {e}",
             )
+    return True
 
-            buffer_ids = unpack_ids_from_str(buffer_ids_str or "")
-            if not buffer_ids:
+
+async def reclaim_dead_workers() -> int:
+    """Move the in-flight tasks of workers without heartbeat back to the queue."""
+    reclaimed = 0
+    async with get_redis_client() as redis_client:
+        worker_ids = await redis_client.smembers(get_flush_workers_key())
+        for worker_id in worker_ids:
+            if await redis_client.exists(get_flush_worker_key(worker_id)):
                 continue
+            processing_key = get_flush_processing_key(worker_id)
+            while await redis_client.lmove(
+                processing_key, get_flush_queue_key(), "LEFT", "RIGHT"
+            ):
+                reclaimed += 1
+            await redis_client.srem(get_flush_workers_key(), worker_id)
+            LOG.warning(f"[flush worker] Worker {worker_id} is dead, reclaim its tasks")
+    if reclaimed:
+        telemetry_manager.increment_counter_metric(
+            CounterMetricName.FLUSH_TASKS_RECLAIMED, reclaimed, {"source": "worker"}
+        )
+    return reclaimed
 
-            try:
-                # Process the buffer with timeout protection
-                processing_start = asyncio.get_event_loop().time()
-
-                p = await flush_buffer_by_ids(
-                    user_id,
-                    project_id,
-                    blob_type,
-                    buffer_ids,
-                    select_status=BufferStatus.processing,
-                )
 
-                processing_time = asyncio.get_event_loop().time() - processing_start
+async def get_pending_buffer_ids() -> set[str]:
+    """The buffer ids of the tasks waiting in the queue or taken by a worker."""
+    async with get_redis_client() as redis_client:
+        worker_ids = await redis_client.smembers(get_flush_workers_key())
+        # one snapshot, a task moving from the queue to a worker is seen once
+        async with redis_client.pipeline(transaction=True) as pipe:
+            pipe.lrange(get_flush_queue_key(), 0, -1)
+            for worker_id in worker_ids:
+                pipe.lrange(get_flush_processing_key(worker_id), 0, -1)
+            task_lists = await pipe.execute()
+    return {
+        buffer_id
+        for tasks in task_lists
+        for raw_task in tasks
+        for buffer_id in json.loads(raw_task)["buffer_ids"]
+    }
+
+
+async def reclaim_expired_buffers(lease_s: int) -> int:
+    """Re-queue the `processing` buffers whose lease is expired.
+
+    Covers the buffers that were marked but never enqueued, or whose task got lost.
+    The UPDATE renews the lease, so concurrent reclaimers won't enqueue the same rows.
+    The buffers of a task still waiting in the queue (longer than the lease under a
+    backlog) only get their lease renewed, they are not queued twice.
+    """
+    async with AsyncSession() as session:
+        rows = (
+            await session.execute(
+                update(BufferZone)
+                .where(
+                    BufferZone.status == BufferStatus.processing,
+                    BufferZone.updated_at < func.now() - timedelta(seconds=lease_s),
+                )
+                .values(updated_at=func.now())
+                .returning(
+                    BufferZone.id,
+                    BufferZone.user_id,
+                    BufferZone.project_id,
+                    BufferZone.blob_type,
+                )
+                .execution_options(synchronize_session=False)
+            )
+        ).all()
+        await session.commit()
+    if not rows:
+        return 0
+
+    pending_ids = await get_pending_buffer_ids()
+    groups: dict[tuple, list[str]] = {}
+    for row in rows:
+        if str(row.id) in pending_ids:
+            continue
+        groups.setdefault((row.user_id, row.project_id, row.blob_type), []).append(
+            row.id
+        )
+    for (user_id, project_id, blob_type), ids in groups.items():
+        TRACE_LOG.warning(
+            project_id,
+            user_id,
+            f"[background] Reclaim {len(ids)} {blob_type} buffers with expired lease",
+        )
+        await enqueue_flush_task(user_id, project_id, BlobType(blob_type), ids)
+    if groups:
+        telemetry_manager.increment_counter_metric(
+            CounterMetricName.FLUSH_TASKS_RECLAIMED, len(groups), {"source": "lease"}
+        )
+    return len(groups)
 
-                if not p.ok():
-                    consecutive_errors += 1
-                    TRACE_LOG.error(
-                        project_id,
-                        user_id,
-                        f"[background] Error flushing buffer by ids: {p.msg()}",
-                    )
 
-                    # Stop if too many consecutive errors
-                    if consecutive_errors >= max_consecutive_errors:
-                        TRACE_LOG.error(
-                            project_id,
-                            user_id,
-                            f"[background] Too many consecutive errors ({consecutive_errors}), stopping",
-                        )
-                        break
-                else:
-                    consecutive_errors = 0  # Reset error counter on success
-                    TRACE_LOG.debug(
-                        project_id,
-                        user_id,
-                        f"[background] Processed batch in {processing_time:.2f}s",
-                    )
+async def flush_idle_buffers(idle_s: int, max_users: int) -> int:
+    """Enqueue the buffers of the users whose oldest idle buffer is older than `idle_s`.
 
-            except Exception as e:
-                consecutive_errors += 1
-                TRACE_LOG.error(
-                    project_id,
-                    user_id,
-                    f"[background] Unknown Error flushing buffer by ids: {e}\n{traceback.format_exc()}",
+    Without it, the buffers of a user who stopped chatting are never flushed.
+    They are cut like the buffers of an insert, plus a batch of the rest, so a
+    backlog of buffers doesn't make one oversized flush.
+    """
+    stale_users = (
+        select(BufferZone.user_id, BufferZone.project_id, BufferZone.blob_type)
+        .where(
+            BufferZone.has_status(BufferStatus.idle),
+            BufferZone.created_at < func.now() - timedelta(seconds=idle_s),
+        )
+        .distinct()
+        .limit(max_users)
+        .subquery()
+    )
+    async with AsyncSession() as session:
+        rows = (
+            await session.execute(
+                select(
+                    BufferZone.id,
+                    BufferZone.user_id,
+                    BufferZone.project_id,
+                    BufferZone.blob_type,
+                    BufferZone.token_size,
+                )
+                .join(
+                    stale_users,
+                    (BufferZone.user_id == stale_users.c.user_id)
+                    & (BufferZone.project_id == stale_users.c.project_id)
+                    & (BufferZone.blob_type == stale_users.c.blob_type),
                 )
+                .where(BufferZone.has_status(BufferStatus.idle))
+                .order_by(BufferZone.created_at)
+            )
+        ).all()
+
+    idle_buffers: dict[str, dict[tuple, list]] = {}
+    for row in rows:
+        idle_buffers.setdefault(row.project_id, {}).setdefault(
+            (row.user_id, BlobType(row.blob_type)), []
+        ).append(row)
+    for project_id, users in idle_buffers.items():
+        batches = []
+        for (user_id, blob_type), user_rows in users.items():
+            full_batches, rest = cut_buffer_batches(user_rows)
+            batches.extend(
+                (user_id, blob_type, ids) for ids in full_batches + [rest] if ids
+            )
+        await flush_buffer_batches_in_background(project_id, batches)
+    return sum(len(users) for users in idle_buffers.values())
 
-                # Stop if too many consecutive errors
-                if consecutive_errors >= max_consecutive_errors:
-                    TRACE_LOG.error(
-                        project_id,
-                        user_id,
-                        f"[background] Too many consecutive errors ({consecutive_errors}), stopping",
-                    )
-                    break
 
-            # Sleep between iterations to prevent overwhelming the system
-            await asyncio.sleep(asleep_waiting_s)
-            iteration_count += 1
+async def run_idle_flush_scheduler(stop_event: asyncio.Event):
+    """Flush the idle buffers in batches, one process per check across all nodes."""
+    interval_s = CONFIG.buffer_idle_flush_check_interval_s
+    while not stop_event.is_set():
+        try:
+            async with get_redis_client() as redis_client:
+                acquired = await redis_client.set(
+                    get_idle_flush_lock_key(), 1, nx=True, ex=interval_s
+                )
+                queue_depth = await redis_client.llen(get_flush_queue_key())
+            if acquired and queue_depth < CONFIG.buffer_idle_flush_max_queue_depth:
+                flushed = await flush_idle_buffers(
+                    CONFIG.buffer_flush_interval, CONFIG.buffer_idle_flush_batch_size
+                )
+                if flushed:
+                    LOG.info(f"[idle flush] Enqueued idle buffers of {flushed} users")
+        except Exception as e:
+            LOG.error(f"[idle flush] Error: {e}\n{traceback.format_exc()}")
+        try:
+            await asyncio.wait_for(stop_event.wait(), timeout=interval_s)
+        except asyncio.TimeoutError:
+            pass
 
-        total_processing_time = asyncio.get_event_loop().time() - start_time
-        TRACE_LOG.info(
-            project_id,
-            user_id,
-            f"[background] Completed processing. "
-            f"Iterations: {iteration_count}, Time: {total_processing_time:.2f}s, "
-            f"Final consecutive errors: {consecutive_errors}",
-        )
 
-    finally:
+async def heartbeat_flush_worker(worker_id: str, lease_s: int):
+    while True:
         try:
             async with get_redis_client() as redis_client:
-                result = await redis_client.eval(
-                    REDIS_LUA_CHECK_AND_DELETE_LOCK, 1, user_key, __lock_value
-                )
-                if result == 1:
-                    TRACE_LOG.debug(
-                        project_id,
-                        user_id,
-                        f"[background] Successfully released lock",
-                    )
-                else:
-                    TRACE_LOG.warning(
-                        project_id,
-                        user_id,
-                        f"[background] Lock was already expired/released",
-                    )
+                await redis_client.sadd(get_flush_workers_key(), worker_id)
+                await redis_client.set(get_flush_worker_key(worker_id), 1, ex=lease_s)
+            await reclaim_dead_workers()
+            await reclaim_expired_buffers(lease_s)
         except Exception as e:
-            TRACE_LOG.error(
-                project_id,
-                user_id,
-                f"[background] Failed to release lock: {e}",
-            )
+            LOG.error(f"[flush worker] Worker {worker_id} heartbeat error: {e}")
+        await asyncio.sleep(lease_s / 3)
+
+
+async def run_flush_worker(
+    worker_id: str,
+    stop_event: asyncio.Event,
+    lease_s: int = None,
+    poll_timeout_s: float = 1,
+    retry_delay_s: float = 0.5,
+):
+    """Pull flush tasks from the shared queue until `stop_event` is set.
+
+    A task is atomically moved into this worker's processing list and only removed (ack)
+    after the flush, so the tasks of a crashed worker can be reclaimed by the others.
+    """
+    lease_s = lease_s or CONFIG.buffer_flush_lease_s
+    queue_key = get_flush_queue_key()
+    processing_key = get_flush_processing_key(worker_id)
+
+    heartbeat_task = asyncio.create_task(heartbeat_flush_worker(worker_id, lease_s))
+    LOG.info(f"[flush worker] Worker {worker_id} started")
+    try:
+        while not stop_event.is_set():
+            try:
+                async with get_redis_client() as redis_client:
+                    raw_task = await redis_client.blmove(
+                        queue_key, processing_key, poll_timeout_s, "LEFT", "RIGHT"
+                    )
+                    queue_depth = await redis_client.llen(queue_key)
+                telemetry_manager.set_gauge_metric(
+                    GaugeMetricName.FLUSH_QUEUE_DEPTH, queue_depth
+                )
+                if raw_task is None:
+                    continue
+
+                task = json.loads(raw_task)
+                telemetry_manager.record_histogram_metric(
+                    HistogramMetricName.FLUSH_QUEUE_LAG_MS,
+                    (time.time() - task["enqueued_at"]) * 1000,
+                    {"project_id": task["project_id"]},
+                )
+                done = await process_flush_task(task, lease_s)
+                async with get_redis_client() as redis_client:
+                    if not done:
+                        # The user is locked by another worker, put it back to the tail
+                        await redis_client.rpush(queue_key, raw_task)
+                    await redis_client.lrem(processing_key, 1, raw_task)
+                if not done:
+                    await asyncio.sleep(retry_delay_s)
+            except Exception as e:
+                LOG.error(
+                    f"[flush worker] Worker {worker_id} error: {e}\n{traceback.format_exc()}"
+                )
+                await asyncio.sleep(retry_delay_s)
+    finally:
+        heartbeat_task.cancel()
+        LOG.info(f"[flush worker] Worker {worker_id} stopped")
+
+
+def start_flush_workers(
+    num_workers: int, stop_event: asyncio.Event
+) -> list[asyncio.Task]:
+    node_id = str(uuid.uuid4())
+    workers = [
+        asyncio.create_task(run_flush_worker(f"{node_id}-{i}", stop_event))
+        for i in range(num_workers)
+    ]
+    if num_workers > 0 and CONFIG.buffer_idle_flush_batch_size > 0:
+        workers.append(asyncio.create_task(run_idle_flush_scheduler(stop_event)))
+    if num_workers > 0 and CONFIG.compaction_interval_s > 0:
+        workers.append(asyncio.create_task(run_compaction_scheduler(stop_event)))
+    return workers
+
+
+async def stop_flush_workers(
+    workers: list[asyncio.Task], stop_event: asyncio.Event, timeout_s: float = 10
+):
+    """Wait the running flushes for a while, the unfinished ones are reclaimed later."""
+    stop_event.set()
+    if not workers:
+        return
+    _, pending = await asyncio.wait(workers, timeout=timeout_s)
+    for task in pending:
+        task.cancel()
@@ -0,0 +1,242 @@
+"""Delete the buffer, blob and event rows nobody reads anymore.
+
+A flush only flips its buffers to `done`/`failed`, and persistent blobs
+(`persistent_chat_blobs`, other blob types) are never deleted, so both tables
+grow without bound and every buffer scan of a user walks past the dead rows.
+Every `compaction_interval_s`, one flush worker across all nodes deletes:
+
+- `done`/`failed` buffers older than `buffer_done_retention_s`/`buffer_failed_retention_s`;
+- blobs of the types in `blob_retention_s` older than their retention, once no
+  buffer still waits for them (only `done` buffers left, which cascade). Without
+  `persistent_chat_blobs`, the chat blobs left by failed flushes go after
+  `buffer_failed_retention_s`;
+- events and gists of the projects in `event_retention_days` older than their
+  retention. Tables created with `event_partitioning` also get their monthly
+  partitions created ahead and the expired ones dropped.
+
+Rows are deleted `compaction_batch_size` at a time, each batch in its own short
+transaction that skips the rows locked by a running flush.
+"""
+
+import asyncio
+import traceback
+from datetime import timedelta
+from sqlalchemy import delete, exists, func, select, text, tuple_
+from ..env import CONFIG, BufferStatus, LOG
+from ..models.database import BufferZone, GeneralBlob, UserEvent, UserEventGist
+from ..models.blob import BlobType
+from ..connectors import (
+    AsyncSession,
+    PROJECT_ID,
+    get_redis_client,
+    maintain_event_partitions,
+)
+from ..telemetry import telemetry_manager, CounterMetricName, GaugeMetricName
+from .memory_version import bump_user_memory_version, bump_memory_generation
+
+COMPACTED_TABLES = [
+    BufferZone.__tablename__,
+    GeneralBlob.__tablename__,
+    UserEvent.__tablename__,
+    UserEventGist.__tablename__,
+]
+
+
+def get_compaction_lock_key() -> str:
+    return f"memobase:compaction:{PROJECT_ID}"
+
+
+def delete_expired_buffers(status: str, retention_s: int, batch_size: int):
+    expired = (
+        select(BufferZone.id, BufferZone.project_id)
+        .where(
+            BufferZone.status == status,
+            BufferZone.created_at < func.now() - timedelta(seconds=retention_s),
+        )
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)
+    )
+    return delete(BufferZone).where(
+        tuple_(BufferZone.id, BufferZone.project_id).in_(expired)
+    )
+
+
+def delete_expired_blobs(blob_type: str, retention_s: int, batch_size: int):
+    waiting_buffers = exists().where(
+        BufferZone.blob_id == GeneralBlob.id,
+        BufferZone.project_id == GeneralBlob.project_id,
+        BufferZone.status != BufferStatus.done,
+    )
+    expired = (
+        select(GeneralBlob.id, GeneralBlob.project_id)
+        .where(
+            GeneralBlob.blob_type == blob_type,
+            GeneralBlob.created_at < func.now() - timedelta(seconds=retention_s),
+            ~waiting_buffers,
+        )
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)
+    )
+    return delete(GeneralBlob).where(
+        tuple_(GeneralBlob.id, GeneralBlob.project_id).in_(expired)
+    )
+
+
+def delete_expired_events(
+    model: type[UserEvent] | type[UserEventGist],
+    project_id: str,
+    retention_days: int,
+    batch_size: int,
+):
+    expired = (
+        select(model.id, model.project_id)
+        .where(
+            model.project_id == project_id,
+            model.created_at < func.now() - timedelta(days=retention_days),
+        )
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)
+    )
+    return (
+        delete(model)
+        .where(tuple_(model.id, model.project_id).in_(expired))
+        .returning(model.user_id)
+    )
+
+
+async def delete_in_batches(
+    make_statement,
+    batch_size: int,
+    max_batches: int,
+    attributes: dict,
+    returning: bool = False,
+) -> int | set:
+    """Run the delete of `make_statement(batch_size)` until it deletes less rows.
+
+    Returns the number of deleted rows, or the set of returned values if `returning`.
+    """
+    total, returned = 0, set()
+    for _ in range(max_batches):
+        async with AsyncSession() as session:
+            result = await session.execute(make_statement(batch_size))
+            if returning:
+                rows = result.scalars().all()
+                returned.update(rows)
+                deleted = len(rows)
+            else:
+                deleted = result.rowcount
+            await session.commit()
+        total += deleted
+        if deleted < batch_size:
+            break
+    if total:
+        telemetry_manager.increment_counter_metric(
+            CounterMetricName.COMPACTION_ROWS_DELETED, total, attributes
+        )
+    return returned if returning else total
+
+
+async def record_table_sizes():
+    # a partitioned table has no storage of its own, sum its partitions
+    async with AsyncSession() as session:
+        rows = (
+            await session.execute(
+                text(
+                    "SELECT c.relname, "
+                    "sum(pg_total_relation_size(t.relid))::bigint AS size_bytes, "
+                    "sum(greatest(p.reltuples, 0))::bigint AS rows "
+                    "FROM pg_class c, pg_partition_tree(c.oid) t "
+                    "JOIN pg_class p ON p.oid = t.relid "
+                    "WHERE c.relname = ANY(:tables) AND c.relkind IN ('r', 'p') "
+                    "AND t.isleaf GROUP BY c.relname"
+                ),
+                {"tables": COMPACTED_TABLES},
+            )
+        ).all()
+    for row in rows:
+        telemetry_manager.set_gauge_metric(
+            GaugeMetricName.TABLE_SIZE_BYTES, row.size_bytes, {"table": row.relname}
+        )
+        telemetry_manager.set_gauge_metric(
+            GaugeMetricName.TABLE_ROWS_ESTIMATE, row.rows, {"table": row.relname}
+        )
+
+
+async def compact_tables(
+    batch_size: int = None, max_batches: int = None
+) -> dict[str, int]:
+    """Delete the expired rows, return the count of each kind (users for events)."""
+    batch_size = batch_size or CONFIG.compaction_batch_size
+    max_batches = max_batches or CONFIG.compaction_max_batches
+    deleted = {}
+    for status, retention_s in [
+        (BufferStatus.done, CONFIG.buffer_done_retention_s),
+        (BufferStatus.failed, CONFIG.buffer_failed_retention_s),
+    ]:
+        if retention_s <= 0:
+            continue
+        deleted[f"buffer_zones:{status}"] = await delete_in_batches(
+            lambda n: delete_expired_buffers(status, retention_s, n),
+            batch_size,
+            max_batches,
+            {"table": BufferZone.__tablename__, "kind": status},
+        )
+    blob_retention_s = dict(CONFIG.blob_retention_s)
+    if not CONFIG.persistent_chat_blobs:
+        # the chat blobs of failed flushes, the others are deleted by the flush
+        blob_retention_s.setdefault(
+            BlobType.chat.value, CONFIG.buffer_failed_retention_s
+        )
+    for blob_type, retention_s in blob_retention_s.items():
+        if retention_s <= 0:
+            continue
+        deleted[f"general_blobs:{blob_type}"] = await delete_in_batches(
+            lambda n: delete_expired_blobs(blob_type, retention_s, n),
+            batch_size,
+            max_batches,
+            {"table": GeneralBlob.__tablename__, "kind": blob_type},
+        )
+    for project_id, retention_days in CONFIG.event_retention_days.items():
+        if retention_days <= 0:
+            continue
+        users = set()
+        # the gists first, without the foreign key of unpartitioned tables
+        for model in (UserEventGist, UserEvent):
+            users |= await delete_in_batches(
+                lambda n: delete_expired_events(model, project_id, retention_days, n),
+                batch_size,
+                max_batches,
+                {"table": model.__tablename__, "kind": "retention"},
+                returning=True,
+            )
+        deleted[f"expired_event_users:{project_id}"] = len(users)
+        for user_id in users:
+            await bump_user_memory_version(user_id, project_id)
+    dropped = await asyncio.to_thread(maintain_event_partitions)
+    if dropped:
+        # the events of every user in them are gone
+        deleted["dropped_partitions"] = len(dropped)
+        await bump_memory_generation()
+    await record_table_sizes()
+    return deleted
+
+
+async def run_compaction_scheduler(stop_event: asyncio.Event):
+    """Compact the tables every `compaction_interval_s`, one process across all nodes."""
+    interval_s = CONFIG.compaction_interval_s
+    while not stop_event.is_set():
+        try:
+            async with get_redis_client() as redis_client:
+                acquired = await redis_client.set(
+                    get_compaction_lock_key(), 1, nx=True, ex=interval_s
+                )
+            if acquired:
+                deleted = await compact_tables()
+                if any(deleted.values()):
+                    LOG.info(f"[compaction] Deleted rows: {deleted}")
+        except Exception as e:
+            LOG.error(f"[compaction] Error: {e}\n{traceback.format_exc()}")
+        try:
+            await asyncio.wait_for(stop_event.wait(), timeout=interval_s)
+        except asyncio.TimeoutError:
+            pass
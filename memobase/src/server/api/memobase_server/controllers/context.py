@@ -1,12 +1,25 @@
+import json
 from functools import partial
+from typing import TypedDict
 from ..models.utils import Promise, CODE
 from ..models.response import ContextData, OpenAICompatibleMessage, UserEventGistsData
 from ..prompts.chat_context_pack import CONTEXT_PROMPT_PACK
-from ..utils import get_encoded_tokens, event_str_repr
+from ..utils import event_str_repr, profile_str_repr, pack_latest_chat
 from ..env import CONFIG, TRACE_LOG
+from ..connectors import PROJECT_ID, get_redis_client
+from ..telemetry import telemetry_manager, CounterMetricName
 from .project import get_project_profile_config
+from .memory_version import (
+    get_user_memory_version_key,
+    get_memory_generation_key,
+    with_memory_generation,
+    init_user_memory_version,
+    get_request_hash,
+    get_memory_etag,
+    etag_matches,
+)
 from .profile import get_user_profiles, truncate_profiles
-from .post_process.profile import filter_profiles_with_chats
+from .post_process.profile import filter_profiles_with_chats, ProfileFilterMode
 
 # from .event import get_user_events, search_user_events, truncate_events
 from .event_gist import (
@@ -24,10 +37,6 @@ def customize_context_prompt_func(
     )
 
 
-def pack_latest_chat(chats: list[OpenAICompatibleMessage], chat_num: int = 3) -> str:
-    return "\n".join([f"{m.content}" for m in chats[-chat_num:]])
-
-
 async def get_user_profiles_data(
     user_id: str,
     project_id: str,
@@ -38,6 +47,7 @@ async def get_user_profiles_data(
     topic_limits: dict[str, int],
     chats: list[OpenAICompatibleMessage],
     full_profile_and_only_search_event: bool,
+    profile_filter_mode: ProfileFilterMode | None = None,
 ) -> Promise[tuple[str, list]]:
     """Retrieve and process user profiles."""
     p = await get_user_profiles(user_id, project_id)
@@ -53,6 +63,7 @@ async def get_user_profiles_data(
                 total_profiles,
                 chats,
                 only_topics=only_topics,
+                mode=profile_filter_mode,
             )
             if p.ok():
                 total_profiles.profiles = p.data()["profiles"]
@@ -71,10 +82,7 @@ async def get_user_profiles_data(
         use_profiles = use_profiles.data().profiles
 
         profile_section = "- " + "\n- ".join(
-            [
-                f"{p.attributes.get('topic')}::{p.attributes.get('sub_topic')}: {p.content}"
-                for p in use_profiles
-            ]
+            [profile_str_repr(p.content, p.attributes) for p in use_profiles]
         )
     else:
         profile_section = ""
@@ -128,6 +136,7 @@ async def get_user_context(
     customize_context_prompt: str = None,
     full_profile_and_only_search_event: bool = False,
     fill_window_with_events: bool = False,
+    profile_filter_mode: ProfileFilterMode | None = None,
 ) -> Promise[ContextData]:
     import asyncio
 
@@ -157,6 +166,7 @@ async def get_user_context(
             topic_limits,
             chats,
             full_profile_and_only_search_event,
+            profile_filter_mode,
         ),
         get_user_event_gists_data(
             user_id,
@@ -187,8 +197,9 @@ async def get_user_context(
         return event_gist_result
     user_event_gists = event_gist_result.data()
 
-    # Calculate token sizes and truncate events if needed
-    profile_section_tokens = len(get_encoded_tokens(profile_section))
+    # Calculate token sizes and truncate events if needed.
+    # Sum the stored sizes instead of encoding the section, plus ~1 token per bullet
+    profile_section_tokens = sum(p.token_size + 1 for p in use_profiles)
     if fill_window_with_events:
         max_event_token_size = max_token_size - profile_section_tokens
     else:
@@ -209,7 +220,7 @@ async def get_user_context(
     user_event_gists = p.data()
 
     event_section = "\n".join([ed.gist_data.content for ed in user_event_gists.gists])
-    event_section_tokens = len(get_encoded_tokens(event_section))
+    event_section_tokens = sum(ed.token_size + 1 for ed in user_event_gists.gists)
 
     TRACE_LOG.info(
         project_id,
@@ -220,3 +231,89 @@ async def get_user_context(
     return Promise.resolve(
         ContextData(context=context_prompt_func(profile_section, event_section))
     )
+
+
+class CachedContextResult(TypedDict):
+    etag: str | None
+    # None when the caller's copy (`if_none_match`) is still current
+    context: ContextData | None
+
+
+def get_user_context_cache_key(user_id: str, project_id: str, request_hash: str) -> str:
+    return f"memobase:user_context:{PROJECT_ID}:{project_id}:{user_id}:{request_hash}"
+
+
+async def get_cached_user_context(
+    user_id: str,
+    project_id: str,
+    context_params: dict,
+    chats: list[OpenAICompatibleMessage],
+    if_none_match: str | None = None,
+) -> Promise[CachedContextResult]:
+    """`get_user_context`, cached by the memory version of the user if there are no chats.
+
+    The version and the cached context are read in one MGET, a current
+    `if_none_match` or cached context costs nothing else.
+    """
+    if chats or CONFIG.context_cache_ttl_s <= 0:
+        p = await get_user_context(user_id, project_id, chats=chats, **context_params)
+        if not p.ok():
+            return p
+        return Promise.resolve({"etag": None, "context": p.data()})
+
+    p = await get_project_profile_config(project_id)
+    if not p.ok():
+        return p
+    language = p.data().language or CONFIG.language
+    request_hash = get_request_hash({"language": language, **context_params})
+    cache_key = get_user_context_cache_key(user_id, project_id, request_hash)
+    try:
+        async with get_redis_client() as redis_client:
+            version, generation, cached = await redis_client.mget(
+                [
+                    get_user_memory_version_key(user_id, project_id),
+                    get_memory_generation_key(),
+                    cache_key,
+                ]
+            )
+            if version is None:
+                version = await init_user_memory_version(
+                    redis_client, user_id, project_id
+                )
+            version = with_memory_generation(version, generation)
+    except Exception as e:
+        TRACE_LOG.error(project_id, user_id, f"Failed to read context cache: {e}")
+        p = await get_user_context(user_id, project_id, chats=chats, **context_params)
+        if not p.ok():
+            return p
+        return Promise.resolve({"etag": None, "context": p.data()})
+
+    etag = get_memory_etag(version, request_hash)
+    cached = json.loads(cached) if cached is not None else None
+    if etag_matches(if_none_match, etag):
+        result = "not_modified"
+        context = None
+    elif cached is not None and cached["version"] == version:
+        result = "hit"
+        context = ContextData.model_validate(cached["context"])
+    else:
+        result = "miss"
+        # rendered from the DB read after the version, a write in between changes
+        # the version and this copy is never served
+        p = await get_user_context(user_id, project_id, chats=chats, **context_params)
+        if not p.ok():
+            return p
+        context = p.data()
+        try:
+            async with get_redis_client() as redis_client:
+                await redis_client.set(
+                    cache_key,
+                    json.dumps({"version": version, "context": context.model_dump()}),
+                    ex=CONFIG.context_cache_ttl_s,
+                )
+        except Exception as e:
+            TRACE_LOG.error(project_id, user_id, f"Failed to write context cache: {e}")
+    telemetry_manager.increment_counter_metric(
+        CounterMetricName.CONTEXT_CACHE_LOOKUPS, 1, {"result": result}
+    )
+    return Promise.resolve({"etag": etag, "context": context})
@@ -2,16 +2,73 @@ from pydantic import ValidationError
 from ..models.database import UserEvent, UserEventGist
 from ..models.response import UserEventData, UserEventsData, EventData
 from ..models.utils import Promise, CODE
-from ..connectors import Session
-from ..utils import get_encoded_tokens, event_str_repr, event_embedding_str
+from ..connectors import (
+    AsyncSession,
+    set_vector_search_options,
+    vector_search_order,
+)
+from ..utils import aget_token_lengths, event_str_repr, event_embedding_str
 
 from ..llms.embeddings import get_embedding
+from .memory_version import bump_user_memory_version
 from datetime import timedelta
-from sqlalchemy import desc, select
+from sqlalchemy import select, bindparam
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.sql import func
 from ..env import TRACE_LOG, CONFIG
 
 
+def select_user_event(user_id: str, project_id: str, event_id: str):
+    return select(UserEvent).where(
+        UserEvent.user_id == user_id,
+        UserEvent.project_id == project_id,
+        UserEvent.id == event_id,
+    )
+
+
+def select_user_events_timeline(
+    user_id: str, project_id: str, topk: int, time_range_in_days: int
+):
+    """The latest events of the user, read in order from the timeline index.
+
+    Only the returned columns are selected, the embeddings are never read.
+    """
+    return (
+        select(
+            UserEvent.id,
+            UserEvent.event_data,
+            UserEvent.created_at,
+            UserEvent.updated_at,
+        )
+        .where(
+            UserEvent.project_id == project_id,
+            UserEvent.user_id == user_id,
+            UserEvent.created_at > (func.now() - timedelta(days=time_range_in_days)),
+        )
+        .order_by(UserEvent.created_at.desc())
+        .limit(topk)
+    )
+
+
+def event_tags_filter(
+    has_event_tag: list[str] = None, event_tag_equal: dict[str, str] = None
+):
+    """The events carrying every tag of `has_event_tag` and every tag-value pair
+    of `event_tag_equal`, or None without filters.
+
+    All the filters go in one bound `@>` array, which the GIN index of the
+    event tags serves: each element must be contained by one of the event's tags.
+    """
+    tags = [{"tag": tag_name} for tag_name in has_event_tag or []]
+    tags.extend(
+        {"tag": tag_name, "value": tag_value}
+        for tag_name, tag_value in (event_tag_equal or {}).items()
+    )
+    if not tags:
+        return None
+    return UserEvent.event_tags().op("@>")(bindparam("event_tags", tags, type_=JSONB))
+
+
 async def get_user_events(
     user_id: str,
     project_id: str,
@@ -19,32 +76,16 @@ async def get_user_events(
     need_summary: bool = False,
     time_range_in_days: int = 21,
 ) -> Promise[UserEventsData]:
-    with Session() as session:
-        query = (
-            session.query(UserEvent)
-            .filter_by(user_id=user_id, project_id=project_id)
-            .filter(
-                UserEvent.created_at > (func.now() - timedelta(days=time_range_in_days))
+    # Abort `need_summary` because the summary is moved to gist
+    async with AsyncSession() as session:
+        rows = (
+            await session.execute(
+                select_user_events_timeline(
+                    user_id, project_id, topk, time_range_in_days
+                )
             )
-        )
-        # Abort this parameter because the summary is moved to gist
-        # if need_summary:
-        #     query = query.filter(
-        #         UserEvent.event_data.contains({"event_tip": None}).is_(False)
-        #     ).filter(UserEvent.event_data.has_key("event_tip"))
-        user_events = query.order_by(UserEvent.created_at.desc()).limit(topk).all()
-        if user_events is None:
-            return Promise.resolve(UserEventsData(events=[]))
-        results = [
-            {
-                "id": ue.id,
-                "event_data": ue.event_data,
-                "created_at": ue.created_at,
-                "updated_at": ue.updated_at,
-            }
-            for ue in user_events
-        ]
-    events = UserEventsData(events=results)
+        ).all()
+    events = UserEventsData(events=[row._asdict() for row in rows])
     return Promise.resolve(events)
 
 
@@ -56,8 +97,9 @@ async def truncate_events(
         return Promise.resolve(events)
     c_tokens = 0
     truncated_results = []
-    for r in events.events:
-        c_tokens += len(get_encoded_tokens(event_str_repr(r)))
+    token_lengths = await aget_token_lengths([event_str_repr(r) for r in events.events])
+    for r, token_length in zip(events.events, token_lengths):
+        c_tokens += token_length
         if c_tokens > max_token_size:
             break
         truncated_results.append(r)
@@ -81,67 +123,57 @@ async def append_user_event(
             f"Invalid event data: {str(e)}",
         )
 
+    event_gists = []
+    if validated_event.event_tip is not None:
+        event_gists = validated_event.event_tip.split("\n")
+        event_gists = [l.strip() for l in event_gists if l.strip().startswith("-")]
+        TRACE_LOG.info(
+            project_id, user_id, f"Processing {len(event_gists)} event gists"
+        )
+
+    # the event and its gists are embedded in one request
+    embedding = [None]
+    event_gists_embedding = [None] * len(event_gists)
     if CONFIG.enable_event_embedding:
         event_data_str = event_embedding_str(validated_event)
-        embedding = await get_embedding(
+        embeddings = await get_embedding(
             project_id,
-            [event_data_str],
+            [event_data_str] + event_gists,
             phase="document",
             model=CONFIG.embedding_model,
         )
-        if not embedding.ok():
+        if not embeddings.ok():
             TRACE_LOG.error(
                 project_id,
                 user_id,
-                f"Failed to get embeddings: {embedding.msg()}",
+                f"Failed to get embeddings: {embeddings.msg()}",
             )
-            embedding = [None]
         else:
-            embedding = embedding.data()
-            embedding_dim_current = embedding.shape[-1]
+            embeddings = embeddings.data()
+            embedding_dim_current = embeddings.shape[-1]
             if embedding_dim_current != CONFIG.embedding_dim:
                 TRACE_LOG.error(
                     project_id,
                     user_id,
                     f"Embedding dimension mismatch! Expected {CONFIG.embedding_dim}, got {embedding_dim_current}.",
                 )
-                embedding = [None]
-    else:
-        embedding = [None]
+            else:
+                embedding = embeddings[:1]
+                event_gists_embedding = embeddings[1:]
 
     event_gist_dbs = []
-    if validated_event.event_tip is not None:
-        event_gists = validated_event.event_tip.split("\n")
-        event_gists = [l.strip() for l in event_gists if l.strip().startswith("-")]
-        TRACE_LOG.info(
-            project_id, user_id, f"Processing {len(event_gists)} event gists"
+    event_gists_token_size = await aget_token_lengths(event_gists)
+    for event_gist, event_gist_embedding, event_gist_token_size in zip(
+        event_gists, event_gists_embedding, event_gists_token_size
+    ):
+        event_gist_dbs.append(
+            {
+                "gist_data": {"content": event_gist},
+                "embedding": event_gist_embedding,
+                "token_size": event_gist_token_size,
+            }
         )
-        if CONFIG.enable_event_embedding and len(event_gists) > 0:
-            event_gists_embedding = await get_embedding(
-                project_id,
-                event_gists,
-                phase="document",
-                model=CONFIG.embedding_model,
-            )
-            if not event_gists_embedding.ok():
-                TRACE_LOG.error(
-                    project_id,
-                    user_id,
-                    f"Failed to get embeddings: {event_gists_embedding.msg()}",
-                )
-                event_gists_embedding = [None] * len(event_gists)
-            else:
-                event_gists_embedding = event_gists_embedding.data()
-        else:
-            event_gists_embedding = [None] * len(event_gists)
-        for event_gist, event_gist_embedding in zip(event_gists, event_gists_embedding):
-            event_gist_dbs.append(
-                {
-                    "gist_data": {"content": event_gist},
-                    "embedding": event_gist_embedding,
-                }
-            )
-    with Session() as session:
+    async with AsyncSession() as session:
         user_event = UserEvent(
             user_id=user_id,
             project_id=project_id,
@@ -157,29 +189,30 @@ async def append_user_event(
                     event_id=user_event.id,
                     gist_data=event_gist_data["gist_data"],
                     embedding=event_gist_data["embedding"],
+                    token_size=event_gist_data["token_size"],
                 )
             )
-        session.commit()
+        await session.commit()
         eid = user_event.id
+    await bump_user_memory_version(user_id, project_id)
     return Promise.resolve(eid)
 
 
 async def delete_user_event(
     user_id: str, project_id: str, event_id: str
 ) -> Promise[None]:
-    with Session() as session:
+    async with AsyncSession() as session:
         user_event = (
-            session.query(UserEvent)
-            .filter_by(user_id=user_id, project_id=project_id, id=event_id)
-            .first()
-        )
+            await session.execute(select_user_event(user_id, project_id, event_id))
+        ).scalar_one_or_none()
         if user_event is None:
             return Promise.reject(
                 CODE.NOT_FOUND,
                 f"User event {event_id} not found",
             )
-        session.delete(user_event)
-        session.commit()
+        await session.delete(user_event)
+        await session.commit()
+    await bump_user_memory_version(user_id, project_id)
     return Promise.resolve(None)
 
 
@@ -194,12 +227,10 @@ async def update_user_event(
             f"Invalid event data: {str(e)}",
         )
     need_to_update = {k: v for k, v in event_data.items() if v is not None}
-    with Session() as session:
+    async with AsyncSession() as session:
         user_event = (
-            session.query(UserEvent)
-            .filter_by(user_id=user_id, project_id=project_id, id=event_id)
-            .first()
-        )
+            await session.execute(select_user_event(user_id, project_id, event_id))
+        ).scalar_one_or_none()
         if user_event is None:
             return Promise.reject(
                 CODE.NOT_FOUND,
@@ -209,7 +240,8 @@ async def update_user_event(
         new_events.update(need_to_update)
 
         user_event.event_data = new_events
-        session.commit()
+        await session.commit()
+    await bump_user_memory_version(user_id, project_id)
     return Promise.resolve(None)
 
 
@@ -220,6 +252,9 @@ async def search_user_events(
     topk: int = 10,
     similarity_threshold: float = 0.2,
     time_range_in_days: int = 21,
+    ef_search: int = None,
+    has_event_tag: list[str] = None,
+    event_tag_equal: dict[str, str] = None,
 ) -> Promise[UserEventsData]:
     if not CONFIG.enable_event_embedding:
         TRACE_LOG.warning(
@@ -244,36 +279,44 @@ async def search_user_events(
         return query_embeddings
     query_embedding = query_embeddings.data()[0]
 
+    # ORDER BY the distance itself so the HNSW index can serve the scan,
+    # the threshold is applied to the `topk` nearest rows afterwards
+    distance_expr = UserEvent.embedding.cosine_distance(query_embedding)
     stmt = (
         select(
-            UserEvent,
-            (1 - UserEvent.embedding.cosine_distance(query_embedding)).label(
-                "similarity"
-            ),
+            UserEvent.id,
+            UserEvent.event_data,
+            UserEvent.created_at,
+            UserEvent.updated_at,
+            distance_expr.label("distance"),
         )
         .where(UserEvent.user_id == user_id, UserEvent.project_id == project_id)
         .where(UserEvent.created_at > func.now() - timedelta(days=time_range_in_days))
-        .where(
-            (1 - UserEvent.embedding.cosine_distance(query_embedding))
-            > similarity_threshold
-        )
-        .order_by(desc("similarity"))
+        .where(UserEvent.embedding.is_not(None))
+        .order_by(vector_search_order(distance_expr))
         .limit(topk)
     )
-
-    with Session() as session:
-        # Use .all() instead of .scalars().all() to get both columns
-        result = session.execute(stmt).all()
+    tags_filter = event_tags_filter(has_event_tag, event_tag_equal)
+    if tags_filter is not None:
+        # filtered during the index scan, iterative scans keep `topk` rows
+        stmt = stmt.where(tags_filter)
+
+    async with AsyncSession() as session:
+        await set_vector_search_options(session, topk, ef_search)
+        # rows of the selected columns, the embeddings stay in the DB
+        result = (await session.execute(stmt)).all()
         user_events: list[UserEventData] = []
-        for row in result:
-            user_event: UserEvent = row[0]  # UserEvent object
-            similarity: float = row[1]  # similarity value
+        # an iterative index scan may return the rows slightly out of order
+        for row in sorted(result, key=lambda r: r.distance):
+            similarity: float = 1 - row.distance
+            if similarity <= similarity_threshold:
+                break
             user_events.append(
                 UserEventData(
-                    id=user_event.id,
-                    event_data=user_event.event_data,
-                    created_at=user_event.created_at,
-                    updated_at=user_event.updated_at,
+                    id=row.id,
+                    event_data=row.event_data,
+                    created_at=row.created_at,
+                    updated_at=row.updated_at,
                     similarity=similarity,
                 )
             )
@@ -295,6 +338,7 @@ async def filter_user_events(
     has_event_tag: list[str] = None,
     event_tag_equal: dict[str, str] = None,
     topk: int = 10,
+    time_range_in_days: int = None,
 ) -> Promise[UserEventsData]:
     """
     Filter user events based on event tags.
@@ -305,55 +349,31 @@ async def filter_user_events(
         has_event_tag: List of tag names that must exist in the event (regardless of value)
         event_tag_equal: Dict of tag_name: tag_value pairs that must match exactly
         topk: Maximum number of events to return
+        time_range_in_days: Only events within the past few days, all events if None
 
     Returns:
         Promise containing filtered UserEventsData
     """
-    with Session() as session:
-        query = session.query(UserEvent).filter_by(
-            user_id=user_id, project_id=project_id
+    query = select(
+        UserEvent.id,
+        UserEvent.event_data,
+        UserEvent.created_at,
+        UserEvent.updated_at,
+    ).where(UserEvent.user_id == user_id, UserEvent.project_id == project_id)
+    if time_range_in_days is not None:
+        query = query.where(
+            UserEvent.created_at > (func.now() - timedelta(days=time_range_in_days))
         )
+    tags_filter = event_tags_filter(has_event_tag, event_tag_equal)
+    if tags_filter is not None:
+        query = query.where(tags_filter)
+
+    async with AsyncSession() as session:
+        rows = (
+            await session.execute(
+                query.order_by(UserEvent.created_at.desc()).limit(topk)
+            )
+        ).all()
 
-        # Apply tag filters if provided
-        if has_event_tag or event_tag_equal:
-            # Build filter conditions for events that have event_tags
-            query = query.filter(UserEvent.event_data.has_key("event_tags"))
-            query = query.filter(UserEvent.event_data["event_tags"].isnot(None))
-
-            # Filter by tag existence (has_event_tag)
-            if has_event_tag:
-                for tag_name in has_event_tag:
-                    # Check if any event_tag in the array has the specified tag name
-                    query = query.filter(
-                        UserEvent.event_data["event_tags"].op("@>")(
-                            f'[{{"tag": "{tag_name}"}}]'
-                        )
-                    )
-
-            # Filter by exact tag-value pairs (event_tag_equal)
-            if event_tag_equal:
-                for tag_name, tag_value in event_tag_equal.items():
-                    # Check if any event_tag in the array has both the tag name and value
-                    query = query.filter(
-                        UserEvent.event_data["event_tags"].op("@>")(
-                            f'[{{"tag": "{tag_name}", "value": "{tag_value}"}}]'
-                        )
-                    )
-
-        user_events = query.order_by(UserEvent.created_at.desc()).limit(topk).all()
-
-        if user_events is None:
-            return Promise.resolve(UserEventsData(events=[]))
-
-        results = [
-            {
-                "id": ue.id,
-                "event_data": ue.event_data,
-                "created_at": ue.created_at,
-                "updated_at": ue.updated_at,
-            }
-            for ue in user_events
-        ]
-
-    events = UserEventsData(events=results)
+    events = UserEventsData(events=[row._asdict() for row in rows])
     return Promise.resolve(events)
@@ -2,49 +2,74 @@ from pydantic import ValidationError
 from ..models.database import UserEventGist
 from ..models.response import UserEventGistsData, UserEventGistData
 from ..models.utils import Promise, CODE
-from ..connectors import Session
-from ..utils import get_encoded_tokens, event_str_repr, event_embedding_str
+from ..connectors import (
+    AsyncSession,
+    set_vector_search_options,
+    vector_search_order,
+)
+from ..utils import aget_token_lengths, event_str_repr, event_embedding_str
 
 from ..llms.embeddings import get_embedding
 from datetime import timedelta
-from sqlalchemy import desc, select
+from sqlalchemy import select
 from sqlalchemy.sql import func
 from ..env import TRACE_LOG, CONFIG
 
 
+def select_user_event_gists_timeline(
+    user_id: str, project_id: str, topk: int, time_range_in_days: int
+):
+    """The latest event gists of the user, read in order from the timeline index.
+
+    Only the returned columns are selected, the embeddings are never read.
+    """
+    return (
+        select(
+            UserEventGist.id,
+            UserEventGist.gist_data,
+            UserEventGist.created_at,
+            UserEventGist.updated_at,
+            UserEventGist.token_size,
+        )
+        .where(
+            UserEventGist.project_id == project_id,
+            UserEventGist.user_id == user_id,
+            UserEventGist.created_at
+            > (func.now() - timedelta(days=time_range_in_days)),
+        )
+        .order_by(UserEventGist.created_at.desc())
+        .limit(topk)
+    )
+
+
 async def get_user_event_gists(
     user_id: str,
     project_id: str,
     topk: int = 10,
     time_range_in_days: int = 21,
 ) -> Promise[UserEventGistsData]:
-    with Session() as session:
-        query = (
-            session.query(UserEventGist)
-            .filter_by(user_id=user_id, project_id=project_id)
-            .filter(
-                UserEventGist.created_at
-                > (func.now() - timedelta(days=time_range_in_days))
+    async with AsyncSession() as session:
+        rows = (
+            await session.execute(
+                select_user_event_gists_timeline(
+                    user_id, project_id, topk, time_range_in_days
+                )
             )
-        )
-        user_event_gists = (
-            query.order_by(UserEventGist.created_at.desc()).limit(topk).all()
-        )
-        if user_event_gists is None:
-            return Promise.resolve(UserEventGistsData(gists=[]))
-        results = [
-            {
-                "id": ue.id,
-                "gist_data": ue.gist_data,
-                "created_at": ue.created_at,
-                "updated_at": ue.updated_at,
-            }
-            for ue in user_event_gists
-        ]
-    gists = UserEventGistsData(gists=results)
+        ).all()
+    gists = UserEventGistsData(gists=[row._asdict() for row in rows])
     return Promise.resolve(gists)
 
 
+async def fill_event_gists_token_size(gists: list[UserEventGistData]):
+    """Count the tokens of the gists written before `token_size` was stored."""
+    missing = [g for g in gists if g.token_size is None]
+    if not missing:
+        return
+    token_sizes = await aget_token_lengths([g.gist_data.content for g in missing])
+    for g, token_size in zip(missing, token_sizes):
+        g.token_size = token_size
+
+
 async def truncate_event_gists(
     events: UserEventGistsData,
     max_token_size: int | None,
@@ -53,8 +78,9 @@ async def truncate_event_gists(
         return Promise.resolve(events)
     c_tokens = 0
     truncated_results = []
+    await fill_event_gists_token_size(events.gists)
     for r in events.gists:
-        c_tokens += len(get_encoded_tokens(r.gist_data.content))
+        c_tokens += r.token_size
         if c_tokens > max_token_size:
             break
         truncated_results.append(r)
@@ -62,6 +88,64 @@ async def truncate_event_gists(
     return Promise.resolve(events)
 
 
+async def search_event_gists_by_embedding(
+    session,
+    user_id: str,
+    project_id: str,
+    query_embedding,
+    topk: int = 10,
+    similarity_threshold: float = 0.2,
+    time_range_in_days: int = 21,
+    ef_search: int = None,
+) -> list[UserEventGistData]:
+    # Calculate the time cutoff once
+    time_cutoff = func.now() - timedelta(days=time_range_in_days)
+
+    # ORDER BY the distance itself so the HNSW index can serve the scan,
+    # the threshold is applied to the `topk` nearest rows afterwards
+    distance_expr = UserEventGist.embedding.cosine_distance(query_embedding)
+
+    stmt = (
+        select(
+            UserEventGist.id,
+            UserEventGist.gist_data,
+            UserEventGist.created_at,
+            UserEventGist.updated_at,
+            UserEventGist.token_size,
+            distance_expr.label("distance"),
+        )
+        .where(
+            UserEventGist.user_id == user_id,
+            UserEventGist.project_id == project_id,
+            UserEventGist.created_at > time_cutoff,
+            UserEventGist.embedding.is_not(None),  # Skip null embeddings
+        )
+        .order_by(vector_search_order(distance_expr))
+        .limit(topk)
+    )
+
+    await set_vector_search_options(session, topk, ef_search)
+    # rows of the selected columns, the embeddings stay in the DB
+    result = (await session.execute(stmt)).all()
+    user_event_gists: list[UserEventGistData] = []
+    # an iterative index scan may return the rows slightly out of order
+    for row in sorted(result, key=lambda r: r.distance):
+        similarity: float = 1 - row.distance
+        if similarity <= similarity_threshold:
+            break
+        user_event_gists.append(
+            UserEventGistData(
+                id=row.id,
+                gist_data=row.gist_data,
+                created_at=row.created_at,
+                updated_at=row.updated_at,
+                similarity=similarity,
+                token_size=row.token_size,
+            )
+        )
+    return user_event_gists
+
+
 async def search_user_event_gists(
     user_id: str,
     project_id: str,
@@ -69,6 +153,7 @@ async def search_user_event_gists(
     topk: int = 10,
     similarity_threshold: float = 0.2,
     time_range_in_days: int = 21,
+    ef_search: int = None,
 ) -> Promise[UserEventGistsData]:
     if not CONFIG.enable_event_embedding:
         TRACE_LOG.warning(
@@ -92,51 +177,20 @@ async def search_user_event_gists(
         return query_embeddings
     query_embedding = query_embeddings.data()[0]
 
-    # Calculate the time cutoff once
-    time_cutoff = func.now() - timedelta(days=time_range_in_days)
-
-    # Store the similarity expression to avoid recomputation
-    similarity_expr = 1 - UserEventGist.embedding.cosine_distance(query_embedding)
-
-    stmt = (
-        select(
-            UserEventGist,
-            similarity_expr.label("similarity"),
-        )
-        .where(
-            UserEventGist.user_id == user_id,
-            UserEventGist.project_id == project_id,
-            UserEventGist.created_at > time_cutoff,
-            similarity_expr > similarity_threshold,
-            UserEventGist.embedding.is_not(None),  # Skip null embeddings
-        )
-        .order_by(desc("similarity"))
-        .limit(topk)
-    )
-
-    with Session() as session:
-        # Use .all() instead of .scalars().all() to get both columns
-        result = session.execute(stmt).all()
-        user_event_gists: list[UserEventGistData] = []
-        for row in result:
-            user_event: UserEventGist = row[0]  # UserEventGist object
-            similarity: float = row[1]  # similarity value
-            user_event_gists.append(
-                UserEventGistData(
-                    id=user_event.id,
-                    gist_data=user_event.gist_data,
-                    created_at=user_event.created_at,
-                    updated_at=user_event.updated_at,
-                    similarity=similarity,
-                )
-            )
-
-        # Create UserEventsData with the events
-        user_event_gists_data = UserEventGistsData(gists=user_event_gists)
-        TRACE_LOG.info(
-            project_id,
+    async with AsyncSession() as session:
+        user_event_gists = await search_event_gists_by_embedding(
+            session,
             user_id,
-            f"Event Query: {query}",
+            project_id,
+            query_embedding,
+            topk,
+            similarity_threshold,
+            time_range_in_days,
+            ef_search,
         )
-
-    return Promise.resolve(user_event_gists_data)
+    TRACE_LOG.info(
+        project_id,
+        user_id,
+        f"Event Query: {query}",
+    )
+    return Promise.resolve(UserEventGistsData(gists=user_event_gists))
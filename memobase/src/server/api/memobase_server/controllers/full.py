@@ -6,5 +6,7 @@ from . import profile
 from . import project
 from . import event
 from . import event_gist
+from . import memory_version
 from . import context
 from . import billing
+from . import compaction
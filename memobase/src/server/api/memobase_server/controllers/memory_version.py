@@ -0,0 +1,108 @@
+"""A version of each user's memory, changed by every profile and event write.
+
+The reads derived from the memory (the rendered `/users/context`, the ETags of
+`/users/context` and `/users/profile`) are keyed by it, so they are never served
+after a write. Versions are random: a version key that expired can't come back
+with the value an old ETag was made of.
+"""
+
+import json
+import uuid
+import hashlib
+from ..env import CONFIG, LOG, TRACE_LOG
+from ..connectors import PROJECT_ID, get_redis_client
+
+
+def get_user_memory_version_key(user_id: str, project_id: str) -> str:
+    return f"memobase:user_memory_version:{PROJECT_ID}:{project_id}:{user_id}"
+
+
+def get_memory_generation_key() -> str:
+    return f"memobase:memory_generation:{PROJECT_ID}"
+
+
+def with_memory_generation(version: str, generation: str | None) -> str:
+    """The version of a user's memory, also changed when the rows of all users are dropped."""
+    return f"{version}.{generation}" if generation else version
+
+
+async def bump_user_memory_version(user_id: str, project_id: str):
+    """Call it after a write of the user's memory is committed."""
+    if CONFIG.context_cache_ttl_s <= 0:
+        return
+    try:
+        async with get_redis_client() as redis_client:
+            await redis_client.set(
+                get_user_memory_version_key(user_id, project_id),
+                uuid.uuid4().hex,
+                ex=CONFIG.context_cache_ttl_s,
+            )
+    except Exception as e:
+        TRACE_LOG.error(project_id, user_id, f"Failed to bump memory version: {e}")
+
+
+async def bump_memory_generation():
+    """Call it after the memory of many users changed at once, e.g. dropped partitions."""
+    if CONFIG.context_cache_ttl_s <= 0:
+        return
+    try:
+        async with get_redis_client() as redis_client:
+            # every copy cached before is expired after the ttl
+            await redis_client.set(
+                get_memory_generation_key(),
+                uuid.uuid4().hex,
+                ex=CONFIG.context_cache_ttl_s,
+            )
+    except Exception as e:
+        LOG.error(f"Failed to bump memory generation: {e}")
+
+
+async def init_user_memory_version(redis_client, user_id: str, project_id: str) -> str:
+    key = get_user_memory_version_key(user_id, project_id)
+    version = uuid.uuid4().hex
+    if await redis_client.set(key, version, nx=True, ex=CONFIG.context_cache_ttl_s):
+        return version
+    # a write or another read set it first
+    return await redis_client.get(key)
+
+
+async def get_user_memory_version(user_id: str, project_id: str) -> str:
+    async with get_redis_client() as redis_client:
+        version = await redis_client.get(
+            get_user_memory_version_key(user_id, project_id)
+        )
+        if version is None:
+            version = await init_user_memory_version(redis_client, user_id, project_id)
+    return version
+
+
+def get_request_hash(request_params: dict) -> str:
+    request = json.dumps(
+        request_params, sort_keys=True, ensure_ascii=False, default=str
+    )
+    return hashlib.sha256(request.encode()).hexdigest()[:32]
+
+
+def get_memory_etag(version: str, request_hash: str) -> str:
+    return f'"{version}-{request_hash}"'
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    tags = [t.strip().removeprefix("W/") for t in if_none_match.split(",")]
+    return "*" in tags or etag in tags
+
+
+async def get_user_memory_etag(
+    user_id: str, project_id: str, request_params: dict
+) -> str | None:
+    """The ETag of a read of the user's memory, `None` if it can't be versioned now."""
+    if CONFIG.context_cache_ttl_s <= 0:
+        return None
+    try:
+        version = await get_user_memory_version(user_id, project_id)
+    except Exception as e:
+        TRACE_LOG.error(project_id, user_id, f"Failed to get memory version: {e}")
+        return None
+    return get_memory_etag(version, get_request_hash(request_params))
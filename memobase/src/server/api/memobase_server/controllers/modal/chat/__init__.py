@@ -1,8 +1,7 @@
 import asyncio
 from ...project import get_project_profile_config
-from ....connectors import Session
 from ....env import ProfileConfig, CONFIG, TRACE_LOG
-from ....utils import get_blob_str, get_encoded_tokens
+from ....utils import get_blob_str, get_token_lengths
 from ....models.blob import Blob
 from ....models.utils import Promise, CODE
 from ....models.response import IdsData, ChatModalResponse, UserProfilesData
@@ -25,8 +24,8 @@ def truncate_chat_blobs(
 ) -> tuple[list[str], list[Blob]]:
     results = []
     total_token_size = 0
-    for b in blobs[::-1]:
-        ts = len(get_encoded_tokens(get_blob_str(b)))
+    token_sizes = get_token_lengths([get_blob_str(b) for b in blobs])
+    for b, ts in zip(blobs[::-1], token_sizes[::-1]):
         total_token_size += ts
         if total_token_size <= max_token_size:
             results.append(b)
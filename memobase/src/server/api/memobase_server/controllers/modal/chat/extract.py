@@ -47,9 +47,7 @@ async def extract_topics(
             user_memo,
             strict_mode=STRICT_MODE,
         ),
-        system_prompt=PROMPTS[USE_LANGUAGE]["extract"].get_prompt(
-            PROMPTS[USE_LANGUAGE]["profile"].get_prompt(project_profiles_slots)
-        ),
+        system_prompt=CURRENT_PROFILE_INFO["compiled_config"].extract_system_prompt,
         temperature=0.2,  # precise
         **PROMPTS[USE_LANGUAGE]["extract"].get_kwargs(),
     )
@@ -1,47 +1,119 @@
-from typing import TypedDict
+import json
+import hashlib
+import dataclasses
+from typing import TypedDict, Optional
 from ....env import CONFIG
 from ....models.response import UserProfilesData
 from ...project import ProfileConfig
-from ....prompts.profile_init_utils import read_out_profile_config
+from ....prompts.profile_init_utils import read_out_profile_config, read_out_event_tags
+from ....prompts import event_tagging as event_tagging_prompt
 from .types import PROMPTS
-from ....types import UserProfileTopic
+from ....types import UserProfileTopic, EventTag
 from ....env import ContanstTable
 from ....utils import truncate_string
 from ....prompts.utils import attribute_unify
+from ....local_cache import LocalTTLCache, MISSING
+
+
+@dataclasses.dataclass(frozen=True)
+class CompiledProfileConfig:
+    """Everything the chat modal derives from a project's `ProfileConfig`.
+
+    Built once per distinct config and shared by all the flushes using it. The system
+    prompts are pre-rendered, so they are byte-identical across calls and the LLM
+    provider can cache their prefix.
+    """
+
+    use_language: str
+    strict_mode: bool
+    profile_slots: list[UserProfileTopic]
+    allowed_topic_subtopics: Optional[frozenset[tuple[str, str]]]
+    event_tags: list[EventTag]
+    available_event_tags: frozenset[str]
+    extract_system_prompt: str
+    entry_summary_system_prompt: str
+    event_tagging_system_prompt: Optional[str]
+
+
+COMPILED_PROFILE_CONFIGS = LocalTTLCache(
+    "compiled_profile_config", CONFIG.project_cache_max_size, 60 * 60
+)
+
+
+def profile_config_hash(config: ProfileConfig) -> str:
+    return hashlib.sha256(
+        json.dumps(dataclasses.asdict(config), sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+def compile_profile_config(config: ProfileConfig) -> CompiledProfileConfig:
+    use_language = config.language or CONFIG.language
+    strict_mode = (
+        config.profile_strict_mode
+        if config.profile_strict_mode is not None
+        else CONFIG.profile_strict_mode
+    )
+    profile_slots = read_out_profile_config(
+        config, PROMPTS[use_language]["profile"].CANDIDATE_PROFILE_TOPICS
+    )
+    allowed_topic_subtopics = None
+    if strict_mode:
+        allowed_topic_subtopics = frozenset(
+            (attribute_unify(p.topic), attribute_unify(st["name"]))
+            for p in profile_slots
+            for st in p.sub_topics
+        )
+    event_tags = read_out_event_tags(config)
+    event_tags_str = "\n".join([f"- {et.name}({et.description})" for et in event_tags])
+    profile_topics_str = PROMPTS[use_language]["profile"].get_prompt(profile_slots)
+    return CompiledProfileConfig(
+        use_language=use_language,
+        strict_mode=strict_mode,
+        profile_slots=profile_slots,
+        allowed_topic_subtopics=allowed_topic_subtopics,
+        event_tags=event_tags,
+        available_event_tags=frozenset(et.name for et in event_tags),
+        extract_system_prompt=PROMPTS[use_language]["extract"].get_prompt(
+            profile_topics_str
+        ),
+        entry_summary_system_prompt=PROMPTS[use_language]["entry_summary"].get_prompt(
+            profile_topics_str,
+            event_tags_str,
+            additional_requirements=config.event_theme_requirement
+            or CONFIG.event_theme_requirement,
+        ),
+        event_tagging_system_prompt=(
+            event_tagging_prompt.get_prompt(event_tags_str) if event_tags else None
+        ),
+    )
+
+
+def get_compiled_profile_config(config: ProfileConfig) -> CompiledProfileConfig:
+    key = profile_config_hash(config)
+    compiled = COMPILED_PROFILE_CONFIGS.get(key)
+    if compiled is MISSING:
+        compiled = compile_profile_config(config)
+        COMPILED_PROFILE_CONFIGS.set(key, compiled)
+    return compiled
 
 
 class PackCurrentUserProfilesResult(TypedDict):
     already_topics_prompt: str
-    allowed_topic_subtopics: set[tuple[str, str]]
+    allowed_topic_subtopics: frozenset[tuple[str, str]]
     already_topic_subtopics_values: dict[tuple[str, str], str]
     project_profile_slots: list[UserProfileTopic]
     use_language: str
     strict_mode: bool
+    compiled_config: CompiledProfileConfig
 
 
 def pack_current_user_profiles(
     current_user_profiles: UserProfilesData, project_profiles: ProfileConfig
 ) -> PackCurrentUserProfilesResult:
     profiles = current_user_profiles.profiles
-    USE_LANGUAGE = project_profiles.language or CONFIG.language
-    STRICT_MODE = (
-        project_profiles.profile_strict_mode
-        if project_profiles.profile_strict_mode is not None
-        else CONFIG.profile_strict_mode
-    )
-
-    project_profiles_slots = read_out_profile_config(
-        project_profiles, PROMPTS[USE_LANGUAGE]["profile"].CANDIDATE_PROFILE_TOPICS
-    )
-    if STRICT_MODE:
-        allowed_topic_subtopics = set()
-        for p in project_profiles_slots:
-            for st in p.sub_topics:
-                allowed_topic_subtopics.add(
-                    (attribute_unify(p.topic), attribute_unify(st["name"]))
-                )
-    else:
-        allowed_topic_subtopics = None
+    compiled = get_compiled_profile_config(project_profiles)
+    STRICT_MODE = compiled.strict_mode
+    allowed_topic_subtopics = compiled.allowed_topic_subtopics
 
     if len(profiles):
         already_topics_subtopics = set(
@@ -82,7 +154,8 @@ def pack_current_user_profiles(
         "already_topics_prompt": already_topics_prompt,
         "allowed_topic_subtopics": allowed_topic_subtopics,
         "already_topic_subtopics_values": already_topic_subtopics_values,
-        "project_profile_slots": project_profiles_slots,
-        "use_language": USE_LANGUAGE,
+        "project_profile_slots": compiled.profile_slots,
+        "use_language": compiled.use_language,
         "strict_mode": STRICT_MODE,
+        "compiled_config": compiled,
     }
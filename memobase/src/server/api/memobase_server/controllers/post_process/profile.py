@@ -1,15 +1,21 @@
 import json
 import re
+import numpy as np
 from pydantic import ValidationError
-from typing import TypedDict
+from sqlalchemy import select
+from typing import TypedDict, Literal
 from ...models.utils import Promise
 from ...models.database import GeneralBlob, UserProfile
 from ...models.blob import OpenAICompatibleMessage
-from ...models.response import CODE, IdData, IdsData, UserProfilesData
-from ...utils import truncate_string, find_list_int_or_none
+from ...models.response import CODE, IdData, IdsData, ProfileData, UserProfilesData
+from ...utils import truncate_string, find_list_int_or_none, pack_latest_chat
 from ...env import TRACE_LOG, CONFIG
+from ...connectors import AsyncSession
 from ...prompts import pick_related_profiles as pick_prompt
 from ...llms import llm_complete
+from ...llms.embeddings import get_embedding
+
+ProfileFilterMode = Literal["vector", "llm"]
 
 
 class FilterProfilesResult(TypedDict):
@@ -36,8 +42,9 @@ async def filter_profiles_with_chats(
     max_value_token_size: int = 10,
     max_previous_chats: int = 4,
     max_filter_num: int = 10,
+    mode: ProfileFilterMode | None = None,
 ) -> Promise[FilterProfilesResult]:
-    """Filter profiles with chats"""
+    """Filter profiles with chats, by `mode` or `CONFIG.profile_filter_mode`"""
     if not len(chats) or not len(profiles.profiles):
         return Promise.reject(CODE.BAD_REQUEST, "No chats or profiles to filter")
     chats = chats[-(max_previous_chats + 1) :]
@@ -56,6 +63,19 @@ async def filter_profiles_with_chats(
         if only_topics is None or p.attributes["topic"].strip() in only_topics
     ]
 
+    mode = mode or CONFIG.profile_filter_mode
+    if mode == "vector" and CONFIG.enable_event_embedding:
+        p = await rank_profiles_with_embedding(
+            user_id,
+            project_id,
+            [profiles.profiles[t["index"]] for t in topics_index],
+            chats,
+            max_filter_num,
+        )
+        if not p.ok() or p.data() is not None:
+            return p
+        # some profiles were written before their embeddings, let the LLM pick
+
     topics_index = sorted(topics_index, key=lambda x: (x["topic"], x["sub_topic"]))
     system_prompt = pick_prompt.get_prompt(max_num=max_filter_num)
     input_prompt = pick_prompt.get_input(chats, topics_index)
@@ -65,6 +85,8 @@ async def filter_profiles_with_chats(
         system_prompt=system_prompt,
         temperature=0.2,  # precise
         model=CONFIG.summary_llm_model,
+        # the caller of /users/context is waiting, go before the flushes
+        priority="interactive",
         **pick_prompt.get_kwargs(),
     )
     if not r.ok():
@@ -93,3 +115,73 @@ async def filter_profiles_with_chats(
         f"Filter profiles with chats: {reason}, {found_ids}",
     )
     return Promise.resolve({"reason": reason, "profiles": profiles})
+
+
+async def rank_profiles_with_embedding(
+    user_id: str,
+    project_id: str,
+    profiles: list[ProfileData],
+    chats: list[OpenAICompatibleMessage],
+    max_filter_num: int,
+) -> Promise[FilterProfilesResult | None]:
+    """Keep the `max_filter_num` profiles most similar to the latest chats.
+
+    A user has tens of profiles, so their stored embeddings are scored in-process.
+    Resolves `None` if some profiles were written before the embeddings
+    (see `backfill_profile_embeddings.py`), they can't be ranked.
+    """
+    if not len(profiles):
+        return Promise.resolve({"reason": None, "profiles": []})
+    async with AsyncSession() as session:
+        rows = (
+            await session.execute(
+                select(UserProfile.id, UserProfile.embedding).where(
+                    UserProfile.user_id == user_id,
+                    UserProfile.project_id == project_id,
+                    UserProfile.embedding.is_not(None),
+                )
+            )
+        ).all()
+    embeddings = {str(row.id): row.embedding for row in rows}
+    unembedded = [p for p in profiles if str(p.id) not in embeddings]
+    if len(unembedded):
+        TRACE_LOG.info(
+            project_id,
+            user_id,
+            f"Can't filter profiles with embedding: {len(unembedded)} not embedded",
+        )
+        return Promise.resolve(None)
+
+    query_embeddings = await get_embedding(
+        project_id,
+        [pack_latest_chat(chats)],
+        phase="query",
+        model=CONFIG.embedding_model,
+    )
+    if not query_embeddings.ok():
+        TRACE_LOG.error(
+            project_id,
+            user_id,
+            f"Failed to get query embedding: {query_embeddings.msg()}",
+        )
+        return query_embeddings
+    query_embedding = query_embeddings.data()[0]
+
+    matrix = np.stack(
+        [np.asarray(embeddings[str(p.id)], dtype=np.float32) for p in profiles]
+    )
+    similarities = (matrix @ query_embedding) / (
+        np.linalg.norm(matrix, axis=1) * np.linalg.norm(query_embedding) + 1e-8
+    )
+    order = np.argsort(-similarities)[:max_filter_num]
+    ranked = [
+        profiles[i]
+        for i in order
+        if similarities[i] > CONFIG.profile_filter_similarity_threshold
+    ]
+    TRACE_LOG.info(
+        project_id,
+        user_id,
+        f"Filter profiles with embedding: {len(ranked)} related",
+    )
+    return Promise.resolve({"reason": None, "profiles": ranked})
@@ -1,10 +1,150 @@
 from pydantic import ValidationError
+from sqlalchemy import select, delete
 from ..models.utils import Promise
 from ..models.database import GeneralBlob, UserProfile
-from ..models.response import CODE, IdData, IdsData, UserProfilesData, ProfileAttributes
-from ..connectors import Session, get_redis_client
-from ..utils import get_encoded_tokens
+from ..models.response import (
+    CODE,
+    IdData,
+    IdsData,
+    UserProfilesData,
+    ProfileAttributes,
+    ProfileData,
+)
+from ..connectors import AsyncSession, PROJECT_ID, get_redis_client
+from ..utils import aget_token_length, aget_token_lengths, profile_str_repr
 from ..env import CONFIG, TRACE_LOG
+from ..llms.embeddings import get_embedding
+from .memory_version import bump_user_memory_version
+from ..telemetry import telemetry_manager, CounterMetricName
+
+# The cached profiles of a user are a hash: profile id -> ProfileData JSON.
+# Every write bumps the version key; a read only fills the cache if the version
+# is still the one it saw before reading the DB, a write only applies its delta
+# if no other write bumped it since the write read it, else the cache is dropped.
+USER_PROFILES_CACHE_VERSION_FIELD = "__version__"
+
+# `unpack` is bounded by the Lua stack, set and delete the fields in chunks
+REDIS_LUA_CHUNKED_CALLS = """
+local function call_in_chunks(command, key, first, last)
+    for i = first, last, 1000 do
+        redis.call(command, key, unpack(ARGV, i, math.min(i + 999, last)))
+    end
+end
+"""
+
+# ARGV: ttl, version, [profile id, profile json]...
+REDIS_LUA_FILL_PROFILES_IF_VERSION = REDIS_LUA_CHUNKED_CALLS + """
+local version = redis.call("get", KEYS[2]) or "0"
+if version ~= ARGV[2] then
+    return 0
+end
+redis.call("del", KEYS[1])
+redis.call("hset", KEYS[1], "__version__", version)
+call_in_chunks("hset", KEYS[1], 3, #ARGV)
+redis.call("expire", KEYS[1], ARGV[1])
+return 1
+"""
+
+# ARGV: ttl, version read by the write, number of set args,
+# [profile id, profile json]..., deleted profile ids...
+REDIS_LUA_APPLY_PROFILES_DELTA = REDIS_LUA_CHUNKED_CALLS + """
+local version = redis.call("incr", KEYS[2])
+redis.call("expire", KEYS[2], ARGV[1])
+if redis.call("exists", KEYS[1]) == 0 then
+    return 0
+end
+if version ~= tonumber(ARGV[2]) + 1 then
+    -- another write applied in between, its rows may be newer than ours
+    redis.call("del", KEYS[1])
+    return 0
+end
+local set_end = 3 + tonumber(ARGV[3])
+call_in_chunks("hset", KEYS[1], 4, set_end)
+call_in_chunks("hdel", KEYS[1], set_end + 1, #ARGV)
+redis.call("hset", KEYS[1], "__version__", version)
+redis.call("expire", KEYS[1], ARGV[1])
+return 1
+"""
+
+
+async def fill_profiles_token_size(profiles: list[ProfileData]):
+    """Count the tokens of the profiles written before `token_size` was stored."""
+    missing = [p for p in profiles if p.token_size is None]
+    if not missing:
+        return
+    token_sizes = await aget_token_lengths(
+        [profile_str_repr(p.content, p.attributes) for p in missing]
+    )
+    for p, token_size in zip(missing, token_sizes):
+        p.token_size = token_size
+
+
+async def embed_profile_lines(user_id: str, project_id: str, lines: list[str]) -> list:
+    """Embed the profile lines for the vector filter of /users/context.
+
+    Returns `None`s if embeddings are disabled or fail, the profiles are still written.
+    """
+    if not CONFIG.enable_event_embedding or not len(lines):
+        return [None] * len(lines)
+    embeddings = await get_embedding(
+        project_id, lines, phase="document", model=CONFIG.embedding_model
+    )
+    if not embeddings.ok():
+        TRACE_LOG.error(
+            project_id,
+            user_id,
+            f"Failed to get profile embeddings: {embeddings.msg()}",
+        )
+        return [None] * len(lines)
+    embeddings = embeddings.data()
+    if embeddings.shape[-1] != CONFIG.embedding_dim:
+        TRACE_LOG.error(
+            project_id,
+            user_id,
+            f"Embedding dimension mismatch! Expected {CONFIG.embedding_dim}, got {embeddings.shape[-1]}.",
+        )
+        return [None] * len(lines)
+    return list(embeddings)
+
+
+async def embed_profile_updates(
+    user_id: str,
+    project_id: str,
+    profile_ids: list[str],
+    contents: list[str],
+    attributes: list[dict | None],
+    extra_lines: list[str] = None,
+) -> tuple[dict[str, list], list]:
+    """Embed the updated profile lines before the write opens its transaction.
+
+    The profiles updated without attributes keep the stored ones, read first in a
+    short session. Returns the embeddings by line, and those of `extra_lines`.
+    """
+    extra_lines = extra_lines or []
+    stored_attributes = {}
+    keep_attributes = [i for i, a in zip(profile_ids, attributes) if a is None]
+    if len(keep_attributes) and CONFIG.enable_event_embedding:
+        async with AsyncSession() as session:
+            rows = (
+                await session.execute(
+                    select(UserProfile.id, UserProfile.attributes).where(
+                        UserProfile.id.in_(keep_attributes),
+                        UserProfile.user_id == user_id,
+                        UserProfile.project_id == project_id,
+                    )
+                )
+            ).all()
+        stored_attributes = {str(row.id): row.attributes for row in rows}
+    lines = []
+    for profile_id, content, attr in zip(profile_ids, contents, attributes):
+        attr = attr if attr is not None else stored_attributes.get(str(profile_id))
+        if attr is not None:
+            lines.append(profile_str_repr(content, attr))
+    embeddings = await embed_profile_lines(user_id, project_id, extra_lines + lines)
+    return (
+        dict(zip(lines, embeddings[len(extra_lines) :])),
+        embeddings[: len(extra_lines)],
+    )
 
 
 async def truncate_profiles(
@@ -62,9 +202,9 @@ async def truncate_profiles(
     if max_token_size:
         current_length = 0
         use_index = 0
+        await fill_profiles_token_size(profiles.profiles)
         for max_i, p in enumerate(profiles.profiles):
-            single_p = f"{p.attributes.get('topic')}::{p.attributes.get('sub_topic')}: {p.content}"
-            current_length += len(get_encoded_tokens(single_p))
+            current_length += p.token_size
             if current_length > max_token_size:
                 break
             use_index = max_i
@@ -72,48 +212,154 @@ async def truncate_profiles(
     return Promise.resolve(profiles)
 
 
-async def get_user_profiles(user_id: str, project_id: str) -> Promise[UserProfilesData]:
-    async with get_redis_client() as redis_client:
-        user_profiles = await redis_client.get(
-            f"user_profiles::{project_id}::{user_id}"
-        )
-        if user_profiles:
-            try:
-                return Promise.resolve(
-                    UserProfilesData.model_validate_json(user_profiles)
-                )
-            except ValidationError as e:
-                TRACE_LOG.error(
-                    project_id,
-                    user_id,
-                    f"Invalid user profiles: {e}",
+def select_user_profile(profile_id: str, user_id: str, project_id: str):
+    return select(UserProfile).where(
+        UserProfile.id == profile_id,
+        UserProfile.user_id == user_id,
+        UserProfile.project_id == project_id,
+    )
+
+
+def select_user_profiles_data(user_id: str, project_id: str):
+    return select(
+        UserProfile.id,
+        UserProfile.content,
+        UserProfile.attributes,
+        UserProfile.created_at,
+        UserProfile.updated_at,
+        UserProfile.token_size,
+    ).where(
+        UserProfile.user_id == user_id,
+        UserProfile.project_id == project_id,
+    )
+
+
+def get_user_profiles_cache_key(user_id: str, project_id: str) -> str:
+    return f"memobase:user_profiles:{PROJECT_ID}:{project_id}:{user_id}"
+
+
+def get_user_profiles_version_key(user_id: str, project_id: str) -> str:
+    return f"memobase:user_profiles_version:{PROJECT_ID}:{project_id}:{user_id}"
+
+
+def pack_profiles_cache_fields(profiles: list[ProfileData]) -> list[str]:
+    fields = []
+    for p in profiles:
+        fields.extend([str(p.id), p.model_dump_json()])
+    return fields
+
+
+async def write_through_user_profile_cache(
+    session,
+    user_id: str,
+    project_id: str,
+    upsert_profile_ids: list[str],
+    delete_profile_ids: list[str],
+) -> None:
+    """Apply a committed write to the cached profiles, instead of dropping them.
+
+    The upserted profiles are re-read, so the cache gets the timestamps of the DB.
+    The version is read before, a concurrent write applied in between drops the cache.
+    """
+    await bump_user_memory_version(user_id, project_id)
+    version_key = get_user_profiles_version_key(user_id, project_id)
+    try:
+        async with get_redis_client() as redis_client:
+            version = await redis_client.get(version_key)
+        upsert_profiles = []
+        if len(upsert_profile_ids):
+            rows = (
+                await session.execute(
+                    select_user_profiles_data(user_id, project_id).where(
+                        UserProfile.id.in_(upsert_profile_ids)
+                    )
                 )
-                await redis_client.delete(f"user_profiles::{project_id}::{user_id}")
-    with Session() as session:
-        user_profiles = (
-            session.query(UserProfile)
-            .filter_by(user_id=user_id, project_id=project_id)
-            .order_by(UserProfile.updated_at.desc())
-            .all()
-        )
-        results = []
-        for up in user_profiles:
-            results.append(
-                {
-                    "id": up.id,
-                    "content": up.content,
-                    "attributes": up.attributes,
-                    "created_at": up.created_at,
-                    "updated_at": up.updated_at,
-                }
+            ).all()
+            upsert_profiles = [ProfileData(**row._asdict()) for row in rows]
+        set_fields = pack_profiles_cache_fields(upsert_profiles)
+        async with get_redis_client() as redis_client:
+            await redis_client.eval(
+                REDIS_LUA_APPLY_PROFILES_DELTA,
+                2,
+                get_user_profiles_cache_key(user_id, project_id),
+                version_key,
+                CONFIG.cache_user_profiles_ttl,
+                version or "0",
+                len(set_fields),
+                *set_fields,
+                *[str(i) for i in delete_profile_ids],
             )
-    return_profiles = UserProfilesData(profiles=results)
-    async with get_redis_client() as redis_client:
-        await redis_client.set(
-            f"user_profiles::{project_id}::{user_id}",
-            return_profiles.model_dump_json(),
-            ex=CONFIG.cache_user_profiles_ttl,
+    except Exception as e:
+        TRACE_LOG.error(
+            project_id,
+            user_id,
+            f"Failed to write through profile cache, drop it: {e}",
         )
+        await refresh_user_profile_cache(user_id, project_id)
+
+
+async def get_user_profiles(user_id: str, project_id: str) -> Promise[UserProfilesData]:
+    cache_key = get_user_profiles_cache_key(user_id, project_id)
+    try:
+        async with get_redis_client() as redis_client:
+            cached_profiles = await redis_client.hgetall(cache_key)
+            if cached_profiles:
+                cached_profiles.pop(USER_PROFILES_CACHE_VERSION_FIELD, None)
+                try:
+                    profiles = [
+                        ProfileData.model_validate_json(p)
+                        for p in cached_profiles.values()
+                    ]
+                    profiles.sort(key=lambda p: p.updated_at, reverse=True)
+                    telemetry_manager.increment_counter_metric(
+                        CounterMetricName.PROFILE_CACHE_LOOKUPS, 1, {"result": "hit"}
+                    )
+                    return Promise.resolve(UserProfilesData(profiles=profiles))
+                except ValidationError as e:
+                    TRACE_LOG.error(
+                        project_id,
+                        user_id,
+                        f"Invalid user profiles: {e}",
+                    )
+                    await redis_client.delete(cache_key)
+            # read the version before the DB, so a write in between won't be overwritten
+            version = await redis_client.get(
+                get_user_profiles_version_key(user_id, project_id)
+            )
+        fill_cache = True
+    except Exception as e:
+        TRACE_LOG.error(project_id, user_id, f"Failed to read profile cache: {e}")
+        fill_cache = False
+    telemetry_manager.increment_counter_metric(
+        CounterMetricName.PROFILE_CACHE_LOOKUPS, 1, {"result": "miss"}
+    )
+
+    async with AsyncSession() as session:
+        rows = (
+            await session.execute(
+                select_user_profiles_data(user_id, project_id).order_by(
+                    UserProfile.updated_at.desc()
+                )
+            )
+        ).all()
+    return_profiles = UserProfilesData(
+        profiles=[ProfileData(**row._asdict()) for row in rows]
+    )
+    if not fill_cache:
+        return Promise.resolve(return_profiles)
+    try:
+        async with get_redis_client() as redis_client:
+            await redis_client.eval(
+                REDIS_LUA_FILL_PROFILES_IF_VERSION,
+                2,
+                cache_key,
+                get_user_profiles_version_key(user_id, project_id),
+                CONFIG.cache_user_profiles_ttl,
+                version or "0",
+                *pack_profiles_cache_fields(return_profiles.profiles),
+            )
+    except Exception as e:
+        TRACE_LOG.error(project_id, user_id, f"Failed to fill profile cache: {e}")
     return Promise.resolve(return_profiles)
 
 
@@ -133,17 +379,31 @@ async def add_user_profiles(
             return Promise.reject(
                 CODE.SERVER_PARSE_ERROR, f"Invalid profile attributes: {e}"
             )
-    with Session() as session:
+    lines = [
+        profile_str_repr(content, attr) for content, attr in zip(profiles, attributes)
+    ]
+    token_sizes = await aget_token_lengths(lines)
+    embeddings = await embed_profile_lines(user_id, project_id, lines)
+    async with AsyncSession() as session:
         db_profiles = [
             UserProfile(
-                user_id=user_id, project_id=project_id, content=content, attributes=attr
+                user_id=user_id,
+                project_id=project_id,
+                content=content,
+                attributes=attr,
+                token_size=token_size,
+                embedding=embedding,
+            )
+            for content, attr, token_size, embedding in zip(
+                profiles, attributes, token_sizes, embeddings
             )
-            for content, attr in zip(profiles, attributes)
         ]
         session.add_all(db_profiles)
-        session.commit()
+        await session.commit()
         profile_ids = [profile.id for profile in db_profiles]
-    await refresh_user_profile_cache(user_id, project_id)
+        await write_through_user_profile_cache(
+            session, user_id, project_id, profile_ids, []
+        )
     return Promise.resolve(IdsData(ids=profile_ids))
 
 
@@ -160,14 +420,17 @@ async def update_user_profiles(
     assert len(profile_ids) == len(
         attributes
     ), "Length of profile_ids, attributes must be equal"
-    with Session() as session:
+    line_embeddings, _ = await embed_profile_updates(
+        user_id, project_id, profile_ids, contents, attributes
+    )
+    async with AsyncSession() as session:
         db_profiles = []
         for profile_id, content, attribute in zip(profile_ids, contents, attributes):
             db_profile = (
-                session.query(UserProfile)
-                .filter_by(id=profile_id, user_id=user_id, project_id=project_id)
-                .one_or_none()
-            )
+                await session.execute(
+                    select_user_profile(profile_id, user_id, project_id)
+                )
+            ).scalar_one_or_none()
             if db_profile is None:
                 TRACE_LOG.error(
                     project_id,
@@ -178,48 +441,67 @@ async def update_user_profiles(
             db_profile.content = content
             if attribute is not None:
                 db_profile.attributes = attribute
+            line = profile_str_repr(db_profile.content, db_profile.attributes)
+            db_profile.token_size = await aget_token_length(line)
+            # no embedding if the stored attributes changed since they were embedded
+            db_profile.embedding = line_embeddings.get(line)
             db_profiles.append(profile_id)
-        session.commit()
-    await refresh_user_profile_cache(user_id, project_id)
+        await session.commit()
+        await write_through_user_profile_cache(
+            session, user_id, project_id, db_profiles, []
+        )
     return Promise.resolve(IdsData(ids=db_profiles))
 
 
 async def delete_user_profile(
     user_id: str, project_id: str, profile_id: str
 ) -> Promise[None]:
-    with Session() as session:
+    async with AsyncSession() as session:
         db_profile = (
-            session.query(UserProfile)
-            .filter_by(id=profile_id, user_id=user_id, project_id=project_id)
-            .one_or_none()
-        )
+            await session.execute(select_user_profile(profile_id, user_id, project_id))
+        ).scalar_one_or_none()
         if db_profile is None:
             return Promise.reject(
                 CODE.NOT_FOUND, f"Profile {profile_id} not found for user {user_id}"
             )
-        session.delete(db_profile)
-        session.commit()
-    await refresh_user_profile_cache(user_id, project_id)
+        await session.delete(db_profile)
+        await session.commit()
+        await write_through_user_profile_cache(
+            session, user_id, project_id, [], [profile_id]
+        )
     return Promise.resolve(None)
 
 
 async def delete_user_profiles(
     user_id: str, project_id: str, profile_ids: list[str]
 ) -> Promise[IdsData]:
-    with Session() as session:
-        session.query(UserProfile).filter(
-            UserProfile.id.in_(profile_ids),
-            UserProfile.user_id == user_id,
-            UserProfile.project_id == project_id,
-        ).delete(synchronize_session=False)
-        session.commit()
-    await refresh_user_profile_cache(user_id, project_id)
+    async with AsyncSession() as session:
+        await session.execute(
+            delete(UserProfile)
+            .where(
+                UserProfile.id.in_(profile_ids),
+                UserProfile.user_id == user_id,
+                UserProfile.project_id == project_id,
+            )
+            .execution_options(synchronize_session=False)
+        )
+        await session.commit()
+        await write_through_user_profile_cache(
+            session, user_id, project_id, [], profile_ids
+        )
     return Promise.resolve(IdsData(ids=profile_ids))
 
 
 async def refresh_user_profile_cache(user_id: str, project_id: str) -> Promise[None]:
+    await bump_user_memory_version(user_id, project_id)
     async with get_redis_client() as redis_client:
-        await redis_client.delete(f"user_profiles::{project_id}::{user_id}")
+        # bump the version first, a read in flight won't fill the old profiles back
+        await redis_client.incr(get_user_profiles_version_key(user_id, project_id))
+        await redis_client.expire(
+            get_user_profiles_version_key(user_id, project_id),
+            CONFIG.cache_user_profiles_ttl,
+        )
+        await redis_client.delete(get_user_profiles_cache_key(user_id, project_id))
     return Promise.resolve(None)
 
 
@@ -253,8 +535,22 @@ async def add_update_delete_user_profiles(
                 CODE.SERVER_PARSE_ERROR, f"Invalid profile attributes: {e}"
             )
     # Sanity Check done
+    add_lines = [
+        profile_str_repr(content, attr)
+        for content, attr in zip(add_profiles, add_attributes)
+    ]
+    add_token_sizes = await aget_token_lengths(add_lines)
+    # embed all the lines in one request before taking a connection
+    update_embeddings, add_embeddings = await embed_profile_updates(
+        user_id,
+        project_id,
+        update_profile_ids,
+        update_contents,
+        update_attributes,
+        extra_lines=add_lines,
+    )
 
-    with Session() as session:
+    async with AsyncSession() as session:
         try:
             # 1. add new profiles
             if len(add_profiles):
@@ -264,8 +560,12 @@ async def add_update_delete_user_profiles(
                         project_id=project_id,
                         content=content,
                         attributes=attr,
+                        token_size=token_size,
+                        embedding=embedding,
+                    )
+                    for content, attr, token_size, embedding in zip(
+                        add_profiles, add_attributes, add_token_sizes, add_embeddings
                     )
-                    for content, attr in zip(add_profiles, add_attributes)
                 ]
                 session.add_all(add_db_profiles)
                 add_profile_ids = [p.id for p in add_db_profiles]
@@ -277,10 +577,10 @@ async def add_update_delete_user_profiles(
                 update_profile_ids, update_contents, update_attributes
             ):
                 db_profile = (
-                    session.query(UserProfile)
-                    .filter_by(id=profile_id, user_id=user_id, project_id=project_id)
-                    .one_or_none()
-                )
+                    await session.execute(
+                        select_user_profile(profile_id, user_id, project_id)
+                    )
+                ).scalar_one_or_none()
                 if db_profile is None:
                     TRACE_LOG.error(
                         project_id,
@@ -291,26 +591,39 @@ async def add_update_delete_user_profiles(
                 db_profile.content = content
                 if attribute is not None:
                     db_profile.attributes = attribute
+                line = profile_str_repr(db_profile.content, db_profile.attributes)
+                db_profile.token_size = await aget_token_length(line)
+                db_profile.embedding = update_embeddings.get(line)
                 update_db_profiles.append(profile_id)
 
             # 3. delete profiles
-            session.query(UserProfile).filter(
-                UserProfile.id.in_(delete_profile_ids),
-                UserProfile.user_id == user_id,
-                UserProfile.project_id == project_id,
-            ).delete(synchronize_session=False)
+            await session.execute(
+                delete(UserProfile)
+                .where(
+                    UserProfile.id.in_(delete_profile_ids),
+                    UserProfile.user_id == user_id,
+                    UserProfile.project_id == project_id,
+                )
+                .execution_options(synchronize_session=False)
+            )
 
-            session.commit()
+            await session.commit()
         except Exception as e:
             TRACE_LOG.error(
                 project_id,
                 user_id,
                 f"Error merging user profiles: {e}",
             )
-            session.rollback()
+            await session.rollback()
             return Promise.reject(
                 CODE.SERVER_PARSE_ERROR, f"Error merging user profiles: {e}"
             )
 
-    await refresh_user_profile_cache(user_id, project_id)
+        await write_through_user_profile_cache(
+            session,
+            user_id,
+            project_id,
+            add_profile_ids + update_db_profiles,
+            delete_profile_ids,
+        )
     return Promise.resolve(IdsData(ids=add_profile_ids))
@@ -1,76 +1,84 @@
-from sqlalchemy import cast, String, func, desc
+from sqlalchemy import cast, String, func, desc, select
 from ..models.database import Project, User, UserProfile, UserEvent
 from ..models.utils import Promise, CODE
 from ..models.response import IdData, ProfileConfigData, ProjectUsersData, DailyUsage
-from ..connectors import Session
+from ..connectors import AsyncSession
 from ..env import ProfileConfig, TelemetryKeyName
-from ..telemetry.capture_key import get_int_key, date_past_key
+from ..local_cache import PROJECT_PROFILE_CONFIGS, MISSING, publish_project_invalidation
+from ..telemetry.capture_key import get_int_keys, date_past_key
 
 
 async def get_project_secret(project_id: str) -> Promise[str]:
-    with Session() as session:
+    async with AsyncSession() as session:
         p = (
-            session.query(Project)
-            .filter(Project.project_id == project_id)
-            .one_or_none()
-        )
+            await session.execute(
+                select(Project.project_secret).where(Project.project_id == project_id)
+            )
+        ).one_or_none()
         if not p:
             return Promise.reject(CODE.NOT_FOUND, "Project not found")
         return Promise.resolve(p.project_secret)
 
 
 async def get_project_status(project_id: str) -> Promise[str]:
-    with Session() as session:
+    async with AsyncSession() as session:
         p = (
-            session.query(Project.status)
-            .filter(Project.project_id == project_id)
-            .one_or_none()
-        )
+            await session.execute(
+                select(Project.status).where(Project.project_id == project_id)
+            )
+        ).one_or_none()
         if not p:
             return Promise.reject(CODE.NOT_FOUND, "Project not found")
         return Promise.resolve(p.status)
 
 
 async def get_project_profile_config(project_id: str) -> Promise[ProfileConfig]:
-    with Session() as session:
+    # The returned config is shared by the callers, don't modify it
+    p_parse = PROJECT_PROFILE_CONFIGS.get(project_id)
+    if p_parse is not MISSING:
+        return Promise.resolve(p_parse)
+    async with AsyncSession() as session:
         p = (
-            session.query(Project.profile_config)
-            .filter(Project.project_id == project_id)
-            .one_or_none()
-        )
+            await session.execute(
+                select(Project.profile_config).where(Project.project_id == project_id)
+            )
+        ).one_or_none()
         if not p:
             return Promise.reject(CODE.NOT_FOUND, "Project not found")
         if not p.profile_config:
-            return Promise.resolve(ProfileConfig())
-        p_parse = ProfileConfig.load_config_string(p.profile_config)
+            p_parse = ProfileConfig()
+        else:
+            p_parse = ProfileConfig.load_config_string(p.profile_config)
+    PROJECT_PROFILE_CONFIGS.set(project_id, p_parse)
     return Promise.resolve(p_parse)
 
 
 async def update_project_profile_config(
     project_id: str, profile_config: str | None
 ) -> Promise[None]:
-    with Session() as session:
+    async with AsyncSession() as session:
         p = (
-            session.query(Project)
-            .filter(Project.project_id == project_id)
-            .one_or_none()
-        )
+            await session.execute(
+                select(Project).where(Project.project_id == project_id)
+            )
+        ).scalar_one_or_none()
         if not p:
             return Promise.reject(CODE.NOT_FOUND, "Project not found")
         p.profile_config = profile_config
-        session.commit()
+        await session.commit()
+    await publish_project_invalidation(project_id)
     return Promise.resolve(None)
 
 
 async def get_project_profile_config_string(
     project_id: str,
 ) -> Promise[ProfileConfigData]:
-    with Session() as session:
+    async with AsyncSession() as session:
         p = (
-            session.query(Project.profile_config)
-            .filter(Project.project_id == project_id)
-            .one_or_none()
-        )
+            await session.execute(
+                select(Project.profile_config).where(Project.project_id == project_id)
+            )
+        ).one_or_none()
         if not p:
             return Promise.reject(CODE.NOT_FOUND, "Project not found")
         return Promise.resolve(ProfileConfigData(profile_config=p.profile_config or ""))
@@ -84,35 +92,35 @@ async def get_project_users(
     order_by: str = "updated_at",
     order_desc: bool = True,
 ) -> Promise[ProjectUsersData]:
-    with Session() as session:
+    async with AsyncSession() as session:
         profile_subq = (
-            session.query(
+            select(
                 UserProfile.user_id.label("user_id"),
                 func.count(UserProfile.id).label("profile_count"),
             )
-            .filter(UserProfile.project_id == project_id)
+            .where(UserProfile.project_id == project_id)
             .group_by(UserProfile.user_id)
             .subquery()
         )
 
         event_subq = (
-            session.query(
+            select(
                 UserEvent.user_id.label("user_id"),
                 func.count(UserEvent.id).label("event_count"),
             )
-            .filter(UserEvent.project_id == project_id)
+            .where(UserEvent.project_id == project_id)
             .group_by(UserEvent.user_id)
             .subquery()
         )
 
         query = (
-            session.query(
+            select(
                 User,
                 func.coalesce(profile_subq.c.profile_count, 0).label("profile_count"),
                 func.coalesce(event_subq.c.event_count, 0).label("event_count"),
             )
-            .filter(User.project_id == project_id)
-            .filter(cast(User.id, String).like(f"%{search}%"))
+            .where(User.project_id == project_id)
+            .where(cast(User.id, String).like(f"%{search}%"))
             .outerjoin(profile_subq, profile_subq.c.user_id == User.id)
             .outerjoin(event_subq, event_subq.c.user_id == User.id)
         )
@@ -129,13 +137,17 @@ async def get_project_users(
             )
 
         count = (
-            session.query(func.count())
-            .filter(User.project_id == project_id)
-            .filter(cast(User.id, String).like(f"%{search}%"))
-            .scalar()
-        )
+            await session.execute(
+                select(func.count())
+                .select_from(User)
+                .where(User.project_id == project_id)
+                .where(cast(User.id, String).like(f"%{search}%"))
+            )
+        ).scalar()
 
-        users_with_counts = query.limit(limit).offset(offset).all()
+        users_with_counts = (
+            await session.execute(query.limit(limit).offset(offset))
+        ).all()
 
         user_dicts = []
         for user, profile_count, event_count in users_with_counts:
@@ -152,27 +164,24 @@ async def get_project_usage(
     project_id: str, last_days: int = 7
 ) -> Promise[list[DailyUsage]]:
     query_dates = [date_past_key(i) for i in range(last_days)]
-    results = []
-    for qd in query_dates:
-        total_insert = await get_int_key(
-            TelemetryKeyName.insert_blob_request, project_id, use_date=qd
-        )
-        total_success_insert = await get_int_key(
-            TelemetryKeyName.insert_blob_success_request, project_id, use_date=qd
-        )
-        total_input_token = await get_int_key(
-            TelemetryKeyName.llm_input_tokens, project_id, use_date=qd
-        )
-        total_output_token = await get_int_key(
-            TelemetryKeyName.llm_output_tokens, project_id, use_date=qd
-        )
-        results.append(
-            DailyUsage(
-                date=qd,
-                total_insert=total_insert,
-                total_success_insert=total_success_insert,
-                total_input_token=total_input_token,
-                total_output_token=total_output_token,
-            )
+    daily_values = await get_int_keys(
+        [
+            TelemetryKeyName.insert_blob_request,
+            TelemetryKeyName.insert_blob_success_request,
+            TelemetryKeyName.llm_input_tokens,
+            TelemetryKeyName.llm_output_tokens,
+        ],
+        project_id,
+        query_dates,
+    )
+    results = [
+        DailyUsage(
+            date=qd,
+            total_insert=values[TelemetryKeyName.insert_blob_request],
+            total_success_insert=values[TelemetryKeyName.insert_blob_success_request],
+            total_input_token=values[TelemetryKeyName.llm_input_tokens],
+            total_output_token=values[TelemetryKeyName.llm_output_tokens],
         )
+        for qd, values in zip(query_dates, daily_values)
+    ]
     return Promise.resolve(results)
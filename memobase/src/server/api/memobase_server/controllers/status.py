@@ -1,20 +1,26 @@
 from pydantic import ValidationError
+from sqlalchemy import select
 from ..models.utils import Promise
 from ..models.database import UserStatus
 from ..models.response import CODE, UserStatusesData, UserStatusData, IdData
-from ..connectors import Session
+from ..connectors import AsyncSession
 
 
 async def get_user_statuses(
     user_id: str, project_id: str, type: str, page: int = 1, page_size: int = 10
 ) -> Promise[UserStatusesData]:
-    with Session() as session:
+    async with AsyncSession() as session:
         status = (
-            session.query(UserStatus)
-            .filter_by(user_id=user_id, project_id=project_id, type=type)
-            .order_by(UserStatus.created_at.desc())
-            .offset((page - 1) * page_size)
-            .limit(page_size)
+            (
+                await session.execute(
+                    select(UserStatus)
+                    .filter_by(user_id=user_id, project_id=project_id, type=type)
+                    .order_by(UserStatus.created_at.desc())
+                    .offset((page - 1) * page_size)
+                    .limit(page_size)
+                )
+            )
+            .scalars()
             .all()
         )
         if status is None:
@@ -35,10 +41,10 @@ async def get_user_statuses(
 async def append_user_status(
     user_id: str, project_id: str, type: str, attributes: dict
 ) -> Promise[IdData]:
-    with Session() as session:
+    async with AsyncSession() as session:
         status = UserStatus(
             user_id=user_id, project_id=project_id, type=type, attributes=attributes
         )
         session.add(status)
-        session.commit()
+        await session.commit()
         return Promise.resolve(IdData(id=status.id))
@@ -68,6 +68,7 @@ class TelemetryKeyName:
     insert_blob_success_request = "insert_blob_success_request"
     llm_input_tokens = "llm_input_tokens"
     llm_output_tokens = "llm_output_tokens"
+    llm_cached_tokens = "llm_cached_tokens"
     has_request = "has_request"
 
 
@@ -83,16 +84,56 @@ class Config:
 
     system_prompt: str = None
     buffer_flush_interval: int = 60 * 60  # 1 hour
+    # idle buffers older than buffer_flush_interval are flushed by the flush workers,
+    # at most this many users every check, 0 to disable
+    buffer_idle_flush_batch_size: int = 100
+    buffer_idle_flush_check_interval_s: int = 60
+    # skip a check while the flush queue is longer than this
+    buffer_idle_flush_max_queue_depth: int = 1000
     max_chat_blob_buffer_token_size: int = 1024
     max_chat_blob_buffer_process_token_size: int = 16384
     max_profile_subtopics: int = 15
     max_pre_profile_token_size: int = 128
     llm_tab_separator: str = "::"
     cache_user_profiles_ttl: int = 60 * 20  # 20 minutes
+    # rendered /users/context without chats, and the memory versions behind the ETags
+    # of /users/context and /users/profile, 0 to disable. Also how long a cached
+    # context may keep the events that left its time range
+    context_cache_ttl_s: int = 60 * 5
+    # in-process cache of project secret/status/profile config
+    project_cache_ttl_s: int = 60
+    project_cache_max_size: int = 10000
+    # in-process cache of token lengths, keyed by the content hash
+    token_length_cache_size: int = 100000
+    # contents longer than this are encoded in a worker thread
+    token_length_offload_chars: int = 8192
+    # flush workers started inside the API server, set to 0 if you run `flush_worker.py`
+    buffer_flush_workers: int = 1
+    # a flushing buffer without heartbeat for this long is re-queued
+    buffer_flush_lease_s: int = 60 * 5
+    # compaction, run by the flush workers every compaction_interval_s, 0 to disable.
+    # done/failed buffers older than these are deleted, 0 keeps them
+    compaction_interval_s: int = 60 * 10
+    buffer_done_retention_s: int = 60 * 60 * 24
+    buffer_failed_retention_s: int = 60 * 60 * 24 * 7
+    # blob_type -> seconds its blobs are kept after their buffers are done,
+    # blob types not listed are kept forever
+    blob_retention_s: dict[str, int] = field(default_factory=dict)
+    # rows deleted per transaction, and at most this many transactions per run
+    compaction_batch_size: int = 1000
+    compaction_max_batches: int = 100
+    # project_id -> days its events and gists are kept, deleted by the compaction
+    event_retention_days: dict[str, int] = field(default_factory=dict)
+    # monthly partitions of user_events/user_event_gists by created_at, only applied
+    # when the tables are created. Partitions are created this many months ahead,
+    # and dropped once older than event_partition_retention_months (0 keeps them)
+    event_partitioning: bool = False
+    event_partition_premake_months: int = 2
+    event_partition_retention_months: int = 0
 
     # LLM
     language: Literal["en", "zh"] = "en"
-    llm_style: Literal["openai", "doubao_cache"] = "openai"
+    llm_style: Literal["openai", "doubao_cache", "stand_in"] = "openai"
     llm_base_url: str = None
     llm_api_key: str = None
     llm_openai_default_query: dict[str, str] = None
@@ -101,13 +142,62 @@ class Config:
     thinking_llm_model: str = "o4-mini"
     summary_llm_model: str = None
 
+    # llm_style/embedding_provider 'stand_in': canned answers for benchmarks,
+    # log-normal latencies around these medians
+    stand_in_llm_latency_ms: float = 800
+    stand_in_embedding_latency_ms: float = 50
+    stand_in_latency_sigma: float = 0.5
+
+    # prompt_id -> seconds its responses are cached, stages not listed are not cached
+    llm_response_cache_ttl_s: dict[str, int] = field(default_factory=dict)
+    llm_response_cache_max_chars: int = 16384
+
+    # LLM limiter, 0 to disable each limit
+    # in-flight calls of each process, all projects and per project
+    llm_max_concurrency: int = 0
+    llm_project_max_concurrency: int = 0
+    # requests/tokens per minute, counted across processes in Redis
+    llm_rpm_limit: int = 0
+    llm_tpm_limit: int = 0
+    llm_project_rpm_limit: int = 0
+    llm_project_tpm_limit: int = 0
+    # share of the rpm/tpm limits kept for interactive calls (/users/context)
+    llm_interactive_reserve: float = 0.2
+    # LLM token usage is summed in each process and billed every this many seconds,
+    # 0 to bill it after every call
+    billing_flush_interval_s: float = 5
+    # a write of the summed usage that fails this many flushes in a row is logged and dropped
+    billing_flush_max_retries: int = 5
+
     enable_event_embedding: bool = True
-    embedding_provider: Literal["openai", "jina"] = "openai"
+    embedding_provider: Literal["openai", "jina", "lmstudio", "local", "stand_in"] = (
+        "openai"
+    )
     embedding_api_key: str = None
     embedding_base_url: str = None
     embedding_dim: int = 1536
     embedding_model: str = "text-embedding-3-small"
     embedding_max_token_size: int = 8192
+    # embedding_provider 'local': a sentence-transformers model run in-process
+    local_embedding_device: str = "cpu"
+    local_embedding_batch_size: int = 32
+    # HNSW index of the event/gist embeddings, only used when embedding_dim <= 2000
+    vector_index_m: int = 16
+    vector_index_ef_construction: int = 64
+    # candidate list size of a search, raised to `topk` if smaller
+    vector_search_ef_search: int = 100
+    # cache of query embeddings (in-process LRU + Redis), 0 to disable
+    query_embedding_cache_ttl_s: int = 60 * 60
+    query_embedding_cache_max_size: int = 2000
+    # concurrent document embeddings are sent together, 0 to disable
+    embedding_batch_window_ms: float = 5
+    embedding_batch_max_size: int = 256
+    embedding_batch_max_tokens: int = 100000
+    # how /users/context picks the profiles related to the chats: 'vector' ranks
+    # the profile embeddings (stored on write), 'llm' asks summary_llm_model (slower).
+    # 'vector' falls back to 'llm' when enable_event_embedding is off
+    profile_filter_mode: Literal["vector", "llm"] = "vector"
+    profile_filter_similarity_threshold: float = 0.2
 
     additional_user_profiles: list[dict] = field(default_factory=list)
     overwrite_user_profiles: Optional[list[dict]] = None
@@ -191,7 +281,9 @@ class Config:
         return overwrite_config
 
     def __post_init__(self):
-        assert self.llm_api_key is not None, "llm_api_key is required"
+        assert (
+            self.llm_api_key is not None or self.llm_style == "stand_in"
+        ), "llm_api_key is required"
         if self.enable_event_embedding:
             if self.embedding_api_key is None and (
                 self.llm_style == self.embedding_provider == "openai"
@@ -199,8 +291,9 @@ class Config:
                 # default to llm config if embedding_api_key is not set
                 self.embedding_api_key = self.llm_api_key
                 self.embedding_base_url = self.llm_base_url
-            assert (
-                self.embedding_api_key is not None
+            assert self.embedding_api_key is not None or self.embedding_provider in (
+                "local",
+                "stand_in",
             ), "embedding_api_key is required for event embedding"
 
             if self.embedding_provider == "jina":
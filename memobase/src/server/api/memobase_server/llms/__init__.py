@@ -1,22 +1,33 @@
-import asyncio
 import time
 from ..prompts.utils import convert_response_to_json
-from ..utils import get_encoded_tokens
+from ..utils import aget_token_length
 from ..env import CONFIG, LOG
-from ..controllers.billing import project_cost_token_billing
+from ..controllers.billing import record_token_billing
 from ..models.utils import Promise
 from ..models.response import CODE
 from ..models.database import DEFAULT_PROJECT_ID
 from ..telemetry import telemetry_manager, CounterMetricName, HistogramMetricName
+from .limiter import LLMPriority, limit_llm_call, settle_llm_rate, tpm_limits_enabled
+from .response_cache import (
+    get_llm_response_cache_ttl,
+    get_llm_response_cache_key,
+    get_cached_llm_response,
+    set_cached_llm_response,
+    record_saved_tokens,
+)
 
 from .openai_model_llm import openai_complete
 from .doubao_cache_llm import doubao_cache_complete
+from .stand_in_llm import stand_in_complete
 
-FACTORIES = {"openai": openai_complete, "doubao_cache": doubao_cache_complete}
+FACTORIES = {
+    "openai": openai_complete,
+    "doubao_cache": doubao_cache_complete,
+    "stand_in": stand_in_complete,
+}
 assert CONFIG.llm_style in FACTORIES, f"Unsupported LLM style: {CONFIG.llm_style}"
 
 
-# TODO: add TPM/Rate limiter
 async def llm_complete(
     project_id,
     prompt,
@@ -25,37 +36,68 @@ async def llm_complete(
     json_mode=False,
     model=None,
     max_tokens=1024,
+    priority: LLMPriority = "background",
     **kwargs,
 ) -> Promise[str | dict]:
     use_model = model or CONFIG.best_llm_model
     if json_mode:
         kwargs["response_format"] = {"type": "json_object"}
-    try:
-        start_time = time.time()
-        results = await FACTORIES[CONFIG.llm_style](
+    prompt_id = kwargs.get("prompt_id")
+    cache_key = None
+    if get_llm_response_cache_ttl(prompt_id) > 0 and not kwargs.get("no_cache"):
+        cache_key = get_llm_response_cache_key(
+            project_id,
+            prompt_id,
             use_model,
             prompt,
-            system_prompt=system_prompt,
-            history_messages=history_messages,
-            max_tokens=max_tokens,
-            **kwargs,
+            system_prompt,
+            history_messages,
+            max_tokens,
+            kwargs,
         )
-        latency = (time.time() - start_time) * 1000
-    except Exception as e:
-        LOG.error(f"Error in llm_complete: {e}")
-        return Promise.reject(CODE.SERVICE_UNAVAILABLE, f"Error in llm_complete: {e}")
+        cached = await get_cached_llm_response(cache_key, prompt_id)
+        if cached is not None:
+            record_saved_tokens(project_id, cached)
+            return parse_llm_results(cached["content"], json_mode)
+    estimated_tokens = max_tokens
+    if tpm_limits_enabled():
+        estimated_tokens += await aget_token_length(
+            prompt
+            + (system_prompt or "")
+            + "\n".join([m["content"] for m in history_messages])
+        )
+    async with limit_llm_call(project_id, priority, estimated_tokens) as reservation:
+        try:
+            start_time = time.time()
+            results, usage = await FACTORIES[CONFIG.llm_style](
+                use_model,
+                prompt,
+                system_prompt=system_prompt,
+                history_messages=history_messages,
+                max_tokens=max_tokens,
+                **kwargs,
+            )
+            latency = (time.time() - start_time) * 1000
+        except Exception as e:
+            LOG.error(f"Error in llm_complete: {e}")
+            return Promise.reject(
+                CODE.SERVICE_UNAVAILABLE, f"Error in llm_complete: {e}"
+            )
 
-    in_tokens = len(
-        get_encoded_tokens(
+    # Bill the counts reported by the provider, only encode when they are missing
+    in_tokens = getattr(usage, "prompt_tokens", None)
+    if in_tokens is None:
+        in_tokens = await aget_token_length(
             prompt
             + (system_prompt or "")
             + "\n".join([m["content"] for m in history_messages])
         )
-    )
-    out_tokens = len(get_encoded_tokens(results))
+    out_tokens = getattr(usage, "completion_tokens", None)
+    if out_tokens is None:
+        out_tokens = await aget_token_length(results)
 
-    # await project_cost_token_billing(project_id, in_tokens, out_tokens)
-    asyncio.create_task(project_cost_token_billing(project_id, in_tokens, out_tokens))
+    await settle_llm_rate(reservation, in_tokens + out_tokens)
+    record_token_billing(project_id, in_tokens, out_tokens)
 
     telemetry_manager.increment_counter_metric(
         CounterMetricName.LLM_TOKENS_INPUT,
@@ -78,6 +120,15 @@ async def llm_complete(
         {"project_id": project_id},
     )
 
+    p = parse_llm_results(results, json_mode)
+    if cache_key is not None and p.ok():
+        await set_cached_llm_response(
+            cache_key, prompt_id, results, in_tokens, out_tokens
+        )
+    return p
+
+
+def parse_llm_results(results: str, json_mode: bool) -> Promise[str | dict]:
     if not json_mode:
         return Promise.resolve(results)
     parse_dict = convert_response_to_json(results)
@@ -1,3 +1,4 @@
+from openai.types import CompletionUsage
 import hashlib
 from .utils import get_doubao_async_client_instance, exclude_special_kwargs
 from ..connectors import get_redis_client
@@ -56,7 +57,7 @@ async def doubao_cache_complete(
     history_messages=[],
     thinking_enable=False,
     **kwargs,
-) -> str:
+) -> tuple[str, CompletionUsage | None]:
     sp_args, kwargs = exclude_special_kwargs(kwargs)
     prompt_id = sp_args.get("prompt_id", None)
     assert prompt_id is not None, "prompt_id is required"
@@ -80,7 +81,7 @@ async def doubao_cache_complete(
             model=model, messages=messages, timeout=120, **kwargs
         )
         LOG.info(f"No Cached {prompt_id} {model} {response.usage.prompt_tokens}")
-        return response.choices[0].message.content
+        return response.choices[0].message.content, response.usage
 
     context_id = await doubao_cache_create_context_and_save(
         model, system_prompt, prompt_id
@@ -94,7 +95,7 @@ async def doubao_cache_complete(
         response = await doubao_async_client.chat.completions.create(
             model=model, messages=messages, timeout=120, **kwargs
         )
-        return response.choices[0].message.content
+        return response.choices[0].message.content, response.usage
     else:
         response = await doubao_async_client.context.completions.create(
             model=model, messages=messages, context_id=context_id, timeout=120, **kwargs
@@ -102,4 +103,4 @@ async def doubao_cache_complete(
         LOG.info(
             f"Cached {prompt_id} {model} {response.usage.prompt_tokens_details.cached_tokens}/{response.usage.prompt_tokens}"
         )
-        return response.choices[0].message.content
+        return response.choices[0].message.content, response.usage
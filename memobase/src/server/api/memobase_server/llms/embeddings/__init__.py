@@ -1,23 +1,117 @@
 import time
+import base64
+import hashlib
 from typing import Literal
 import numpy as np
 from traceback import format_exc
 from ...env import CONFIG, LOG
+from ...connectors import PROJECT_ID, get_redis_client
+from ...local_cache import LocalTTLCache, MISSING
 from ...models.utils import Promise
 from ...models.response import CODE
 from ...models.database import DEFAULT_PROJECT_ID
 from .jina_embedding import jina_embedding
 from .openai_embedding import openai_embedding
 from .lmstudio_embedding import lmstudio_embedding
+from .local_embedding import local_embedding
+from .stand_in_embedding import stand_in_embedding
+from .batcher import EmbeddingBatcher
 from ...telemetry import telemetry_manager, HistogramMetricName, CounterMetricName
-from ...utils import get_encoded_tokens
+from ...utils import aget_token_length
 
-FACTORIES = {"openai": openai_embedding, "jina": jina_embedding, "lmstudio": lmstudio_embedding}
+FACTORIES = {
+    "openai": openai_embedding,
+    "jina": jina_embedding,
+    "lmstudio": lmstudio_embedding,
+    "local": local_embedding,
+    "stand_in": stand_in_embedding,
+}
 assert (
     CONFIG.embedding_provider in FACTORIES
 ), f"Unsupported embedding provider: {CONFIG.embedding_provider}"
 
 
+QUERY_EMBEDDINGS = LocalTTLCache(
+    "query_embedding",
+    CONFIG.query_embedding_cache_max_size,
+    CONFIG.query_embedding_cache_ttl_s,
+)
+
+
+def get_query_embedding_cache_key(model: str, phase: str, text: str) -> str:
+    text_hash = hashlib.sha256(text.encode()).hexdigest()
+    return f"memobase:query_embedding:{PROJECT_ID}:{CONFIG.embedding_provider}:{model}:{phase}:{text_hash}"
+
+
+def pack_embedding(embedding: np.ndarray) -> str:
+    # float16 is 1/4 of the JSON floats once base64-ed, the similarity barely moves
+    return base64.b64encode(embedding.astype("<f2").tobytes()).decode()
+
+
+def unpack_embedding(packed: str) -> np.ndarray:
+    return np.frombuffer(base64.b64decode(packed), dtype="<f2").astype(np.float32)
+
+
+async def get_cached_query_embeddings(keys: list[str]) -> list[np.ndarray | None]:
+    """Look up the in-process cache first, then Redis."""
+    embeddings = [QUERY_EMBEDDINGS.get(k) for k in keys]
+    embeddings = [None if e is MISSING else e for e in embeddings]
+    local_hits = sum(e is not None for e in embeddings)
+    redis_hits = 0
+    missing = [i for i, e in enumerate(embeddings) if e is None]
+    if missing:
+        try:
+            async with get_redis_client() as redis_client:
+                packed = await redis_client.mget([keys[i] for i in missing])
+            for i, p in zip(missing, packed):
+                if p is None:
+                    continue
+                embeddings[i] = unpack_embedding(p)
+                QUERY_EMBEDDINGS.set(keys[i], embeddings[i])
+                redis_hits += 1
+        except Exception as e:
+            LOG.error(f"Failed to read query embeddings cache: {e}")
+    for result, count in [
+        ("local", local_hits),
+        ("redis", redis_hits),
+        ("miss", len(missing) - redis_hits),
+    ]:
+        if count:
+            telemetry_manager.increment_counter_metric(
+                CounterMetricName.QUERY_EMBEDDING_CACHE_LOOKUPS,
+                count,
+                {"result": result},
+            )
+    return embeddings
+
+
+async def set_cached_query_embeddings(keys: list[str], embeddings: np.ndarray):
+    for k, e in zip(keys, embeddings):
+        QUERY_EMBEDDINGS.set(k, e)
+    try:
+        async with get_redis_client() as redis_client:
+            pipe = redis_client.pipeline(transaction=False)
+            for k, e in zip(keys, embeddings):
+                pipe.set(k, pack_embedding(e), ex=CONFIG.query_embedding_cache_ttl_s)
+            await pipe.execute()
+    except Exception as e:
+        LOG.error(f"Failed to write query embeddings cache: {e}")
+
+
+async def call_embedding_provider(model: str, texts: list[str], phase: str):
+    return await FACTORIES[CONFIG.embedding_provider](model, texts, phase)
+
+
+# model -> batcher of its document embeddings
+DOCUMENT_BATCHERS: dict[str, EmbeddingBatcher] = {}
+
+
+def get_document_batcher(model: str) -> EmbeddingBatcher:
+    if model not in DOCUMENT_BATCHERS:
+        DOCUMENT_BATCHERS[model] = EmbeddingBatcher(call_embedding_provider, model)
+    return DOCUMENT_BATCHERS[model]
+
+
 async def check_embedding_sanity():
     if not CONFIG.enable_event_embedding:
         LOG.info("Event embedding is disabled, skipping sanity check.")
@@ -25,7 +119,7 @@ async def check_embedding_sanity():
     r = await get_embedding(DEFAULT_PROJECT_ID, ["Hello, world!"])
     if not r.ok():
         raise ValueError(
-            "Embedding API check failed! Make sure the embedding API key is valid."
+            f"Embedding API check failed! Make sure the embedding API key is valid. {r.msg()}"
         )
     d = r.data()
     embedding_dim = d.shape[-1]
@@ -43,14 +137,47 @@ async def get_embedding(
     model: str = None,
 ) -> Promise[np.ndarray]:
     model = model or CONFIG.embedding_model
+    # queries (the latest chats of /users/context) repeat while a turn is generated
+    if phase == "query" and CONFIG.query_embedding_cache_ttl_s > 0:
+        return await get_query_embedding_with_cache(project_id, texts, model)
+    # concurrent flushes embed their events together
+    if phase == "document" and CONFIG.embedding_batch_window_ms > 0:
+        return await get_document_batcher(model).embed(project_id, texts)
+    return await request_embedding(project_id, texts, phase, model)
+
+
+async def get_query_embedding_with_cache(
+    project_id: str, texts: list[str], model: str
+) -> Promise[np.ndarray]:
+    cache_keys = [get_query_embedding_cache_key(model, "query", t) for t in texts]
+    embeddings = await get_cached_query_embeddings(cache_keys)
+    missing = [i for i, e in enumerate(embeddings) if e is None]
+    if missing:
+        p = await request_embedding(
+            project_id, [texts[i] for i in missing], "query", model
+        )
+        if not p.ok():
+            return p
+        await set_cached_query_embeddings([cache_keys[i] for i in missing], p.data())
+        for i, e in zip(missing, p.data()):
+            embeddings[i] = e
+    return Promise.resolve(np.stack(embeddings))
+
+
+async def request_embedding(
+    project_id: str,
+    texts: list[str],
+    phase: Literal["query", "document"],
+    model: str,
+) -> Promise[np.ndarray]:
     try:
         start_time = time.time()
-        results = await FACTORIES[CONFIG.embedding_provider](model, texts, phase)
+        results = await call_embedding_provider(model, texts, phase)
         latency_ms = (time.time() - start_time) * 1000
     except Exception as e:
         LOG.error(f"Error in get_embedding: {e} {format_exc()}")
         return Promise.reject(CODE.SERVICE_UNAVAILABLE, f"Error in get_embedding: {e}")
-    embedding_tokens = len(get_encoded_tokens("\n".join(texts)))
+    embedding_tokens = await aget_token_length("\n".join(texts))
     telemetry_manager.increment_counter_metric(
         CounterMetricName.EMBEDDING_TOKENS,
         embedding_tokens,
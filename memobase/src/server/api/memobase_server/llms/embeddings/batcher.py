@@ -0,0 +1,172 @@
+"""Coalesce concurrent document embedding requests into provider-sized batches.
+
+Each buffer flush embeds one event and its gists, so concurrent flushes of many
+users would each send a tiny request. The requests arriving within
+`embedding_batch_window_ms` are sent together, split at `embedding_batch_max_size`
+texts or `embedding_batch_max_tokens` tokens per provider request.
+"""
+
+import time
+import asyncio
+import numpy as np
+from dataclasses import dataclass
+from typing import Awaitable, Callable
+from traceback import format_exc
+from ...env import CONFIG, LOG
+from ...models.utils import Promise
+from ...models.response import CODE
+from ...telemetry import telemetry_manager, HistogramMetricName, CounterMetricName
+from ...utils import aget_token_lengths, get_encoded_tokens, get_decoded_tokens
+
+EmbeddingProvider = Callable[[str, list[str], str], Awaitable[np.ndarray]]
+
+
+@dataclass
+class PendingEmbedding:
+    project_id: str
+    texts: list[str]
+    token_sizes: list[int]
+    future: asyncio.Future
+    enqueued_at: float
+
+
+class EmbeddingBatcher:
+    def __init__(self, provider: EmbeddingProvider, model: str):
+        self.provider = provider
+        self.model = model
+        self.pending: list[PendingEmbedding] = []
+        self.pending_texts = 0
+        self.pending_tokens = 0
+        self.flush_handle: asyncio.TimerHandle | None = None
+        # keep a reference, the loop only holds weak ones
+        self.running: set[asyncio.Task] = set()
+
+    async def embed(self, project_id: str, texts: list[str]) -> Promise[np.ndarray]:
+        if not texts:
+            return Promise.resolve(np.zeros((0, CONFIG.embedding_dim)))
+        texts, token_sizes = await truncate_texts(texts)
+        loop = asyncio.get_running_loop()
+        request = PendingEmbedding(
+            project_id, texts, token_sizes, loop.create_future(), time.monotonic()
+        )
+        self.pending.append(request)
+        self.pending_texts += len(texts)
+        self.pending_tokens += sum(token_sizes)
+        if (
+            self.pending_texts >= CONFIG.embedding_batch_max_size
+            or self.pending_tokens >= CONFIG.embedding_batch_max_tokens
+        ):
+            self.flush()
+        elif self.flush_handle is None:
+            self.flush_handle = loop.call_later(
+                CONFIG.embedding_batch_window_ms / 1000, self.flush
+            )
+        return await request.future
+
+    def flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        requests, self.pending = self.pending, []
+        self.pending_texts = self.pending_tokens = 0
+        if not requests:
+            return
+        task = asyncio.create_task(self.run(requests))
+        self.running.add(task)
+        task.add_done_callback(self.running.discard)
+
+    async def run(self, requests: list[PendingEmbedding]):
+        try:
+            await self.embed_requests(requests)
+        finally:
+            # don't leave a caller waiting if the batch is cancelled or broken
+            for r in requests:
+                if not r.future.done():
+                    r.future.set_result(
+                        Promise.reject(
+                            CODE.SERVICE_UNAVAILABLE, "Embedding batch aborted"
+                        )
+                    )
+
+    async def embed_requests(self, requests: list[PendingEmbedding]):
+        now = time.monotonic()
+        for r in requests:
+            telemetry_manager.record_histogram_metric(
+                HistogramMetricName.EMBEDDING_QUEUE_DELAY_MS,
+                (now - r.enqueued_at) * 1000,
+            )
+        items = [(r, t, s) for r in requests for t, s in zip(r.texts, r.token_sizes)]
+        batches = split_batches(items)
+        results = await asyncio.gather(
+            *[self.request_batch([t for _, t, _ in b]) for b in batches]
+        )
+
+        embeddings: dict[int, list[np.ndarray]] = {id(r): [] for r in requests}
+        failed: dict[int, Promise] = {}
+        for batch, result in zip(batches, results):
+            for i, (r, _, _) in enumerate(batch):
+                if not result.ok():
+                    failed[id(r)] = result
+                else:
+                    embeddings[id(r)].append(result.data()[i])
+        for r in requests:
+            if r.future.done():
+                # the caller was cancelled
+                continue
+            if id(r) in failed:
+                r.future.set_result(failed[id(r)])
+            else:
+                r.future.set_result(Promise.resolve(np.stack(embeddings[id(r)])))
+                telemetry_manager.increment_counter_metric(
+                    CounterMetricName.EMBEDDING_TOKENS,
+                    sum(r.token_sizes),
+                    {"project_id": r.project_id},
+                )
+
+    async def request_batch(self, texts: list[str]) -> Promise[np.ndarray]:
+        telemetry_manager.record_histogram_metric(
+            HistogramMetricName.EMBEDDING_BATCH_SIZE, len(texts)
+        )
+        try:
+            start_time = time.time()
+            results = await self.provider(self.model, texts, "document")
+            latency_ms = (time.time() - start_time) * 1000
+        except Exception as e:
+            LOG.error(f"Error in embedding batch: {e} {format_exc()}")
+            return Promise.reject(
+                CODE.SERVICE_UNAVAILABLE, f"Error in get_embedding: {e}"
+            )
+        telemetry_manager.record_histogram_metric(
+            HistogramMetricName.EMBEDDING_LATENCY_MS, latency_ms
+        )
+        return Promise.resolve(results)
+
+
+async def truncate_texts(texts: list[str]) -> tuple[list[str], list[int]]:
+    """Cut the texts to `embedding_max_token_size`, one long text can't fail the batch."""
+    texts = list(texts)
+    token_sizes = await aget_token_lengths(texts)
+    for i, size in enumerate(token_sizes):
+        if size > CONFIG.embedding_max_token_size:
+            tokens = get_encoded_tokens(texts[i])[: CONFIG.embedding_max_token_size]
+            texts[i] = get_decoded_tokens(tokens)
+            token_sizes[i] = CONFIG.embedding_max_token_size
+    return texts, token_sizes
+
+
+def split_batches(items: list[tuple]) -> list[list[tuple]]:
+    """Split (request, text, token_size) items into provider-sized batches."""
+    batches, batch, batch_tokens = [], [], 0
+    for item in items:
+        token_size = item[2]
+        if batch and (
+            len(batch) >= CONFIG.embedding_batch_max_size
+            or batch_tokens + token_size > CONFIG.embedding_batch_max_tokens
+        ):
+            batches.append(batch)
+            batch, batch_tokens = [], 0
+        batch.append(item)
+        batch_tokens += token_size
+    if batch:
+        batches.append(batch)
+    return batches
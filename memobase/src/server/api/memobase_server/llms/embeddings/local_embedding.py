@@ -0,0 +1,51 @@
+import asyncio
+import numpy as np
+from typing import Literal
+from concurrent.futures import ThreadPoolExecutor
+from ...errors import ExternalAPIError
+from ...env import CONFIG, LOG
+
+_local_models = {}
+# one model call at a time, the inference itself uses all the CPU threads
+_local_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="embedding")
+
+
+def get_local_model(model: str):
+    if model not in _local_models:
+        try:
+            from sentence_transformers import SentenceTransformer
+        except ImportError as e:
+            raise ExternalAPIError(
+                "embedding_provider 'local' requires `pip install sentence-transformers`"
+            ) from e
+        LOG.info(
+            f"Loading local embedding model {model} on {CONFIG.local_embedding_device}"
+        )
+        _local_models[model] = SentenceTransformer(
+            model, device=CONFIG.local_embedding_device
+        )
+    return _local_models[model]
+
+
+def encode_texts(
+    model: str, texts: list[str], phase: Literal["query", "document"]
+) -> np.ndarray:
+    local_model = get_local_model(model)
+    # models like e5/bge ship their own query/document prompts
+    prompt_name = phase if phase in local_model.prompts else None
+    return local_model.encode(
+        texts,
+        prompt_name=prompt_name,
+        batch_size=CONFIG.local_embedding_batch_size,
+        normalize_embeddings=True,
+        convert_to_numpy=True,
+    )
+
+
+async def local_embedding(
+    model: str, texts: list[str], phase: Literal["query", "document"] = "document"
+) -> np.ndarray:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        _local_executor, encode_texts, model, texts, phase
+    )
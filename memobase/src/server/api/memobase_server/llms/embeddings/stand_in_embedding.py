@@ -0,0 +1,19 @@
+import hashlib
+import numpy as np
+from typing import Literal
+from ...env import CONFIG
+from ..stand_in_llm import sleep_stand_in_latency
+
+
+def stand_in_vector(text: str) -> np.ndarray:
+    seed = int.from_bytes(hashlib.blake2b(text.encode(), digest_size=8).digest())
+    v = np.random.default_rng(seed).normal(size=CONFIG.embedding_dim)
+    return (v / np.linalg.norm(v)).astype(np.float32)
+
+
+async def stand_in_embedding(
+    model: str, texts: list[str], phase: Literal["query", "document"] = "document"
+) -> np.ndarray:
+    """Same text, same unit vector, no provider needed."""
+    await sleep_stand_in_latency(CONFIG.stand_in_embedding_latency_ms)
+    return np.stack([stand_in_vector(t) for t in texts])
@@ -0,0 +1,231 @@
+"""Limit the LLM calls before they reach the provider.
+
+A burst of buffer flushes fans out into many concurrent calls (merges,
+organize, re-summary), which trips the provider's rate limits and retries all
+at once. Every call of `llm_complete` takes:
+
+- a share of the current minute's requests and tokens, counted in Redis for all
+  the processes (`llm_rpm_limit`, `llm_tpm_limit` and their `llm_project_` versions).
+  Background calls can only use `1 - llm_interactive_reserve` of them;
+- then an in-flight slot of its project and of the process (`llm_project_max_concurrency`,
+  `llm_max_concurrency`), waiters are served by priority then arrival.
+
+Every limit is disabled when set to 0. If Redis is down the rate limits are skipped.
+"""
+
+import time
+import heapq
+import random
+import asyncio
+import itertools
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import Literal
+from ..env import CONFIG, LOG
+from ..connectors import PROJECT_ID, get_redis_client
+from ..telemetry import telemetry_manager, HistogramMetricName
+
+LLMPriority = Literal["interactive", "background"]
+PRIORITY_ORDER = {"interactive": 0, "background": 1}
+RATE_WINDOW_S = 60
+
+# Take the requests/tokens from every window only if all of them have room.
+# An empty window always admits one call, so a call above the TPM limit still runs.
+REDIS_LUA_TAKE_RATE = """
+local requests = tonumber(ARGV[1])
+local tokens = tonumber(ARGV[2])
+for i, key in ipairs(KEYS) do
+    local rpm = tonumber(ARGV[2 + i * 2 - 1])
+    local tpm = tonumber(ARGV[2 + i * 2])
+    local used_requests = tonumber(redis.call("hget", key, "requests") or "0")
+    local used_tokens = tonumber(redis.call("hget", key, "tokens") or "0")
+    if rpm > 0 and used_requests + requests > rpm then
+        return 0
+    end
+    if tpm > 0 and used_requests > 0 and used_tokens + tokens > tpm then
+        return 0
+    end
+end
+for i, key in ipairs(KEYS) do
+    redis.call("hincrby", key, "requests", requests)
+    redis.call("hincrby", key, "tokens", tokens)
+    redis.call("expire", key, ARGV[#ARGV])
+end
+return 1
+"""
+
+
+class PrioritySemaphore:
+    """A semaphore whose waiters are woken by priority, then arrival."""
+
+    def __init__(self, value: int):
+        self.value = value
+        self.waiters: list[tuple[int, int, asyncio.Future]] = []
+        self.counter = itertools.count()
+
+    def idle(self, max_value: int) -> bool:
+        return self.value == max_value and not self.waiters
+
+    async def acquire(self, priority: int):
+        if self.value > 0 and not self.waiters:
+            self.value -= 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (priority, next(self.counter), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # woken up and cancelled at once, pass the slot on
+                self.release()
+            raise
+
+    def release(self):
+        while self.waiters:
+            _, _, future = heapq.heappop(self.waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.value += 1
+
+
+_global_slots: PrioritySemaphore | None = None
+_project_slots: dict[str, PrioritySemaphore] = {}
+
+
+@asynccontextmanager
+async def llm_slot(project_id: str, priority: LLMPriority):
+    order = PRIORITY_ORDER[priority]
+    global _global_slots
+    project_slots = None
+    if CONFIG.llm_project_max_concurrency > 0:
+        if project_id not in _project_slots:
+            _project_slots[project_id] = PrioritySemaphore(
+                CONFIG.llm_project_max_concurrency
+            )
+        project_slots = _project_slots[project_id]
+        await project_slots.acquire(order)
+    global_slots = None
+    try:
+        if CONFIG.llm_max_concurrency > 0:
+            if _global_slots is None:
+                _global_slots = PrioritySemaphore(CONFIG.llm_max_concurrency)
+            global_slots = _global_slots
+            await global_slots.acquire(order)
+        try:
+            yield
+        finally:
+            if global_slots is not None:
+                global_slots.release()
+    finally:
+        if project_slots is not None:
+            project_slots.release()
+            if project_slots.idle(CONFIG.llm_project_max_concurrency):
+                _project_slots.pop(project_id, None)
+
+
+def get_llm_rate_keys(project_id: str, window: int) -> list[str]:
+    prefix = f"memobase:llm_rate:{PROJECT_ID}:{CONFIG.llm_style}"
+    return [f"{prefix}:global:{window}", f"{prefix}:project:{project_id}:{window}"]
+
+
+def rate_limits_enabled() -> bool:
+    return any(
+        [
+            CONFIG.llm_rpm_limit,
+            CONFIG.llm_tpm_limit,
+            CONFIG.llm_project_rpm_limit,
+            CONFIG.llm_project_tpm_limit,
+        ]
+    )
+
+
+def tpm_limits_enabled() -> bool:
+    return CONFIG.llm_tpm_limit > 0 or CONFIG.llm_project_tpm_limit > 0
+
+
+@dataclass
+class RateReservation:
+    project_id: str
+    window: int | None = None
+    tokens: int = 0
+
+
+async def take_llm_rate(
+    project_id: str, priority: LLMPriority, tokens: int
+) -> RateReservation:
+    """Wait until the current minute has room for the call, then count it."""
+    reservation = RateReservation(project_id)
+    if not rate_limits_enabled():
+        return reservation
+    share = 1 if priority == "interactive" else 1 - CONFIG.llm_interactive_reserve
+    limits = [
+        CONFIG.llm_rpm_limit,
+        CONFIG.llm_tpm_limit,
+        CONFIG.llm_project_rpm_limit,
+        CONFIG.llm_project_tpm_limit,
+    ]
+    limits = [max(int(l * share), 1) if l > 0 else 0 for l in limits]
+    while True:
+        now = time.time()
+        window = int(now // RATE_WINDOW_S)
+        try:
+            async with get_redis_client() as redis_client:
+                taken = await redis_client.eval(
+                    REDIS_LUA_TAKE_RATE,
+                    2,
+                    *get_llm_rate_keys(project_id, window),
+                    1,
+                    tokens,
+                    *limits,
+                    RATE_WINDOW_S * 2,
+                )
+        except Exception as e:
+            LOG.error(f"[llm limiter] Failed to take rate, skip it: {e}")
+            return reservation
+        if taken:
+            reservation.window = window
+            reservation.tokens = tokens
+            return reservation
+        # spread the waiters over the start of the next window
+        wait_s = (window + 1) * RATE_WINDOW_S - now
+        await asyncio.sleep(wait_s + random.random() * (1 + PRIORITY_ORDER[priority]))
+
+
+async def settle_llm_rate(reservation: RateReservation, tokens: int):
+    """Replace the estimated tokens of the call with the used ones."""
+    if (
+        reservation.window is None
+        or not tpm_limits_enabled()
+        or tokens == reservation.tokens
+    ):
+        return
+    try:
+        async with get_redis_client() as redis_client:
+            async with redis_client.pipeline(transaction=False) as pipe:
+                for key in get_llm_rate_keys(
+                    reservation.project_id, reservation.window
+                ):
+                    pipe.hincrby(key, "tokens", tokens - reservation.tokens)
+                    pipe.expire(key, RATE_WINDOW_S * 2)
+                await pipe.execute()
+    except Exception as e:
+        LOG.error(f"[llm limiter] Failed to settle tokens: {e}")
+
+
+@asynccontextmanager
+async def limit_llm_call(project_id: str, priority: LLMPriority, tokens: int):
+    """Hold an in-flight slot and a rate reservation during a LLM call.
+
+    The rate is taken first: a call sleeping until the next window holds no slot,
+    so the rate-limited background calls can't keep the interactive ones waiting.
+    """
+    start_time = time.time()
+    reservation = await take_llm_rate(project_id, priority, tokens)
+    async with llm_slot(project_id, priority):
+        telemetry_manager.record_histogram_metric(
+            HistogramMetricName.LLM_LIMITER_WAIT_MS,
+            (time.time() - start_time) * 1000,
+            {"priority": priority},
+        )
+        yield reservation
@@ -1,10 +1,11 @@
+from openai.types import CompletionUsage
 from .utils import exclude_special_kwargs, get_openai_async_client_instance
 from ..env import LOG
 
 
 async def openai_complete(
     model, prompt, system_prompt=None, history_messages=[], **kwargs
-) -> str:
+) -> tuple[str, CompletionUsage | None]:
     sp_args, kwargs = exclude_special_kwargs(kwargs)
     prompt_id = sp_args.get("prompt_id", None)
 
@@ -22,4 +23,4 @@ async def openai_complete(
     LOG.info(
         f"Cached {prompt_id} {model} {cached_tokens}/{response.usage.prompt_tokens}"
     )
-    return response.choices[0].message.content
+    return response.choices[0].message.content, response.usage
@@ -0,0 +1,92 @@
+"""Cache the LLM responses of stages that send the same prompt again.
+
+Opt-in per stage (the `prompt_id` of the prompt) with `llm_response_cache_ttl_s`,
+e.g. `tag_event` for the same event, the re-summary of an unchanged profile,
+or `/users/context` filtering the same chats twice. A response is keyed by
+everything that goes to the provider, so a hit is the answer to the exact
+same request. Pass `no_cache=True` to `llm_complete` to bypass it.
+"""
+
+import json
+import asyncio
+import hashlib
+from ..env import CONFIG, LOG, TelemetryKeyName
+from ..connectors import PROJECT_ID, get_redis_client
+from ..telemetry import telemetry_manager, CounterMetricName
+from ..telemetry.capture_key import capture_int_key
+
+
+def get_llm_response_cache_ttl(prompt_id: str | None) -> int:
+    if prompt_id is None:
+        return 0
+    return CONFIG.llm_response_cache_ttl_s.get(prompt_id, 0)
+
+
+def get_llm_response_cache_key(
+    project_id: str,
+    prompt_id: str,
+    model: str,
+    prompt: str,
+    system_prompt: str | None,
+    history_messages: list[dict],
+    max_tokens: int,
+    kwargs: dict,
+) -> str:
+    request = json.dumps(
+        [
+            CONFIG.llm_style,
+            model,
+            system_prompt,
+            history_messages,
+            prompt,
+            max_tokens,
+            # temperature, response_format (json_mode)...
+            sorted(kwargs.items()),
+        ],
+        ensure_ascii=False,
+        default=str,
+    )
+    request_hash = hashlib.sha256(request.encode()).hexdigest()
+    return f"memobase:llm_response:{PROJECT_ID}:{project_id}:{prompt_id}:{request_hash}"
+
+
+async def get_cached_llm_response(key: str, prompt_id: str) -> dict | None:
+    try:
+        async with get_redis_client() as redis_client:
+            cached = await redis_client.get(key)
+    except Exception as e:
+        LOG.error(f"Failed to read LLM response cache: {e}")
+        return None
+    telemetry_manager.increment_counter_metric(
+        CounterMetricName.LLM_RESPONSE_CACHE_LOOKUPS,
+        1,
+        {"stage": prompt_id, "result": "miss" if cached is None else "hit"},
+    )
+    return None if cached is None else json.loads(cached)
+
+
+async def set_cached_llm_response(
+    key: str, prompt_id: str, content: str, in_tokens: int, out_tokens: int
+):
+    if len(content) > CONFIG.llm_response_cache_max_chars:
+        return
+    cached = {"content": content, "in_tokens": in_tokens, "out_tokens": out_tokens}
+    try:
+        async with get_redis_client() as redis_client:
+            await redis_client.set(
+                key, json.dumps(cached), ex=get_llm_response_cache_ttl(prompt_id)
+            )
+    except Exception as e:
+        LOG.error(f"Failed to write LLM response cache: {e}")
+
+
+def record_saved_tokens(project_id: str, cached: dict):
+    saved = cached["in_tokens"] + cached["out_tokens"]
+    telemetry_manager.increment_counter_metric(
+        CounterMetricName.LLM_CACHED_TOKENS, saved, {"project_id": project_id}
+    )
+    asyncio.create_task(
+        capture_int_key(
+            TelemetryKeyName.llm_cached_tokens, saved, project_id=project_id
+        )
+    )
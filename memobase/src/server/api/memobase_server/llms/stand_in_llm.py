@@ -0,0 +1,124 @@
+"""A deterministic stand-in of the LLM, for benchmarks and tests without a provider.
+
+Set `llm_style: stand_in`. Each prompt of `prompts/` (by `prompt_id`) gets a
+canned answer in the format its parser expects, derived from the input so the
+same chats always give the same profiles. Every call sleeps a log-normal
+latency around `stand_in_llm_latency_ms`.
+"""
+
+import ast
+import asyncio
+import hashlib
+import json
+import random
+from openai.types import CompletionUsage
+from .utils import exclude_special_kwargs
+from ..env import CONFIG
+
+# (topic, sub_topic) pairs of the default profile topics
+STAND_IN_SLOTS = [
+    ("basic_info", "name"),
+    ("contact_info", "city"),
+    ("education", "school"),
+    ("work", "title"),
+    ("interest", "hobbies"),
+    ("interest", "foods"),
+    ("psychological", "emotional_state"),
+    ("life_event", "recent_events"),
+]
+
+
+async def sleep_stand_in_latency(median_ms: float):
+    if median_ms <= 0:
+        return
+    sigma = CONFIG.stand_in_latency_sigma
+    await asyncio.sleep(random.lognormvariate(0, sigma) * median_ms / 1000)
+
+
+def stable_hash(content: str) -> int:
+    return int.from_bytes(hashlib.blake2b(content.encode(), digest_size=8).digest())
+
+
+def last_line(content: str, max_chars: int = 80) -> str:
+    lines = [l.strip() for l in content.split("\n") if l.strip()]
+    return (lines[-1] if lines else "something")[:max_chars].replace("::", " ")
+
+
+def answer_extract(prompt: str) -> str:
+    h = stable_hash(prompt)
+    tab = CONFIG.llm_tab_separator
+    facts = []
+    for i in range(2):
+        topic, sub_topic = STAND_IN_SLOTS[(h + i * 3) % len(STAND_IN_SLOTS)]
+        facts.append(
+            f"- {topic}{tab}{sub_topic}{tab}{last_line(prompt)} ({h % 97 + i})"
+        )
+    return "\n".join(facts)
+
+
+def answer_merge_yolo(prompt: str) -> str:
+    try:
+        memos = ast.literal_eval(prompt.strip())
+    except (ValueError, SyntaxError):
+        return ""
+    tab = CONFIG.llm_tab_separator
+    answers = []
+    for m in memos:
+        if m.get("current_memo"):
+            memo = f"{m['current_memo']}; {m['new_info']}"[-200:]
+            answers.append(f"{m['memo_id']}. UPDATE{tab}{memo}")
+        else:
+            answers.append(f"{m['memo_id']}. APPEND{tab}APPEND")
+    return "---\n" + "\n".join(answers)
+
+
+def answer_merge(prompt: str) -> str:
+    return f"- APPEND{CONFIG.llm_tab_separator}APPEND"
+
+
+def answer_organize(prompt: str) -> str:
+    tab = CONFIG.llm_tab_separator
+    return f"- summary{tab}{last_line(prompt)}"
+
+
+def answer_pick_related(prompt: str) -> str:
+    memos = [l for l in prompt.split("\n") if l[:1].isdigit()]
+    ids = list(range(min(len(memos), 5)))
+    return json.dumps({"reason": "stand-in", "ids": ids})
+
+
+def answer_summary(prompt: str) -> str:
+    return prompt.strip()[:200]
+
+
+ANSWERS = {
+    "extract_profile": answer_extract,
+    "zh_extract_profile": answer_extract,
+    "merge_profile_yolo": answer_merge_yolo,
+    "zh_merge_profile_yolo": answer_merge_yolo,
+    "merge_profile": answer_merge,
+    "zh_merge_profile": answer_merge,
+    "organize_profile": answer_organize,
+    "pick_related_profiles": answer_pick_related,
+    "summary_profile": answer_summary,
+    "summary_entry_chats": answer_summary,
+    "zh_summary_entry_chats": answer_summary,
+    # no tags: the tagging prompt is compiled per project, there's nothing to echo
+    "event_tagging": lambda prompt: "",
+}
+
+
+async def stand_in_complete(
+    model, prompt, system_prompt=None, history_messages=[], **kwargs
+) -> tuple[str, CompletionUsage]:
+    sp_args, kwargs = exclude_special_kwargs(kwargs)
+    answer = ANSWERS.get(sp_args["prompt_id"], lambda prompt: "ok")(prompt)
+    await sleep_stand_in_latency(CONFIG.stand_in_llm_latency_ms)
+    # ~4 chars per token, the stand-in doesn't pay for an encoder
+    prompt_tokens = (len(prompt) + len(system_prompt or "")) // 4
+    completion_tokens = len(answer) // 4
+    return answer, CompletionUsage(
+        prompt_tokens=prompt_tokens,
+        completion_tokens=completion_tokens,
+        total_tokens=prompt_tokens + completion_tokens,
+    )
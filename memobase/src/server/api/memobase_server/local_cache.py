@@ -0,0 +1,118 @@
+"""In-process caches of per-project objects (secret, status, profile config).
+
+Every API/flush worker keeps its own copy, so the hot path of auth and config
+doesn't touch Redis or Postgres. A change of a project made by the server (its
+profile config) is broadcast through Redis pub/sub, every process then drops its
+local copy of that project. Entries also expire after `project_cache_ttl_s`,
+which bounds the staleness if a message is missed, and of the changes made
+outside of the server: a status change applies once the shared status key
+in Redis (1 hour) and the local copies have expired.
+"""
+
+import time
+import asyncio
+from collections import OrderedDict
+from typing import Any
+from .env import CONFIG, LOG
+from .connectors import PROJECT_ID, get_redis_client
+from .telemetry import telemetry_manager, CounterMetricName
+
+MISSING = object()
+
+
+class LocalTTLCache:
+    """A LRU cache whose entries expire after `ttl_s` seconds."""
+
+    def __init__(self, name: str, max_size: int, ttl_s: float):
+        self.name = name
+        self.max_size = max_size
+        self.ttl_s = ttl_s
+        self._data: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+
+    def get(self, key: str) -> Any:
+        item = self._data.get(key)
+        if item is None or item[0] < time.monotonic():
+            self._data.pop(key, None)
+            telemetry_manager.increment_counter_metric(
+                CounterMetricName.PROJECT_CACHE_LOOKUPS,
+                1,
+                {"cache": self.name, "result": "miss"},
+            )
+            return MISSING
+        self._data.move_to_end(key)
+        telemetry_manager.increment_counter_metric(
+            CounterMetricName.PROJECT_CACHE_LOOKUPS,
+            1,
+            {"cache": self.name, "result": "hit"},
+        )
+        return item[1]
+
+    def set(self, key: str, value: Any):
+        self._data[key] = (time.monotonic() + self.ttl_s, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def pop(self, key: str):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+
+PROJECT_SECRETS = LocalTTLCache(
+    "project_secret", CONFIG.project_cache_max_size, CONFIG.project_cache_ttl_s
+)
+PROJECT_STATUSES = LocalTTLCache(
+    "project_status", CONFIG.project_cache_max_size, CONFIG.project_cache_ttl_s
+)
+PROJECT_PROFILE_CONFIGS = LocalTTLCache(
+    "project_profile_config",
+    CONFIG.project_cache_max_size,
+    CONFIG.project_cache_ttl_s,
+)
+PROJECT_CACHES = [PROJECT_SECRETS, PROJECT_STATUSES, PROJECT_PROFILE_CONFIGS]
+
+
+def get_project_invalidation_channel() -> str:
+    return f"memobase:project_invalidation:{PROJECT_ID}"
+
+
+def drop_local_project_cache(project_id: str):
+    for cache in PROJECT_CACHES:
+        cache.pop(project_id)
+
+
+def clear_local_project_cache():
+    for cache in PROJECT_CACHES:
+        cache.clear()
+
+
+async def publish_project_invalidation(project_id: str):
+    """Drop the cached objects of the project in this process and all the others."""
+    drop_local_project_cache(project_id)
+    async with get_redis_client() as redis_client:
+        await redis_client.publish(get_project_invalidation_channel(), project_id)
+
+
+async def listen_project_invalidation(
+    stop_event: asyncio.Event, poll_timeout_s: float = 1, retry_delay_s: float = 1
+):
+    """Drop the local copy of the projects published by other processes."""
+    while not stop_event.is_set():
+        try:
+            async with get_redis_client() as redis_client:
+                async with redis_client.pubsub() as pubsub:
+                    await pubsub.subscribe(get_project_invalidation_channel())
+                    # Messages are lost while not subscribed, don't trust the old entries
+                    clear_local_project_cache()
+                    while not stop_event.is_set():
+                        message = await pubsub.get_message(
+                            ignore_subscribe_messages=True, timeout=poll_timeout_s
+                        )
+                        if message is not None:
+                            drop_local_project_cache(message["data"])
+        except Exception as e:
+            LOG.error(f"[project cache] Invalidation listener error: {e}")
+            clear_local_project_cache()
+            await asyncio.sleep(retry_delay_s)
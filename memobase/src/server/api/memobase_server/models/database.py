@@ -15,6 +15,8 @@ from sqlalchemy import (
     Boolean,
     PrimaryKeyConstraint,
     ForeignKeyConstraint,
+    literal,
+    literal_column,
 )
 from dataclasses import dataclass
 from sqlalchemy.dialects.postgresql import JSONB, UUID
@@ -99,6 +101,93 @@ def check_legal_embedding_dim(cls, session):
         raise e
 
 
+# pgvector can't build HNSW indexes on `vector` columns of more dimensions
+HNSW_MAX_DIM = 2000
+
+
+def embedding_hnsw_indexes(table_name: str) -> list[Index]:
+    """The ANN index of the `embedding` column, for cosine distance searches."""
+    if CONFIG.embedding_dim > HNSW_MAX_DIM:
+        return []
+    return [
+        Index(
+            f"idx_{table_name}_embedding_hnsw",
+            "embedding",
+            postgresql_using="hnsw",
+            postgresql_with={
+                "m": CONFIG.vector_index_m,
+                "ef_construction": CONFIG.vector_index_ef_construction,
+            },
+            postgresql_ops={"embedding": "vector_cosine_ops"},
+        )
+    ]
+
+
+def timeline_indexes(table_name: str) -> list[Index]:
+    """The rows of a user by time, for the latest rows of a time range.
+
+    Serves `created_at > now() - interval ORDER BY created_at DESC LIMIT k` without a sort.
+    """
+    return [
+        Index(
+            f"idx_{table_name}_project_id_user_id_created_at",
+            "project_id",
+            "user_id",
+            text("created_at DESC"),
+        )
+    ]
+
+
+def event_tags_indexes(table_name: str) -> list[Index]:
+    """The events by their tags, for `@>` containment on `event_data -> 'event_tags'`.
+
+    Only queries on the same expression (`UserEvent.event_tags()`) can use it.
+    """
+    return [
+        Index(
+            f"idx_{table_name}_event_tags",
+            text("(event_data -> 'event_tags') jsonb_path_ops"),
+            postgresql_using="gin",
+        )
+    ]
+
+
+def event_primary_key() -> PrimaryKeyConstraint:
+    """A partitioned table needs its partition key in the primary key."""
+    if CONFIG.event_partitioning:
+        return PrimaryKeyConstraint("id", "project_id", "created_at")
+    return PrimaryKeyConstraint("id", "project_id")
+
+
+def event_partition_options() -> dict:
+    """Monthly partitions by `created_at`, created by `maintain_event_partitions`."""
+    if CONFIG.event_partitioning:
+        return {"postgresql_partition_by": "RANGE (created_at)"}
+    return {}
+
+
+def event_gist_event_fks() -> list[ForeignKeyConstraint]:
+    # a foreign key to a partitioned table must include its partition key,
+    # the gists of a deleted event are then only deleted by the ORM cascade
+    if CONFIG.event_partitioning:
+        return []
+    return [
+        ForeignKeyConstraint(
+            ["event_id", "project_id"],
+            ["user_events.id", "user_events.project_id"],
+            ondelete="CASCADE",
+            onupdate="CASCADE",
+        )
+    ]
+
+
+# the gists of an event, with or without the foreign key
+EVENT_GISTS_JOIN = (
+    "and_(UserEvent.id == foreign(UserEventGist.event_id), "
+    "UserEvent.project_id == foreign(UserEventGist.project_id))"
+)
+
+
 @dataclass
 class Base:
     __abstract__ = True
@@ -393,6 +482,19 @@ class BufferZone(Base):
             "blob_type",
             "status",
         ),
+        # idle buffers by age, for the idle flush scheduler
+        Index("idx_buffer_zones_status_created_at", "status", "created_at"),
+        # the idle buffers of a user, without the done/failed rows until compacted
+        Index(
+            "idx_buffer_zones_idle_user_id_blob_type",
+            "user_id",
+            "project_id",
+            "blob_type",
+            "created_at",
+            postgresql_where=text(f"status = '{BufferStatus.idle}'"),
+        ),
+        # the buffers of a blob, for its cascade delete
+        Index("idx_buffer_zones_blob_id_project_id", "blob_id", "project_id"),
         ForeignKeyConstraint(
             ["user_id", "project_id"],
             ["users.id", "users.project_id"],
@@ -414,6 +516,13 @@ class BufferZone(Base):
         ), f"Invalid blob type: {self.blob_type}"
         self.blob_type = self.blob_type.value
 
+    @classmethod
+    def has_status(cls, status: str):
+        """`status = '<status>'` inlined in the SQL, so the planner can match
+        the partial index of idle buffers, which a bound parameter can't.
+        """
+        return cls.status == literal(status, literal_execute=True)
+
 
 @REG.mapped_as_dataclass
 class UserProfile(Base):
@@ -435,6 +544,16 @@ class UserProfile(Base):
         default=DEFAULT_PROJECT_ID,
     )
 
+    # tokens of the profile line in the context, NULL for rows written before it
+    token_size: Mapped[Optional[int]] = mapped_column(
+        Integer, nullable=True, default=None
+    )
+
+    # embedding of the profile line, NULL for rows written before it
+    embedding: Mapped[Vector] = mapped_column(
+        Vector(dim=CONFIG.embedding_dim), nullable=True, default=None
+    )
+
     user: Mapped[User] = relationship(
         "User",
         back_populates="related_user_profiles",
@@ -454,6 +573,11 @@ class UserProfile(Base):
         ),
     )
 
+    @classmethod
+    def check_legal_embedding_dim(cls, session):
+        check_legal_embedding_dim(cls, session)
+        LOG.info("UserProfile embedding dimension checked")
+
 
 @REG.mapped_as_dataclass
 class UserEvent(Base):
@@ -491,18 +615,23 @@ class UserEvent(Base):
         cascade="all, delete-orphan",
         init=False,
         overlaps="related_user_event_gists",
+        primaryjoin=EVENT_GISTS_JOIN,
     )
 
     __table_args__ = (
-        PrimaryKeyConstraint("id", "project_id"),
+        event_primary_key(),
         Index("idx_user_events_user_id_project_id", "user_id", "project_id"),
         Index("idx_user_events_user_id_id_project_id", "user_id", "project_id", "id"),
+        *timeline_indexes("user_events"),
+        *event_tags_indexes("user_events"),
+        *embedding_hnsw_indexes("user_events"),
         ForeignKeyConstraint(
             ["user_id", "project_id"],
             ["users.id", "users.project_id"],
             ondelete="CASCADE",
             onupdate="CASCADE",
         ),
+        event_partition_options(),
     )
 
     @classmethod
@@ -510,6 +639,13 @@ class UserEvent(Base):
         check_legal_embedding_dim(cls, session)
         LOG.info("UserEvent embedding dimension checked")
 
+    @classmethod
+    def event_tags(cls):
+        """`event_data -> 'event_tags'`, the expression of the event tags index."""
+        return cls.event_data.op("->", return_type=JSONB)(
+            literal_column("'event_tags'")
+        )
+
 
 @REG.mapped_as_dataclass
 class UserEventGist(Base):
@@ -538,8 +674,8 @@ class UserEventGist(Base):
         "UserEvent",
         back_populates="related_user_event_gists",
         init=False,
-        foreign_keys=[event_id, project_id],
         overlaps="related_user_event_gists",
+        primaryjoin=EVENT_GISTS_JOIN,
     )
 
     user: Mapped[User] = relationship(
@@ -554,8 +690,13 @@ class UserEventGist(Base):
         Vector(dim=CONFIG.embedding_dim), nullable=True, default=None
     )
 
+    # tokens of the gist content, NULL for rows written before it
+    token_size: Mapped[Optional[int]] = mapped_column(
+        Integer, nullable=True, default=None
+    )
+
     __table_args__ = (
-        PrimaryKeyConstraint("id", "project_id"),
+        event_primary_key(),
         Index("idx_user_event_gists_user_id_project_id", "user_id", "project_id"),
         Index(
             "idx_user_event_gists_user_id_project_id_id", "user_id", "project_id", "id"
@@ -566,18 +707,16 @@ class UserEventGist(Base):
             "project_id",
             "event_id",
         ),
+        *timeline_indexes("user_event_gists"),
+        *embedding_hnsw_indexes("user_event_gists"),
         ForeignKeyConstraint(
             ["user_id", "project_id"],
             ["users.id", "users.project_id"],
             ondelete="CASCADE",
             onupdate="CASCADE",
         ),
-        ForeignKeyConstraint(
-            ["event_id", "project_id"],
-            ["user_events.id", "user_events.project_id"],
-            ondelete="CASCADE",
-            onupdate="CASCADE",
-        ),
+        *event_gist_event_fks(),
+        event_partition_options(),
     )
 
     @classmethod
@@ -81,6 +81,9 @@ class ProfileData(BaseModel):
         None,
         description="User profile attributes in JSON, containing 'topic', 'sub_topic'",
     )
+    token_size: Optional[int] = Field(
+        None, description="Token size of the profile in the user context"
+    )
 
 
 class ProfileDelta(BaseModel):
@@ -118,6 +121,9 @@ class UserEventGistData(BaseModel):
         None, description="Timestamp when the event gist was last updated"
     )
     similarity: Optional[float] = Field(None, description="Similarity score")
+    token_size: Optional[int] = Field(
+        None, description="Token size of the event gist content"
+    )
 
 
 class UserEventData(BaseModel):
@@ -228,6 +234,18 @@ class UserContextImport(BaseModel):
     )
 
 
+class UserBlobData(BlobData):
+    user_id: UUID = Field(..., description="The ID of the user this blob belongs to")
+
+
+class BlobsInsertData(BaseModel):
+    blobs: list[UserBlobData] = Field(
+        ...,
+        max_length=1000,
+        description="The blobs to insert, can be of different users, at most 1000 per request",
+    )
+
+
 class ProjectUsersData(BaseModel):
     users: list = Field(..., description="The user list")
     count: int = Field(0, description="The user count")
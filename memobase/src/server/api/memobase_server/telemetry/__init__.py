@@ -1,3 +1,13 @@
-from .open_telemetry import telemetry_manager, CounterMetricName, HistogramMetricName
+from .open_telemetry import (
+    telemetry_manager,
+    CounterMetricName,
+    HistogramMetricName,
+    GaugeMetricName,
+)
 
-__all__ = ["telemetry_manager", "CounterMetricName", "HistogramMetricName"]
+__all__ = [
+    "telemetry_manager",
+    "CounterMetricName",
+    "HistogramMetricName",
+    "GaugeMetricName",
+]
@@ -19,19 +19,39 @@ def head_key(project_id: str):
     return f"memobase_telemetry::{PROJECT_ID}::{project_id}"
 
 
+def int_key(name: str, project_id: str, date: str) -> str:
+    return f"{head_key(project_id)}::{name}::{date}"
+
+
 async def capture_int_key(
     name: str,
     value: int = 1,
     expire_days: int = 14,
     project_id: str = DEFAULT_PROJECT_ID,
 ):
-    key = f"{head_key(project_id)}::{name}::{date_key()}"
-    key_month = f"{head_key(project_id)}::{name}::{month_key()}"
+    await capture_int_keys([(name, value, project_id)], expire_days=expire_days)
+
+
+async def capture_int_keys(
+    values: list[tuple[str, int, str]],
+    expire_days: int = 14,
+    atomic: bool = False,
+):
+    """Add the (name, value, project_id) values in one round trip.
+
+    If `atomic`, in one MULTI: a failed call added none of them and can be retried.
+    """
+    day, month = date_key(), month_key()
     async with get_redis_client() as r_c:
-        await r_c.incrby(key, value)
-        await r_c.incrby(key_month, value)
-        await r_c.expire(key, expire_days * 24 * 60 * 60)
-        await r_c.expire(key_month, 30 * expire_days * 24 * 60 * 60)
+        async with r_c.pipeline(transaction=atomic) as pipe:
+            for name, value, project_id in values:
+                key = int_key(name, project_id, day)
+                key_month = int_key(name, project_id, month)
+                pipe.incrby(key, value)
+                pipe.incrby(key_month, value)
+                pipe.expire(key, expire_days * 24 * 60 * 60)
+                pipe.expire(key_month, 30 * expire_days * 24 * 60 * 60)
+            await pipe.execute()
 
 
 async def get_int_key(
@@ -41,14 +61,24 @@ async def get_int_key(
     use_date: str = None,
 ) -> int:
     if in_month:
-        key = f"{head_key(project_id)}::{name}::{month_key()}"
+        key = int_key(name, project_id, month_key())
     else:
-        using_date = use_date or date_key()
-        key = f"{head_key(project_id)}::{name}::{using_date}"
+        key = int_key(name, project_id, use_date or date_key())
     async with get_redis_client() as r_c:
         return int((await r_c.get(key)) or 0)
 
 
+async def get_int_keys(
+    names: list[str], project_id: str, use_dates: list[str]
+) -> list[dict[str, int]]:
+    """The values of `names` on each of `use_dates`, with one MGET."""
+    keys = [int_key(n, project_id, d) for d in use_dates for n in names]
+    async with get_redis_client() as r_c:
+        values = await r_c.mget(keys)
+    values = iter(int(v or 0) for v in values)
+    return [{n: next(values) for n in names} for _ in use_dates]
+
+
 if __name__ == "__main__":
     import asyncio
 
@@ -1,6 +1,7 @@
 from enum import Enum
 from typing import Dict
 import os
+import errno
 import socket
 from prometheus_client import start_http_server
 from opentelemetry import metrics
@@ -36,6 +37,14 @@ class CounterMetricName(Enum):
     LLM_TOKENS_INPUT = "llm_input_tokens_total"
     LLM_TOKENS_OUTPUT = "llm_output_tokens_total"
     EMBEDDING_TOKENS = "embedding_tokens_total"
+    FLUSH_TASKS_RECLAIMED = "flush_tasks_reclaimed_total"
+    PROFILE_CACHE_LOOKUPS = "profile_cache_lookups_total"
+    PROJECT_CACHE_LOOKUPS = "project_cache_lookups_total"
+    QUERY_EMBEDDING_CACHE_LOOKUPS = "query_embedding_cache_lookups_total"
+    LLM_RESPONSE_CACHE_LOOKUPS = "llm_response_cache_lookups_total"
+    LLM_CACHED_TOKENS = "llm_cached_tokens_total"
+    CONTEXT_CACHE_LOOKUPS = "context_cache_lookups_total"
+    COMPACTION_ROWS_DELETED = "compaction_rows_deleted_total"
 
     def get_description(self) -> str:
         """Get the description for this metric."""
@@ -46,6 +55,14 @@ class CounterMetricName(Enum):
             CounterMetricName.LLM_TOKENS_INPUT: "Total number of input tokens",
             CounterMetricName.LLM_TOKENS_OUTPUT: "Total number of output tokens",
             CounterMetricName.EMBEDDING_TOKENS: "Total number of embedding tokens",
+            CounterMetricName.FLUSH_TASKS_RECLAIMED: "Total number of buffer flush tasks reclaimed from dead workers or expired leases",
+            CounterMetricName.PROFILE_CACHE_LOOKUPS: "Total number of user profiles cache lookups, by result (hit/miss)",
+            CounterMetricName.PROJECT_CACHE_LOOKUPS: "Total number of in-process project cache lookups, by cache and result (hit/miss)",
+            CounterMetricName.QUERY_EMBEDDING_CACHE_LOOKUPS: "Total number of query embedding cache lookups, by result (local/redis/miss)",
+            CounterMetricName.LLM_RESPONSE_CACHE_LOOKUPS: "Total number of LLM response cache lookups, by stage and result (hit/miss)",
+            CounterMetricName.LLM_CACHED_TOKENS: "Total number of LLM tokens served from the response cache",
+            CounterMetricName.CONTEXT_CACHE_LOOKUPS: "Total number of user context cache lookups, by result (not_modified/hit/miss)",
+            CounterMetricName.COMPACTION_ROWS_DELETED: "Total number of rows deleted by the compaction, by table and kind (buffer status or blob type)",
         }
         return descriptions[self]
 
@@ -60,6 +77,10 @@ class HistogramMetricName(Enum):
     LLM_LATENCY_MS = "llm_latency"
     EMBEDDING_LATENCY_MS = "embedding_latency"
     REQUEST_LATENCY_MS = "request_latency"
+    FLUSH_QUEUE_LAG_MS = "flush_queue_lag"
+    EMBEDDING_BATCH_SIZE = "embedding_batch_size"
+    EMBEDDING_QUEUE_DELAY_MS = "embedding_queue_delay"
+    LLM_LIMITER_WAIT_MS = "llm_limiter_wait"
 
     def get_description(self) -> str:
         """Get the description for this metric."""
@@ -67,9 +88,19 @@ class HistogramMetricName(Enum):
             HistogramMetricName.LLM_LATENCY_MS: "Latency of the LLM in milliseconds",
             HistogramMetricName.EMBEDDING_LATENCY_MS: "Latency of the embedding in milliseconds",
             HistogramMetricName.REQUEST_LATENCY_MS: "Latency of the request in milliseconds",
+            HistogramMetricName.FLUSH_QUEUE_LAG_MS: "Time a buffer flush task waited in the queue in milliseconds",
+            HistogramMetricName.EMBEDDING_BATCH_SIZE: "Number of texts per batched document embedding request",
+            HistogramMetricName.EMBEDDING_QUEUE_DELAY_MS: "Time a document embedding request waited for its batch in milliseconds",
+            HistogramMetricName.LLM_LIMITER_WAIT_MS: "Time a LLM call waited for the limiter in milliseconds, by priority",
         }
         return descriptions[self]
 
+    def get_unit(self) -> str:
+        """Get the unit of this metric."""
+        if self == HistogramMetricName.EMBEDDING_BATCH_SIZE:
+            return "1"
+        return "ms"
+
     def get_metric_name(self) -> str:
         """Get the full metric name with prefix."""
         return f"memobase_server_{self.value}"
@@ -80,12 +111,20 @@ class GaugeMetricName(Enum):
 
     INPUT_TOKEN_COUNT = "input_token_count_per_call"
     OUTPUT_TOKEN_COUNT = "output_token_count_per_call"
+    FLUSH_QUEUE_DEPTH = "flush_queue_depth"
+    DB_POOL_CHECKED_OUT = "db_pool_checked_out"
+    TABLE_SIZE_BYTES = "table_size_bytes"
+    TABLE_ROWS_ESTIMATE = "table_rows_estimate"
 
     def get_description(self) -> str:
         """Get the description for this metric."""
         descriptions = {
             GaugeMetricName.INPUT_TOKEN_COUNT: "Number of input tokens per call",
             GaugeMetricName.OUTPUT_TOKEN_COUNT: "Number of output tokens per call",
+            GaugeMetricName.FLUSH_QUEUE_DEPTH: "Number of buffer flush tasks waiting in the queue",
+            GaugeMetricName.DB_POOL_CHECKED_OUT: "Number of DB connections checked out of the pool of this process",
+            GaugeMetricName.TABLE_SIZE_BYTES: "Size of a compacted table with its indexes in bytes, by table",
+            GaugeMetricName.TABLE_ROWS_ESTIMATE: "Estimated number of rows of a compacted table, by table",
         }
         return descriptions[self]
 
@@ -128,7 +167,7 @@ class TelemetryManager:
         try:
             start_http_server(self._prometheus_port)
         except OSError as e:
-            if e.errno == 48:  # Address already in use
+            if e.errno == errno.EADDRINUSE:
                 LOG.warning(
                     f"Prometheus HTTP server already running on port {self._prometheus_port}"
                 )
@@ -174,7 +213,7 @@ class TelemetryManager:
         for metric in HistogramMetricName:
             self._metrics[metric] = self._meter.create_histogram(
                 metric.get_metric_name(),
-                unit="ms",
+                unit=metric.get_unit(),
                 description=metric.get_description(),
             )
 
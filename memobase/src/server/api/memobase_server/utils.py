@@ -1,6 +1,9 @@
 import re
 import yaml
 import json
+import asyncio
+import hashlib
+from collections import OrderedDict
 from typing import cast
 from datetime import timezone, datetime
 from functools import wraps
@@ -41,6 +44,16 @@ def event_str_repr(event: UserEventData) -> str:
         return f"{event_tags}\n{event_data.event_tip}"
 
 
+def profile_str_repr(content: str, attributes: dict | None) -> str:
+    attributes = attributes or {}
+    return f"{attributes.get('topic')}::{attributes.get('sub_topic')}: {content}"
+
+
+def pack_latest_chat(chats: list[OpenAICompatibleMessage], chat_num: int = 3) -> str:
+    """The search query of the latest chats, shared by the profiles and events."""
+    return "\n".join([f"{m.content}" for m in chats[-chat_num:]])
+
+
 def event_embedding_str(event_data: EventData) -> str:
     if event_data.profile_delta is None:
         profile_delta_str = ""
@@ -98,6 +111,80 @@ def truncate_string(content: str, max_tokens: int) -> str:
     return get_decoded_tokens(tokens[:max_tokens]) + tailing
 
 
+# content hash -> token length, in LRU order
+TOKEN_LENGTHS: OrderedDict[bytes, int] = OrderedDict()
+
+
+def get_content_hash(content: str) -> bytes:
+    return hashlib.blake2b(content.encode(), digest_size=16).digest()
+
+
+def get_cached_token_length(key: bytes) -> int | None:
+    length = TOKEN_LENGTHS.get(key)
+    if length is not None:
+        TOKEN_LENGTHS.move_to_end(key)
+    return length
+
+
+def set_cached_token_length(key: bytes, length: int):
+    TOKEN_LENGTHS[key] = length
+    while len(TOKEN_LENGTHS) > CONFIG.token_length_cache_size:
+        TOKEN_LENGTHS.popitem(last=False)
+
+
+def get_token_length(content: str) -> int:
+    """Token length of the content, use it instead of `len(get_encoded_tokens(...))`."""
+    key = get_content_hash(content)
+    length = get_cached_token_length(key)
+    if length is None:
+        length = len(ENCODER.encode(content))
+        set_cached_token_length(key, length)
+    return length
+
+
+def get_token_lengths(contents: list[str]) -> list[int]:
+    """Token lengths of the contents, the uncached ones are encoded in one batch."""
+    keys = [get_content_hash(c) for c in contents]
+    lengths = [get_cached_token_length(k) for k in keys]
+    missing = [i for i, length in enumerate(lengths) if length is None]
+    if missing:
+        encoded = ENCODER.encode_batch([contents[i] for i in missing])
+        for i, tokens in zip(missing, encoded):
+            lengths[i] = len(tokens)
+            set_cached_token_length(keys[i], lengths[i])
+    return lengths
+
+
+async def aget_token_length(content: str) -> int:
+    """Same as `get_token_length`, large contents are encoded in a worker thread."""
+    if len(content) <= CONFIG.token_length_offload_chars:
+        return get_token_length(content)
+    key = get_content_hash(content)
+    length = get_cached_token_length(key)
+    if length is None:
+        # tiktoken releases the GIL while encoding
+        length = len(await asyncio.to_thread(ENCODER.encode, content))
+        set_cached_token_length(key, length)
+    return length
+
+
+async def aget_token_lengths(contents: list[str]) -> list[int]:
+    """Same as `get_token_lengths`, large batches are encoded in a worker thread."""
+    if sum(len(c) for c in contents) <= CONFIG.token_length_offload_chars:
+        return get_token_lengths(contents)
+    keys = [get_content_hash(c) for c in contents]
+    lengths = [get_cached_token_length(k) for k in keys]
+    missing = [i for i, length in enumerate(lengths) if length is None]
+    if missing:
+        encoded = await asyncio.to_thread(
+            ENCODER.encode_batch, [contents[i] for i in missing]
+        )
+        for i, tokens in zip(missing, encoded):
+            lengths[i] = len(tokens)
+            set_cached_token_length(keys[i], lengths[i])
+    return lengths
+
+
 def pack_blob_from_db(blob: GeneralBlob, blob_type: BlobType) -> Blob:
     blob_data = blob.blob_data
     match blob_type:
@@ -151,7 +238,15 @@ def get_blob_str(blob: Blob):
 
 
 def get_blob_token_size(blob: Blob):
-    return len(get_encoded_tokens(get_blob_str(blob)))
+    return get_token_length(get_blob_str(blob))
+
+
+async def aget_blob_token_size(blob: Blob) -> int:
+    return await aget_token_length(get_blob_str(blob))
+
+
+async def aget_blob_token_sizes(blobs: list[Blob]) -> list[int]:
+    return await aget_token_lengths([get_blob_str(b) for b in blobs])
 
 
 def seconds_from_now(dt: datetime):
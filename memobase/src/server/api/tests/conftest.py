@@ -2,6 +2,7 @@ import pytest
 import pytest_asyncio
 from api import app
 from memobase_server.env import CONFIG
+from memobase_server.connectors import ASYNC_DB_ENGINE
 from fastapi.testclient import TestClient
 
 PREFIX = "/api/v1"
@@ -30,6 +31,9 @@ async def db_env():
     response = client.get(f"{PREFIX}/healthcheck")
     d = response.json()
     if response.status_code == 200 and d["errno"] == 0:
+        # TestClient runs on its own event loop, asyncpg connections can't be shared
+        await ASYNC_DB_ENGINE.dispose(close=False)
         yield
+        await ASYNC_DB_ENGINE.dispose(close=False)
     else:
         pytest.skip("Database not available")
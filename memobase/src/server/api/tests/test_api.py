@@ -9,6 +9,7 @@ from memobase_server.models.database import DEFAULT_PROJECT_ID
 from memobase_server.models.blob import BlobType
 import numpy as np
 from memobase_server.env import CONFIG
+from memobase_server.models.utils import Promise
 
 PREFIX = "/api/v1"
 TOKEN = os.getenv("ACCESS_TOKEN")
@@ -93,12 +94,14 @@ def mock_event_get_embedding():
     with patch(
         "memobase_server.controllers.event.get_embedding"
     ) as mock_event_get_embedding:
-        async_mock = AsyncMock()
-        async_mock.ok = Mock(return_value=True)
-        async_mock.data = Mock(
-            return_value=np.array([[0.1 for _ in range(CONFIG.embedding_dim)]])
-        )
-        mock_event_get_embedding.return_value = async_mock
+
+        # one row per text, the event and its gists are embedded together
+        async def get_embedding(project_id, texts, **kwargs):
+            return Promise.resolve(
+                np.array([[0.1 for _ in range(CONFIG.embedding_dim)] for _ in texts])
+            )
+
+        mock_event_get_embedding.side_effect = get_embedding
         yield mock_event_get_embedding
 
 
@@ -126,12 +126,14 @@ def mock_event_get_embedding():
     with patch(
         "memobase_server.controllers.event.get_embedding"
     ) as mock_event_get_embedding:
-        async_mock = AsyncMock()
-        async_mock.ok = Mock(return_value=True)
-        async_mock.data = Mock(
-            return_value=np.array([[0.1 for _ in range(CONFIG.embedding_dim)]])
-        )
-        mock_event_get_embedding.return_value = async_mock
+
+        # one row per text, the event and its gists are embedded together
+        async def get_embedding(project_id, texts, **kwargs):
+            return Promise.resolve(
+                np.array([[0.1 for _ in range(CONFIG.embedding_dim)] for _ in texts])
+            )
+
+        mock_event_get_embedding.side_effect = get_embedding
         yield mock_event_get_embedding
 
 
@@ -369,3 +371,37 @@ async def test_chat_organize_modal(
     assert mock_extract_llm_complete.await_count == 1
     assert mock_merge_llm_complete.await_count == 1
     assert mock_organize_llm_complete.await_count == 1
+
+
+def test_compiled_profile_config():
+    from memobase_server.env import ProfileConfig
+    from memobase_server.controllers.modal.chat.utils import (
+        get_compiled_profile_config,
+    )
+
+    config_str = """
+language: en
+profile_strict_mode: true
+overwrite_user_profiles:
+  - topic: interest
+    sub_topics:
+      - name: foods
+event_tags:
+  - name: mood
+    description: the user's mood
+"""
+    compiled = get_compiled_profile_config(
+        ProfileConfig.load_config_string(config_str)
+    )
+    # same config content, same object and byte-identical prompts
+    assert compiled is get_compiled_profile_config(
+        ProfileConfig.load_config_string(config_str)
+    )
+    assert compiled.allowed_topic_subtopics == {("interest", "foods")}
+    assert compiled.available_event_tags == {"mood"}
+    assert "- mood(the user's mood)" in compiled.event_tagging_system_prompt
+    assert "interest" in compiled.extract_system_prompt
+
+    other = get_compiled_profile_config(ProfileConfig())
+    assert other is not compiled
+    assert other.strict_mode == CONFIG.profile_strict_mode
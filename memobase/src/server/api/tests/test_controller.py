@@ -1,11 +1,17 @@
+import json
+import time
+import random
+import asyncio
 import pytest
 import numpy as np
-from unittest.mock import patch, AsyncMock, Mock
+from unittest.mock import patch, AsyncMock
 from memobase_server.env import CONFIG
 from memobase_server.controllers import full as controllers
 from memobase_server.models import response as res
 from memobase_server.models.blob import BlobType
 from memobase_server.models.database import DEFAULT_PROJECT_ID
+from memobase_server.connectors import get_redis_client
+from memobase_server.models.utils import Promise
 
 
 @pytest.fixture
@@ -13,12 +19,14 @@ def mock_event_get_embedding():
     with patch(
         "memobase_server.controllers.event.get_embedding"
     ) as mock_event_get_embedding:
-        async_mock = AsyncMock()
-        async_mock.ok = Mock(return_value=True)
-        async_mock.data = Mock(
-            return_value=np.array([[0.1 for _ in range(CONFIG.embedding_dim)]])
-        )
-        mock_event_get_embedding.return_value = async_mock
+
+        # one row per text, the event and its gists are embedded together
+        async def get_embedding(project_id, texts, **kwargs):
+            return Promise.resolve(
+                np.array([[0.1 for _ in range(CONFIG.embedding_dim)] for _ in texts])
+            )
+
+        mock_event_get_embedding.side_effect = get_embedding
         yield mock_event_get_embedding
 
 
@@ -268,7 +276,7 @@ async def test_filter_user_events(db_env, mock_event_get_embedding):
         assert p.ok()
         event_ids.append(p.data())
 
-    assert mock_event_get_embedding.await_count == len(test_events) * 2
+    assert mock_event_get_embedding.await_count == len(test_events)
     # Test 1: Filter by tag existence - events that have 'emotion' tag
     p = await controllers.event.filter_user_events(
         u_id, DEFAULT_PROJECT_ID, has_event_tag=["emotion"]
@@ -449,8 +457,1430 @@ async def test_filter_user_events_edge_cases(db_env, mock_event_get_embedding):
     events = p.data().events
     assert len(events) == 0
 
-    assert mock_event_get_embedding.await_count == 2 * 2
+    assert mock_event_get_embedding.await_count == 2
 
     # Cleanup
     p = await controllers.user.delete_user(u_id, DEFAULT_PROJECT_ID)
     assert p.ok()
+
+
+async def pop_user_flush_tasks(user_id: str) -> list[str]:
+    bg = controllers.buffer_background
+    async with get_redis_client() as redis_client:
+        tasks = await redis_client.lrange(bg.get_flush_queue_key(), 0, -1)
+        tasks = [t for t in tasks if str(user_id) in t]
+        for t in tasks:
+            await redis_client.lrem(bg.get_flush_queue_key(), 1, t)
+    return tasks
+
+
+@pytest.mark.asyncio
+async def test_flush_queue_reclaim(db_env):
+    bg = controllers.buffer_background
+    p = await controllers.user.create_user(res.UserData(), DEFAULT_PROJECT_ID)
+    assert p.ok()
+    u_id = p.data().id
+
+    blob = res.BlobData(
+        blob_type=BlobType.chat,
+        blob_data={"messages": [{"role": "user", "content": "Hello world"}]},
+    )
+    p = await controllers.blob.insert_blob(u_id, DEFAULT_PROJECT_ID, blob)
+    assert p.ok()
+    p = await controllers.buffer.insert_blob_to_buffer(
+        u_id, DEFAULT_PROJECT_ID, p.data().id, blob.to_blob()
+    )
+    assert p.ok()
+    p = await controllers.buffer.get_unprocessed_buffer_ids(
+        u_id, DEFAULT_PROJECT_ID, BlobType.chat
+    )
+    buffer_ids = p.data().ids
+    assert len(buffer_ids) == 1
+
+    await bg.flush_buffer_by_ids_in_background(
+        u_id, DEFAULT_PROJECT_ID, BlobType.chat, buffer_ids
+    )
+    p = await controllers.buffer.get_unprocessed_buffer_ids(
+        u_id, DEFAULT_PROJECT_ID, BlobType.chat, select_status="processing"
+    )
+    assert p.data().ids == buffer_ids
+
+    # A worker took the task and died before ack
+    (task,) = await pop_user_flush_tasks(u_id)
+    dead_worker_id = "test-dead-worker"
+    async with get_redis_client() as redis_client:
+        await redis_client.sadd(bg.get_flush_workers_key(), dead_worker_id)
+        await redis_client.rpush(bg.get_flush_processing_key(dead_worker_id), task)
+    assert await bg.reclaim_dead_workers() >= 1
+    assert await pop_user_flush_tasks(u_id) == [task]
+
+    # The task is lost, the buffers are re-queued after the lease
+    assert await bg.reclaim_expired_buffers(lease_s=0) >= 1
+    (task,) = await pop_user_flush_tasks(u_id)
+    assert json.loads(task)["buffer_ids"] == [str(i) for i in buffer_ids]
+
+    p = await controllers.user.delete_user(u_id, DEFAULT_PROJECT_ID)
+    assert p.ok()
+
+
+@pytest.mark.asyncio
+async def test_reclaim_skips_queued_tasks(db_env):
+    from sqlalchemy import update, func
+    from datetime import timedelta
+    from memobase_server.connectors import AsyncSession
+    from memobase_server.models.database import BufferZone
+
+    bg = controllers.buffer_background
+    p = await controllers.user.create_user(res.UserData(), DEFAULT_PROJECT_ID)
+    assert p.ok()
+    u_id = p.data().id
+    blob = res.BlobData(
+        blob_type=BlobType.chat,
+        blob_data={"messages": [{"role": "user", "content": "queued for long"}]},
+    )
+    p = await controllers.blob.insert_blob(u_id, DEFAULT_PROJECT_ID, blob)
+    assert p.ok()
+    p = await controllers.buffer.insert_blob_to_buffer(
+        u_id, DEFAULT_PROJECT_ID, p.data().id, blob.to_blob()
+    )
+    assert p.ok()
+    p = await controllers.buffer.get_unprocessed_buffer_ids(
+        u_id, DEFAULT_PROJECT_ID, BlobType.chat
+    )
+    buffer_ids = p.data().ids
+    await bg.flush_buffer_by_ids_in_background(
+        u_id, DEFAULT_PROJECT_ID, BlobType.chat, buffer_ids
+    )
+
+    # the task waited in the queue longer than the lease
+    async def expire_lease():
+        async with AsyncSession() as session:
+            await session.execute(
+                update(BufferZone)
+                .where(BufferZone.id.in_(buffer_ids))
+                .values(updated_at=func.now() - timedelta(seconds=120))
+            )
+            await session.commit()
+
+    await expire_lease()
+    await bg.reclaim_expired_buffers(lease_s=60)
+    await bg.reclaim_expired_buffers(lease_s=60)
+    (task,) = await pop_user_flush_tasks(u_id)
+    assert json.loads(task)["buffer_ids"] == [str(i) for i in buffer_ids]
+
+    # once the task is gone, the buffers are queued again
+    await expire_lease()
+    assert await bg.reclaim_expired_buffers(lease_s=60) >= 1
+    assert len(await pop_user_flush_tasks(u_id)) == 1
+
+    p = await controllers.user.delete_user(u_id, DEFAULT_PROJECT_ID)
+    assert p.ok()
+
+
+@pytest.mark.asyncio
+async def test_flush_idle_buffers(db_env):
+    bg = controllers.buffer_background
+    p = await controllers.user.create_user(res.UserData(), DEFAULT_PROJECT_ID)
+    assert p.ok()
+    u_id = p.data().id
+
+    for i in range(2):
+        blob = res.BlobData(
+            blob_type=BlobType.chat,
+            blob_data={"messages": [{"role": "user", "content": f"idle {i}"}]},
+        )
+        p = await controllers.blob.insert_blob(u_id, DEFAULT_PROJECT_ID, blob)
+        assert p.ok()
+        p = await controllers.buffer.insert_blob_to_buffer(
+            u_id, DEFAULT_PROJECT_ID, p.data().id, blob.to_blob()
+        )
+        assert p.ok()
+    p = await controllers.buffer.get_unprocessed_buffer_ids(
+        u_id, DEFAULT_PROJECT_ID, BlobType.chat
+    )
+    buffer_ids = p.data().ids
+
+    # not idle for long enough
+    await bg.flush_idle_buffers(idle_s=3600, max_users=10000)
+    assert await pop_user_flush_tasks(u_id) == []
+
+    assert await bg.flush_idle_buffers(idle_s=0, max_users=10000) >= 1
+    (task,) = await pop_user_flush_tasks(u_id)
+    assert json.loads(task)["buffer_ids"] == [str(i) for i in buffer_ids]
+    p = await controllers.buffer.get_unprocessed_buffer_ids(
+        u_id, DEFAULT_PROJECT_ID, BlobType.chat, select_status="processing"
+    )
+    assert p.data().ids == buffer_ids
+
+    p = await controllers.user.delete_user(u_id, DEFAULT_PROJECT_ID)
+    assert p.ok()
+
+
+@pytest.mark.asyncio
+async def test_flush_idle_buffers_in_token_batches(db_env, monkeypatch):
+    bg = controllers.buffer_background
+    p = await controllers.user.create_user(res.UserData(), DEFAULT_PROJECT_ID)
+    assert p.ok()
+    u_id = p.data().id
+    for i in range(3):
+        blob = res.BlobData(
+            blob_type=BlobType.chat,
+            blob_data={"messages": [{"role": "user", "content": f"backlog {i}"}]},
+        )
+        p = await controllers.blob.insert_blob(u_id, DEFAULT_PROJECT_ID, blob)
+        assert p.ok()
+        p = await controllers.buffer.insert_blob_to_buffer(
+            u_id, DEFAULT_PROJECT_ID, p.data().id, blob.to_blob()
+        )
+        assert p.ok()
+    p = await controllers.buffer.get_unprocessed_buffer_ids(
+        u_id, DEFAULT_PROJECT_ID, BlobType.chat
+    )
+    buffer_ids = p.data().ids
+
+    # every buffer is over the limit, each one is flushed on its own
+    monkeypatch.setattr(CONFIG, "max_chat_blob_buffer_token_size", 1)
+    assert await bg.flush_idle_buffers(idle_s=0, max_users=10000) >= 1
+    tasks = await pop_user_flush_tasks(u_id)
+    assert sorted(json.loads(t)["buffer_ids"] for t in tasks) == sorted(
+        [str(i)] for i in buffer_ids
+    )
+
+    p = await controllers.user.delete_user(u_id, DEFAULT_PROJECT_ID)
+    assert p.ok()
+
+
+@pytest.mark.asyncio
+async def test_compact_buffers_and_blobs(db_env, monkeypatch):
+    from datetime import timedelta
+    from sqlalchemy import func, select, update
+    from memobase_server.connectors import AsyncSession
+    from memobase_server.models.database import BufferZone, GeneralBlob
+
+    p = await controllers.user.create_user(res.UserData(), DEFAULT_PROJECT_ID)
+    assert p.ok()
+    u_id = p.data().id
+    blob_ids = []
+    for i in range(3):
+        blob = res.BlobData(
+            blob_type=BlobType.chat,
+            blob_data={"messages": [{"role": "user", "content": f"old {i}"}]},
+        )
+        p = await controllers.blob.insert_blob(u_id, DEFAULT_PROJECT_ID, blob)
+        assert p.ok()
+        blob_ids.append(p.data().id)
+        p = await controllers.buffer.insert_blob_to_buffer(
+            u_id, DEFAULT_PROJECT_ID, blob_ids[-1], blob.to_blob()
+        )
+        assert p.ok()
+
+    async def user_rows(model, column):
+        async with AsyncSession() as session:
+            rows = await session.execute(
+                select(model.id, column).where(model.user_id == u_id)
+            )
+            return {row[1] for row in rows}
+
+    # two days old: done, failed, still idle
+    async with AsyncSession() as session:
+        for blob_id, status in zip(blob_ids, ["done", "failed", "idle"]):
+            await session.execute(
+                update(BufferZone)
+                .where(BufferZone.blob_id == blob_id)
+                .values(status=status, created_at=func.now() - timedelta(days=2))
+            )
+        await session.execute(
+            update(GeneralBlob)
+            .where(GeneralBlob.user_id == u_id)
+            .values(created_at=func.now() - timedelta(days=2))
+        )
+        await session.commit()
+
+    monkeypatch.setattr(CONFIG, "persistent_chat_blobs", True)
+    monkeypatch.setattr(CONFIG, "buffer_done_retention_s", 24 * 60 * 60)
+    monkeypatch.setattr(CONFIG, "buffer_failed_retention_s", 0)
+    monkeypatch.setattr(CONFIG, "blob_retention_s", {})
+    deleted = await controllers.compaction.compact_tables(batch_size=1)
+    assert deleted["buffer_zones:done"] >= 1
+    assert await user_rows(BufferZone, BufferZone.status) == {"failed", "idle"}
+    assert await user_rows(GeneralBlob, GeneralBlob.id) == set(blob_ids)
+
+    # only the blob without a waiting buffer goes
+    monkeypatch.setattr(CONFIG, "blob_retention_s", {"chat": 24 * 60 * 60})
+    await controllers.compaction.compact_tables()
+    assert await user_rows(GeneralBlob, GeneralBlob.id) == set(blob_ids[1:])
+    assert await user_rows(BufferZone, BufferZone.status) == {"failed", "idle"}
+
+    p = await controllers.user.delete_user(u_id, DEFAULT_PROJECT_ID)
+    assert p.ok()
+
+
+@pytest.mark.asyncio
+async def test_compact_expired_events(db_env, mock_event_get_embedding, monkeypatch):
+    from datetime import timedelta
+    from sqlalchemy import func, select, update
+    from memobase_server.connectors import AsyncSession
+    from memobase_server.models.database import UserEvent, UserEventGist
+
+    versions = controllers.memory_version
+    p = await controllers.user.create_user(res.UserData(), DEFAULT_PROJECT_ID)
+    assert p.ok()
+    u_id = p.data().id
+    event_ids = []
+    for i in range(2):
+        p = await controllers.event.append_user_event(
+            u_id, DEFAULT_PROJECT_ID, {"event_tip": f"- User did {i}\n- Then {i}"}
+        )
+        assert p.ok()
+        event_ids.append(p.data())
+
+    async with AsyncSession() as session:
+        for model, column in [
+            (UserEvent, UserEvent.id),
+            (UserEventGist, UserEventGist.event_id),
+        ]:
+            await session.execute(
+                update(model)
+                .where(column == event_ids[0])
+                .values(created_at=func.now() - timedelta(days=3))
+            )
+        await session.commit()
+    version = await versions.get_user_memory_version(u_id, DEFAULT_PROJECT_ID)
+
+    monkeypatch.setattr(CONFIG, "event_retention_days", {DEFAULT_PROJECT_ID: 2})
+    deleted = await controllers.compaction.compact_tables()
+    assert deleted[f"expired_event_users:{DEFAULT_PROJECT_ID}"] >= 1
+    async with AsyncSession() as session:
+        events = (
+            (
+                await session.execute(
+                    select(UserEvent.id).where(UserEvent.user_id == u_id)
+                )
+            )
+            .scalars()
+            .all()
+        )
+        gist_events = (
+            (
+                await session.execute(
+                    select(UserEventGist.event_id).where(UserEventGist.user_id == u_id)
+                )
+            )
+            .scalars()
+            .all()
+        )
+    assert events == [event_ids[1]]
+    assert set(gist_events) == {event_ids[1]}
+    # the cached context of the user is not served anymore
+    assert await versions.get_user_memory_version(u_id, DEFAULT_PROJECT_ID) != version
+
+    p = await controllers.user.delete_user(u_id, DEFAULT_PROJECT_ID)
+    assert p.ok()
+
+
+@pytest.mark.asyncio
+async def test_parallel_flush_exactly_once(db_env):
+    p = await controllers.user.create_user(res.UserData(), DEFAULT_PROJECT_ID)
+    assert p.ok()
+    u_id = p.data().id
+
+    total_blobs = 30
+    for i in range(total_blobs):
+        blob = res.BlobData(
+            blob_type=BlobType.chat,
+            blob_data={"messages": [{"role": "user", "content": f"message {i}"}]},
+        )
+        p = await controllers.blob.insert_blob(u_id, DEFAULT_PROJECT_ID, blob)
+        assert p.ok()
+        p = await controllers.buffer.insert_blob_to_buffer(
+            u_id, DEFAULT_PROJECT_ID, p.data().id, blob.to_blob()
+        )
+        assert p.ok()
+    p = await controllers.buffer.get_unprocessed_buffer_ids(
+        u_id, DEFAULT_PROJECT_ID, BlobType.chat
+    )
+    buffer_ids = p.data().ids
+    assert len(buffer_ids) == total_blobs
+
+    processed = []
+
+    async def fake_process(user_id, project_id, blobs):
+        await asyncio.sleep(0.01)
+        processed.extend(b.messages[0].content for b in blobs)
+        return Promise.resolve(None)
+
+    def caller_ids(i):
+        # overlapping subsets, the first caller asks for everything
+        if i == 0:
+            return buffer_ids
+        return random.sample(buffer_ids, random.randint(1, total_blobs))
+
+    with patch.dict(
+        "memobase_server.controllers.buffer.BLOBS_PROCESS",
+        {BlobType.chat: fake_process},
+    ):
+        results = await asyncio.gather(
+            *[
+                controllers.buffer.flush_buffer_by_ids(
+                    u_id, DEFAULT_PROJECT_ID, BlobType.chat, caller_ids(i)
+                )
+                for i in range(50)
+            ]
+        )
+    assert all(r.ok() for r in results)
+    assert sorted(processed) == sorted(f"message {i}" for i in range(total_blobs))
+
+    p = await controllers.buffer.get_unprocessed_buffer_ids(
+        u_id, DEFAULT_PROJECT_ID, BlobType.chat, select_status="done"
+    )
+    assert len(p.data().ids) == total_blobs
+
+    p = await controllers.user.delete_user(u_id, DEFAULT_PROJECT_ID)
+    assert p.ok()
+
+
+@pytest.mark.asyncio
+async def test_insert_blob_with_buffer(db_env, monkeypatch):
+    monkeypatch.setattr(CONFIG, "max_chat_blob_buffer_token_size", 20)
+    p = await controllers.user.create_user(res.UserData(), DEFAULT_PROJECT_ID)
+    assert p.ok()
+    u_id = p.data().id
+
+    blob = res.BlobData(
+        blob_type=BlobType.chat,
+        blob_data={"messages": [{"role": "user", "content": "Hello world"}]},
+    )
+    full_ids = []
+    for i in range(20):
+        p = await controllers.buffer.insert_blob_with_buffer(
+            u_id, DEFAULT_PROJECT_ID, blob
+        )
+        assert p.ok()
+        p = await controllers.blob.get_blob(u_id, DEFAULT_PROJECT_ID, p.data().id)
+        assert p.ok()
+        p = await controllers.buffer.detect_buffer_full_or_not(
+            u_id, DEFAULT_PROJECT_ID, BlobType.chat
+        )
+        assert p.ok()
+        full_ids = p.data().ids
+        if full_ids:
+            break
+    assert len(full_ids) == i + 1
+
+    async with get_redis_client() as redis_client:
+        buffered_tokens = await redis_client.get(
+            controllers.buffer.get_buffer_tokens_key(
+                u_id, DEFAULT_PROJECT_ID, BlobType.chat
+            )
+        )
+    assert int(buffered_tokens) > CONFIG.max_chat_blob_buffer_token_size
+
+    p = await controllers.user.delete_user(u_id, DEFAULT_PROJECT_ID)
+    assert p.ok()
+
+
+@pytest.mark.asyncio
+async def test_insert_blobs_with_buffers(db_env, monkeypatch):
+    monkeypatch.setattr(CONFIG, "max_chat_blob_buffer_token_size", 20)
+    u_ids = []
+    for _ in range(2):
+        p = await controllers.user.create_user(res.UserData(), DEFAULT_PROJECT_ID)
+        assert p.ok()
+        u_ids.append(p.data().id)
+
+    blobs = [
+        res.UserBlobData(
+            user_id=u_ids[i % 2],
+            blob_type=BlobType.chat,
+            blob_data={"messages": [{"role": "user", "content": f"Hello world {i}"}]},
+        )
+        for i in range(20)
+    ]
+    p = await controllers.buffer.insert_blobs_with_buffers(DEFAULT_PROJECT_ID, blobs)
+    assert p.ok()
+    b_ids = p.data().ids
+    assert len(b_ids) == 20
+    p = await controllers.blob.get_blob(u_ids[1], DEFAULT_PROJECT_ID, b_ids[3])
+    assert p.ok() and p.data().blob_data["messages"][0]["content"] == "Hello world 3"
+
+    p = await controllers.buffer.split_full_buffers(
+        DEFAULT_PROJECT_ID, [(u_id, BlobType.chat) for u_id in u_ids]
+    )
+    assert p.ok()
+    batches = p.data()
+    assert {b[0] for b in batches} == set(u_ids)
+    for _, _, buffer_ids in batches:
+        assert 1 < len(buffer_ids) < 10
+
+    p = await controllers.buffer.insert_blobs_with_buffers(
+        DEFAULT_PROJECT_ID,
+        [
+            res.UserBlobData(
+                user_id="00000000-0000-4000-8000-000000000000",
+                blob_type=BlobType.chat,
+                blob_data={"messages": [{"role": "user", "content": "Hello"}]},
+            )
+        ],
+    )
+    assert p.code() == res.CODE.NOT_FOUND
+
+    for u_id in u_ids:
+        p = await controllers.user.delete_user(u_id, DEFAULT_PROJECT_ID)
+        assert p.ok()
+
+
+@pytest.mark.asyncio
+async def test_user_profile_cache_write_through(db_env):
+    p = await controllers.user.create_user(res.UserData(), DEFAULT_PROJECT_ID)
+    assert p.ok()
+    u_id = p.data().id
+    cache_key = controllers.profile.get_user_profiles_cache_key(
+        u_id, DEFAULT_PROJECT_ID
+    )
+
+    # miss fills the cache, even if there are no profiles
+    p = await controllers.profile.get_user_profiles(u_id, DEFAULT_PROJECT_ID)
+    assert p.ok() and len(p.data().profiles) == 0
+    async with get_redis_client() as redis_client:
+        assert await redis_client.exists(cache_key)
+
+    p = await controllers.profile.add_user_profiles(
+        u_id,
+        DEFAULT_PROJECT_ID,
+        ["Gus", "25"],
+        [
+            {"topic": "basic_info", "sub_topic": "name"},
+            {"topic": "basic_info", "sub_topic": "age"},
+        ],
+    )
+    assert p.ok()
+    name_id, age_id = p.data().ids
+
+    p = await controllers.profile.add_update_delete_user_profiles(
+        u_id,
+        DEFAULT_PROJECT_ID,
+        ["Tokyo"],
+        [{"topic": "basic_info", "sub_topic": "city"}],
+        [name_id],
+        ["Gustavo"],
+        [None],
+        [age_id],
+    )
+    assert p.ok()
+
+    # writes are applied to the cache, not dropped
+    async with get_redis_client() as redis_client:
+        assert await redis_client.exists(cache_key)
+    cached = (
+        await controllers.profile.get_user_profiles(u_id, DEFAULT_PROJECT_ID)
+    ).data()
+    async with get_redis_client() as redis_client:
+        await redis_client.delete(cache_key)
+    from_db = (
+        await controllers.profile.get_user_profiles(u_id, DEFAULT_PROJECT_ID)
+    ).data()
+    # profiles written in one transaction share `updated_at`, compare them by id
+    assert {p.id: p for p in cached.profiles} == {p.id: p for p in from_db.profiles}
+    assert sorted(p.content for p in cached.profiles) == ["Gustavo", "Tokyo"]
+
+    # a read that started before a write must not fill the old profiles back
+    version_key = controllers.profile.get_user_profiles_version_key(
+        u_id, DEFAULT_PROJECT_ID
+    )
+    async with get_redis_client() as redis_client:
+        version = await redis_client.get(version_key)
+        await controllers.profile.refresh_user_profile_cache(u_id, DEFAULT_PROJECT_ID)
+        filled = await redis_client.eval(
+            controllers.profile.REDIS_LUA_FILL_PROFILES_IF_VERSION,
+            2,
+            cache_key,
+            version_key,
+            60,
+            version,
+            *controllers.profile.pack_profiles_cache_fields(from_db.profiles),
+        )
+        assert filled == 0
+        assert not await redis_client.exists(cache_key)
+
+    # a write whose version was bumped by another write drops the cache
+    p = await controllers.profile.get_user_profiles(u_id, DEFAULT_PROJECT_ID)
+    assert p.ok()
+    async with get_redis_client() as redis_client:
+        stale_version = await redis_client.get(version_key)
+
+        async def apply_delta(version, set_fields, delete_ids):
+            return await redis_client.eval(
+                controllers.profile.REDIS_LUA_APPLY_PROFILES_DELTA,
+                2,
+                cache_key,
+                version_key,
+                60,
+                version,
+                len(set_fields),
+                *set_fields,
+                *delete_ids,
+            )
+
+        assert await apply_delta(stale_version, [], []) == 1
+        assert await apply_delta(stale_version, [name_id, "stale"], []) == 0
+        assert not await redis_client.exists(cache_key)
+
+        # more fields than Lua can unpack at once
+        fields = [f"field_{i // 2}" if i % 2 == 0 else "{}" for i in range(20000)]
+        version = await redis_client.get(version_key)
+        filled = await redis_client.eval(
+            controllers.profile.REDIS_LUA_FILL_PROFILES_IF_VERSION,
+            2,
+            cache_key,
+            version_key,
+            60,
+            version,
+            *fields,
+        )
+        assert filled == 1
+        assert await redis_client.hlen(cache_key) == 10000 + 1
+        assert await apply_delta(version, fields[:4000], fields[4000::2]) == 1
+        assert await redis_client.hlen(cache_key) == 2000 + 1
+        await redis_client.delete(cache_key)
+
+    p = await controllers.user.delete_user(u_id, DEFAULT_PROJECT_ID)
+    assert p.ok()
+
+
+@pytest.mark.asyncio
+async def test_stored_token_sizes(db_env, monkeypatch):
+    from memobase_server.utils import get_token_length, profile_str_repr
+
+    monkeypatch.setattr(CONFIG, "enable_event_embedding", False)
+    p = await controllers.user.create_user(res.UserData(), DEFAULT_PROJECT_ID)
+    assert p.ok()
+    u_id = p.data().id
+
+    attributes = [
+        {"topic": "basic_info", "sub_topic": "name"},
+        {"topic": "interest", "sub_topic": "sports"},
+    ]
+    p = await controllers.profile.add_user_profiles(
+        u_id, DEFAULT_PROJECT_ID, ["Gus", "Likes playing basketball"], attributes
+    )
+    assert p.ok()
+    p = await controllers.profile.get_user_profiles(u_id, DEFAULT_PROJECT_ID)
+    assert p.ok()
+    profiles = p.data().profiles
+    for profile in profiles:
+        assert profile.token_size == get_token_length(
+            profile_str_repr(profile.content, profile.attributes)
+        )
+
+    # truncation only sums the stored sizes
+    with patch("memobase_server.controllers.profile.aget_token_lengths") as mock_len:
+        p = await controllers.profile.truncate_profiles(
+            res.UserProfilesData(profiles=profiles),
+            max_token_size=profiles[0].token_size,
+        )
+        mock_len.assert_not_called()
+    assert p.ok() and len(p.data().profiles) == 1
+
+    p = await controllers.event.append_user_event(
+        u_id,
+        DEFAULT_PROJECT_ID,
+        {"event_tip": "- User had a great day\n- User went hiking"},
+    )
+    assert p.ok()
+    p = await controllers.event_gist.get_user_event_gists(u_id, DEFAULT_PROJECT_ID)
+    assert p.ok()
+    gists = p.data().gists
+    assert len(gists) == 2
+    for gist in gists:
+        assert gist.token_size == get_token_length(gist.gist_data.content)
+
+    p = await controllers.user.delete_user(u_id, DEFAULT_PROJECT_ID)
+    assert p.ok()
+
+
+@pytest.mark.asyncio
+async def test_filter_profiles_with_embedding(db_env, monkeypatch):
+    from memobase_server.controllers.post_process.profile import (
+        filter_profiles_with_chats,
+    )
+    from memobase_server.models.blob import OpenAICompatibleMessage
+    from memobase_server.utils import profile_str_repr
+
+    monkeypatch.setattr(CONFIG, "enable_event_embedding", True)
+    monkeypatch.setattr(CONFIG, "embedding_provider", "stand_in")
+    monkeypatch.setattr(CONFIG, "stand_in_embedding_latency_ms", 0)
+    monkeypatch.setattr(CONFIG, "embedding_batch_window_ms", 0)
+    p = await controllers.user.create_user(res.UserData(), DEFAULT_PROJECT_ID)
+    assert p.ok()
+    u_id = p.data().id
+
+    attributes = [
+        {"topic": "interest", "sub_topic": "sports"},
+        {"topic": "work", "sub_topic": "title"},
+    ]
+    p = await controllers.profile.add_user_profiles(
+        u_id, DEFAULT_PROJECT_ID, ["Likes playing tennis", "Engineer"], attributes
+    )
+    assert p.ok()
+    p = await controllers.profile.get_user_profiles(u_id, DEFAULT_PROJECT_ID)
+    assert p.ok()
+    profiles = p.data()
+
+    # the stand-in gives the same text the same vector, other texts are ~orthogonal
+    chats = [
+        OpenAICompatibleMessage(
+            role="user", content=profile_str_repr("Likes playing tennis", attributes[0])
+        )
+    ]
+    with patch(
+        "memobase_server.controllers.post_process.profile.llm_complete"
+    ) as mock_llm:
+        p = await filter_profiles_with_chats(
+            u_id, DEFAULT_PROJECT_ID, profiles, chats, mode="vector"
+        )
+        mock_llm.assert_not_called()
+    assert p.ok()
+    assert [x.content for x in p.data()["profiles"]] == ["Likes playing tennis"]
+
+    # an update without attributes is embedded with the stored ones
+    tennis_id = [x.id for x in profiles.profiles if x.content.endswith("tennis")][0]
+    p = await controllers.profile.update_user_profiles(
+        u_id, DEFAULT_PROJECT_ID, [tennis_id], ["Likes playing golf"], [None]
+    )
+    assert p.ok()
+    p = await controllers.profile.get_user_profiles(u_id, DEFAULT_PROJECT_ID)
+    assert p.ok()
+    profiles = p.data()
+    chats = [
+        OpenAICompatibleMessage(
+            role="user", content=profile_str_repr("Likes playing golf", attributes[0])
+        )
+    ]
+    p = await filter_profiles_with_chats(
+        u_id, DEFAULT_PROJECT_ID, profiles, chats, mode="vector"
+    )
+    assert p.ok()
+    assert [x.content for x in p.data()["profiles"]] == ["Likes playing golf"]
+
+    # a profile written before the embeddings can't be ranked, the LLM picks
+    from sqlalchemy import update
+    from memobase_server.connectors import AsyncSession
+    from memobase_server.models.database import UserProfile
+
+    async with AsyncSession() as session:
+        await session.execute(
+            update(UserProfile)
+            .where(UserProfile.id == tennis_id)
+            .values(embedding=None)
+        )
+        await session.commit()
+    with patch(
+        "memobase_server.controllers.post_process.profile.llm_complete",
+        AsyncMock(return_value=Promise.resolve("[0]")),
+    ) as mock_llm:
+        p = await filter_profiles_with_chats(
+            u_id, DEFAULT_PROJECT_ID, profiles, chats, mode="vector"
+        )
+        mock_llm.assert_awaited_once()
+    assert p.ok()
+    assert len(p.data()["profiles"]) == 1
+
+    p = await controllers.user.delete_user(u_id, DEFAULT_PROJECT_ID)
+    assert p.ok()
+
+
+@pytest.mark.asyncio
+async def test_versioned_context_cache(db_env, monkeypatch):
+    monkeypatch.setattr(CONFIG, "enable_event_embedding", False)
+    p = await controllers.user.create_user(res.UserData(), DEFAULT_PROJECT_ID)
+    assert p.ok()
+    u_id = p.data().id
+    p = await controllers.profile.add_user_profiles(
+        u_id,
+        DEFAULT_PROJECT_ID,
+        ["Gus"],
+        [{"topic": "basic_info", "sub_topic": "name"}],
+    )
+    assert p.ok()
+    params = dict(
+        max_token_size=500,
+        prefer_topics=None,
+        only_topics=None,
+        max_subtopic_size=None,
+        topic_limits={},
+        profile_event_ratio=0.6,
+        require_event_summary=False,
+        event_similarity_threshold=0.2,
+        time_range_in_days=180,
+    )
+
+    p = await controllers.context.get_cached_user_context(
+        u_id, DEFAULT_PROJECT_ID, params, []
+    )
+    assert p.ok()
+    etag, context = p.data()["etag"], p.data()["context"]
+    assert etag is not None and "Gus" in context.context
+
+    # unchanged: served from the cache, or not at all with the ETag
+    with patch("memobase_server.controllers.context.get_user_context") as mock_render:
+        p = await controllers.context.get_cached_user_context(
+            u_id, DEFAULT_PROJECT_ID, params, []
+        )
+        assert p.data() == {"etag": etag, "context": context}
+        p = await controllers.context.get_cached_user_context(
+            u_id, DEFAULT_PROJECT_ID, params, [], if_none_match=etag
+        )
+        assert p.data() == {"etag": etag, "context": None}
+        mock_render.assert_not_called()
+
+    # a profile or event write changes the version
+    p = await controllers.event.append_user_event(
+        u_id, DEFAULT_PROJECT_ID, {"event_tip": "- User went hiking"}
+    )
+    assert p.ok()
+    p = await controllers.context.get_cached_user_context(
+        u_id, DEFAULT_PROJECT_ID, params, [], if_none_match=etag
+    )
+    assert p.ok()
+    assert p.data()["etag"] != etag
+    assert "hiking" in p.data()["context"].context
+    etag = p.data()["etag"]
+    p = await controllers.profile.add_user_profiles(
+        u_id,
+        DEFAULT_PROJECT_ID,
+        ["Likes tennis"],
+        [{"topic": "interest", "sub_topic": "sports"}],
+    )
+    assert p.ok()
+    p = await controllers.context.get_cached_user_context(
+        u_id, DEFAULT_PROJECT_ID, params, [], if_none_match=etag
+    )
+    assert p.data()["etag"] != etag
+    assert "tennis" in p.data()["context"].context
+
+    # dropped event partitions change the version of every user
+    etag = p.data()["etag"]
+    await controllers.memory_version.bump_memory_generation()
+    p = await controllers.context.get_cached_user_context(
+        u_id, DEFAULT_PROJECT_ID, params, [], if_none_match=etag
+    )
+    assert p.data()["etag"] != etag
+    assert p.data()["context"] is not None
+
+    p = await controllers.user.delete_user(u_id, DEFAULT_PROJECT_ID)
+    assert p.ok()
+
+
+@pytest.mark.asyncio
+async def test_timeline_queries_use_index(db_env):
+    import uuid
+    from sqlalchemy import text
+    from memobase_server.connectors import AsyncSession, explain_query
+    from memobase_server.controllers.event import select_user_events_timeline
+    from memobase_server.controllers.event_gist import (
+        select_user_event_gists_timeline,
+    )
+
+    u_id = uuid.uuid4()
+    queries = [
+        (
+            select_user_events_timeline(u_id, DEFAULT_PROJECT_ID, 10, 21),
+            "idx_user_events_project_id_user_id_created_at",
+        ),
+        (
+            select_user_event_gists_timeline(u_id, DEFAULT_PROJECT_ID, 60, 180),
+            "idx_user_event_gists_project_id_user_id_created_at",
+        ),
+    ]
+    async with AsyncSession() as session:
+        # only an index read in time order can avoid the Sort now
+        await session.execute(text("SET LOCAL enable_seqscan = off"))
+        await session.execute(text("SET LOCAL enable_sort = off"))
+        for stmt, index_name in queries:
+            plan = await explain_query(session, stmt)
+            assert index_name in plan, plan
+            assert "Sort" not in plan, plan
+
+
+@pytest.mark.asyncio
+async def test_event_tags_filter(db_env, mock_event_get_embedding):
+    from sqlalchemy import select, text
+    from memobase_server.connectors import AsyncSession, explain_query
+    from memobase_server.controllers.event import event_tags_filter
+    from memobase_server.models.database import UserEvent
+
+    p = await controllers.user.create_user(res.UserData(), DEFAULT_PROJECT_ID)
+    assert p.ok()
+    u_id = p.data().id
+    for tags in [
+        [{"tag": "emotion", "value": "happy"}, {"tag": "goal", "value": "relax"}],
+        [{"tag": "emotion", "value": "sad"}],
+        None,
+    ]:
+        p = await controllers.event.append_user_event(
+            u_id, DEFAULT_PROJECT_ID, {"event_tip": "- User talked", "event_tags": tags}
+        )
+        assert p.ok()
+
+    # a quote in a tag is a value, not SQL
+    p = await controllers.event.filter_user_events(
+        u_id, DEFAULT_PROJECT_ID, event_tag_equal={"emotion": 'happy"}]'}
+    )
+    assert p.ok()
+    assert len(p.data().events) == 0
+
+    p = await controllers.event.filter_user_events(
+        u_id, DEFAULT_PROJECT_ID, has_event_tag=["emotion"], time_range_in_days=1
+    )
+    assert p.ok()
+    assert len(p.data().events) == 2
+    p = await controllers.event.filter_user_events(
+        u_id, DEFAULT_PROJECT_ID, has_event_tag=["emotion"], time_range_in_days=0
+    )
+    assert p.ok()
+    assert len(p.data().events) == 0
+
+    p = await controllers.event.search_user_events(
+        u_id,
+        DEFAULT_PROJECT_ID,
+        "relax",
+        has_event_tag=["goal"],
+        event_tag_equal={"emotion": "happy"},
+    )
+    assert p.ok()
+    events = p.data().events
+    assert len(events) == 1
+    assert events[0].event_data.event_tags[1].tag == "goal"
+
+    async with AsyncSession() as session:
+        await session.execute(text("SET LOCAL enable_seqscan = off"))
+        plan = await explain_query(
+            session,
+            select(UserEvent.id).where(event_tags_filter(has_event_tag=["emotion"])),
+        )
+        assert "idx_user_events_event_tags" in plan, plan
+
+    p = await controllers.user.delete_user(u_id, DEFAULT_PROJECT_ID)
+    assert p.ok()
+
+
+@pytest.mark.asyncio
+async def test_search_event_gists_threshold_after_scan(db_env):
+    from memobase_server.connectors import AsyncSession
+
+    hiking = np.zeros(CONFIG.embedding_dim)
+    hiking[0] = 1
+    cooking = np.zeros(CONFIG.embedding_dim)
+    cooking[1] = 1
+
+    async def fake_get_embedding(project_id, texts, **kwargs):
+        return Promise.resolve(
+            np.array([hiking if "hiking" in t else cooking for t in texts])
+        )
+
+    p = await controllers.user.create_user(res.UserData(), DEFAULT_PROJECT_ID)
+    assert p.ok()
+    u_id = p.data().id
+    with patch(
+        "memobase_server.controllers.event.get_embedding",
+        side_effect=fake_get_embedding,
+    ):
+        p = await controllers.event.append_user_event(
+            u_id,
+            DEFAULT_PROJECT_ID,
+            {"event_tip": "- User went hiking\n- User is cooking pasta"},
+        )
+    assert p.ok()
+
+    search = controllers.event_gist.search_event_gists_by_embedding
+    async with AsyncSession() as session:
+        gists = await search(session, u_id, DEFAULT_PROJECT_ID, hiking, topk=10)
+    assert [g.gist_data.content for g in gists] == ["- User went hiking"]
+    assert gists[0].similarity == pytest.approx(1)
+
+    # the nearest rows come first, the threshold doesn't drop them before LIMIT
+    query = hiking + 0.5 * cooking
+    async with AsyncSession() as session:
+        gists = await search(
+            session,
+            u_id,
+            DEFAULT_PROJECT_ID,
+            query,
+            topk=2,
+            similarity_threshold=0,
+            ef_search=1,
+        )
+    assert [g.gist_data.content for g in gists] == [
+        "- User went hiking",
+        "- User is cooking pasta",
+    ]
+
+    p = await controllers.user.delete_user(u_id, DEFAULT_PROJECT_ID)
+    assert p.ok()
+
+
+@pytest.mark.asyncio
+async def test_search_recall_among_users(db_env, mock_event_get_embedding, monkeypatch):
+    import uuid
+    from sqlalchemy import insert
+    from memobase_server import connectors
+    from memobase_server.connectors import AsyncSession
+    from memobase_server.models.database import UserEvent, UserEventGist
+
+    # the HNSW scan alone would stop at the other user's rows, nearer the query
+    monkeypatch.setattr(connectors, "PGVECTOR_ITERATIVE_SCAN", False)
+    query = np.full(CONFIG.embedding_dim, 0.1)
+    rng = np.random.default_rng(0)
+    user_ids = []
+    for _ in range(2):
+        p = await controllers.user.create_user(res.UserData(), DEFAULT_PROJECT_ID)
+        assert p.ok()
+        user_ids.append(p.data().id)
+    crowd_id, u_id = user_ids
+
+    async def insert_events(user_id, n, noise):
+        embeddings = query + noise * rng.normal(size=(n, CONFIG.embedding_dim))
+        event_id = uuid.uuid4()
+        async with AsyncSession() as session:
+            await session.execute(
+                insert(UserEvent),
+                [
+                    {
+                        "id": event_id if i == 0 else uuid.uuid4(),
+                        "user_id": user_id,
+                        "project_id": DEFAULT_PROJECT_ID,
+                        "event_data": {"event_tip": f"- event {i}"},
+                        "embedding": embeddings[i],
+                    }
+                    for i in range(n)
+                ],
+            )
+            await session.execute(
+                insert(UserEventGist),
+                [
+                    {
+                        "id": uuid.uuid4(),
+                        "user_id": user_id,
+                        "event_id": event_id,
+                        "project_id": DEFAULT_PROJECT_ID,
+                        "gist_data": {"content": f"- gist {i}"},
+                        "embedding": embeddings[i],
+                    }
+                    for i in range(n)
+                ],
+            )
+            await session.commit()
+
+    await insert_events(crowd_id, 200, 0.001)
+    await insert_events(u_id, 3, 0.01)
+
+    p = await controllers.event.search_user_events(
+        u_id, DEFAULT_PROJECT_ID, "anything", topk=3, ef_search=10
+    )
+    assert p.ok()
+    assert len(p.data().events) == 3
+    async with AsyncSession() as session:
+        gists = await controllers.event_gist.search_event_gists_by_embedding(
+            session, u_id, DEFAULT_PROJECT_ID, query, topk=3, ef_search=10
+        )
+    assert len(gists) == 3
+
+    for user_id in user_ids:
+        p = await controllers.user.delete_user(user_id, DEFAULT_PROJECT_ID)
+        assert p.ok()
+
+
+@pytest.mark.asyncio
+async def test_query_embedding_cache(db_env):
+    from memobase_server.llms import embeddings
+
+    rng = np.random.default_rng(0)
+    texts = [f"query embedding cache test {random.random()}" for _ in range(2)]
+    vectors = rng.normal(size=(2, CONFIG.embedding_dim)).astype(np.float32)
+    provider = AsyncMock(
+        side_effect=lambda model, t, phase: np.stack(
+            [vectors[texts.index(x)] for x in t]
+        )
+    )
+
+    with patch.dict(embeddings.FACTORIES, {CONFIG.embedding_provider: provider}):
+        p = await embeddings.get_embedding(DEFAULT_PROJECT_ID, texts[:1], "query")
+        assert p.ok()
+        # local hit for the first text, only the second one is requested
+        p = await embeddings.get_embedding(DEFAULT_PROJECT_ID, texts, "query")
+        assert p.ok() and p.data().shape == (2, CONFIG.embedding_dim)
+        assert provider.await_count == 2
+        assert provider.await_args.args[1] == texts[1:]
+        np.testing.assert_allclose(p.data(), vectors)
+
+        # other processes get the float16 copy from Redis
+        embeddings.QUERY_EMBEDDINGS.clear()
+        p = await embeddings.get_embedding(DEFAULT_PROJECT_ID, texts, "query")
+        assert p.ok() and provider.await_count == 2
+        np.testing.assert_allclose(p.data(), vectors, rtol=1e-2, atol=1e-3)
+
+        # documents are never cached
+        p = await embeddings.get_embedding(DEFAULT_PROJECT_ID, texts, "document")
+        assert p.ok() and provider.await_count == 3
+
+    async with get_redis_client() as redis_client:
+        await redis_client.delete(
+            *[
+                embeddings.get_query_embedding_cache_key(
+                    CONFIG.embedding_model, "query", t
+                )
+                for t in texts
+            ]
+        )
+    embeddings.QUERY_EMBEDDINGS.clear()
+
+
+@pytest.mark.asyncio
+async def test_document_embedding_batcher(db_env, monkeypatch):
+    from memobase_server.llms import embeddings
+
+    monkeypatch.setattr(CONFIG, "embedding_batch_window_ms", 50)
+    monkeypatch.setattr(CONFIG, "embedding_batch_max_size", 4)
+    provider = AsyncMock(
+        side_effect=lambda model, t, phase: np.array(
+            [[float(x.split()[-1])] * CONFIG.embedding_dim for x in t]
+        )
+    )
+    requests = [[f"document {i}{j}" for j in range(i + 1)] for i in range(3)]
+
+    with patch.dict(embeddings.FACTORIES, {CONFIG.embedding_provider: provider}):
+        ps = await asyncio.gather(
+            *[
+                embeddings.get_embedding(DEFAULT_PROJECT_ID, texts, "document")
+                for texts in requests
+            ]
+        )
+        # 6 texts, the first request reaches the max size of 4 texts
+        assert [len(c.args[1]) for c in provider.await_args_list] == [4, 2]
+        for texts, p in zip(requests, ps):
+            assert p.ok()
+            assert p.data()[:, 0].tolist() == [float(t.split()[-1]) for t in texts]
+
+        provider.side_effect = Exception("provider down")
+        p = await embeddings.get_embedding(DEFAULT_PROJECT_ID, ["a b 1"], "document")
+        assert not p.ok()
+
+
+@pytest.mark.asyncio
+async def test_local_embedding_provider(monkeypatch):
+    import threading
+    from memobase_server.llms.embeddings import local_embedding
+
+    calls = []
+
+    class FakeModel:
+        prompts = {"query": "query: "}
+
+        def encode(self, texts, prompt_name=None, **kwargs):
+            calls.append((prompt_name, threading.current_thread().name))
+            return np.ones((len(texts), CONFIG.embedding_dim), dtype=np.float32)
+
+    monkeypatch.setitem(local_embedding._local_models, "fake-model", FakeModel())
+    r = await local_embedding.local_embedding("fake-model", ["a", "b"], "query")
+    assert r.shape == (2, CONFIG.embedding_dim)
+    await local_embedding.local_embedding("fake-model", ["a"], "document")
+    # the model's own prompts are used, off the event loop
+    assert [c[0] for c in calls] == ["query", None]
+    assert all(c[1].startswith("embedding") for c in calls)
+
+
+@pytest.mark.asyncio
+async def test_llm_limiter_priority():
+    from memobase_server.llms.limiter import PrioritySemaphore, PRIORITY_ORDER
+
+    slots = PrioritySemaphore(1)
+    await slots.acquire(PRIORITY_ORDER["background"])
+    order = []
+
+    async def call(name, priority):
+        await slots.acquire(PRIORITY_ORDER[priority])
+        order.append(name)
+        slots.release()
+
+    tasks = [
+        asyncio.create_task(call("flush_1", "background")),
+        asyncio.create_task(call("flush_2", "background")),
+        asyncio.create_task(call("context", "interactive")),
+    ]
+    await asyncio.sleep(0)
+    slots.release()
+    await asyncio.gather(*tasks)
+    assert order == ["context", "flush_1", "flush_2"]
+    assert slots.idle(1)
+
+
+@pytest.mark.asyncio
+async def test_llm_limiter_rate(db_env, monkeypatch):
+    from memobase_server.llms import limiter
+
+    monkeypatch.setattr(CONFIG, "llm_project_rpm_limit", 5)
+    monkeypatch.setattr(CONFIG, "llm_project_tpm_limit", 1000)
+    monkeypatch.setattr(CONFIG, "llm_interactive_reserve", 0.2)
+    # one window for the whole test
+    monkeypatch.setattr(limiter, "RATE_WINDOW_S", 60 * 60 * 24)
+    project_id = f"limiter_test_{random.random()}"
+
+    # background calls get 4 of the 5 requests per minute
+    for _ in range(4):
+        r = await limiter.take_llm_rate(project_id, "background", 10)
+        assert r.window is not None
+    # the 5th waits for the next window
+    with pytest.raises(asyncio.TimeoutError):
+        await asyncio.wait_for(
+            limiter.take_llm_rate(project_id, "background", 10), timeout=0.5
+        )
+    r = await limiter.take_llm_rate(project_id, "interactive", 10)
+    assert r.window is not None
+
+    await limiter.settle_llm_rate(r, 25)
+    async with get_redis_client() as redis_client:
+        keys = limiter.get_llm_rate_keys(project_id, r.window)
+        assert int(await redis_client.hget(keys[1], "tokens")) == 4 * 10 + 25
+        await redis_client.delete(*keys)
+
+
+@pytest.mark.asyncio
+async def test_llm_limiter_rate_holds_no_slot(db_env, monkeypatch):
+    from memobase_server.llms import limiter
+
+    monkeypatch.setattr(CONFIG, "llm_project_max_concurrency", 2)
+    monkeypatch.setattr(CONFIG, "llm_project_rpm_limit", 5)
+    monkeypatch.setattr(CONFIG, "llm_interactive_reserve", 0.2)
+    monkeypatch.setattr(limiter, "RATE_WINDOW_S", 60 * 60 * 24)
+    project_id = f"limiter_test_{random.random()}"
+
+    async def call(priority):
+        async with limiter.limit_llm_call(project_id, priority, 10):
+            pass
+
+    # use up the background share, the next background calls sleep on the rate
+    for _ in range(4):
+        await call("background")
+    waiting = [asyncio.create_task(call("background")) for _ in range(4)]
+    await asyncio.sleep(0.2)
+    assert not any(t.done() for t in waiting)
+    # the sleeping calls hold none of the 2 slots
+    await asyncio.wait_for(call("interactive"), timeout=1)
+    for t in waiting:
+        t.cancel()
+    await asyncio.gather(*waiting, return_exceptions=True)
+    assert project_id not in limiter._project_slots
+
+    async with get_redis_client() as redis_client:
+        window = int(time.time() // limiter.RATE_WINDOW_S)
+        await redis_client.delete(*limiter.get_llm_rate_keys(project_id, window))
+
+
+@pytest.mark.asyncio
+async def test_stand_in_backends(monkeypatch):
+    from memobase_server.llms.stand_in_llm import stand_in_complete
+    from memobase_server.llms.embeddings.stand_in_embedding import stand_in_embedding
+    from memobase_server.prompts import merge_profile_yolo
+    from memobase_server.prompts.utils import (
+        parse_string_into_profiles,
+        parse_string_into_merge_yolo_action,
+    )
+    from memobase_server.utils import find_list_int_or_none
+
+    monkeypatch.setattr(CONFIG, "stand_in_llm_latency_ms", 0)
+    monkeypatch.setattr(CONFIG, "stand_in_embedding_latency_ms", 0)
+
+    # the answers parse like the real ones, and are the same for the same input
+    a1, usage = await stand_in_complete(
+        "m", "Q: I live in Paris", prompt_id="extract_profile"
+    )
+    a2, _ = await stand_in_complete(
+        "m", "Q: I live in Paris", prompt_id="extract_profile"
+    )
+    assert a1 == a2 and usage.prompt_tokens > 0
+    assert len(parse_string_into_profiles(a1).facts) == 2
+
+    memos = [
+        {"memo_id": 1, "new_info": "likes tea", "current_memo": ""},
+        {"memo_id": 2, "new_info": "lives in Paris", "current_memo": "lives in Rome"},
+    ]
+    a, _ = await stand_in_complete(
+        "m", merge_profile_yolo.get_input(memos), prompt_id="merge_profile_yolo"
+    )
+    actions = parse_string_into_merge_yolo_action(a)
+    assert actions[1]["action"] == "APPEND" and actions[2]["action"] == "UPDATE"
+
+    a, _ = await stand_in_complete(
+        "m", "<memos>\n0. a,b,c\n1. d,e,f\n</memos>", prompt_id="pick_related_profiles"
+    )
+    assert find_list_int_or_none(a) == [0, 1]
+
+    e = await stand_in_embedding("m", ["a", "b", "a"])
+    assert e.shape == (3, CONFIG.embedding_dim)
+    np.testing.assert_allclose(e[0], e[2])
+    np.testing.assert_allclose(np.linalg.norm(e, axis=1), 1, rtol=1e-5)
+
+
+@pytest.mark.asyncio
+async def test_llm_response_cache(db_env, monkeypatch):
+    from types import SimpleNamespace
+    from memobase_server import llms
+
+    monkeypatch.setattr(CONFIG, "llm_response_cache_ttl_s", {"test_stage": 60})
+    usage = SimpleNamespace(prompt_tokens=10, completion_tokens=2)
+    provider = AsyncMock(return_value=("cached answer", usage))
+    prompt = f"llm response cache test {random.random()}"
+
+    with patch.dict(llms.FACTORIES, {CONFIG.llm_style: provider}):
+        for _ in range(2):
+            p = await llms.llm_complete(
+                DEFAULT_PROJECT_ID, prompt, temperature=0.2, prompt_id="test_stage"
+            )
+            assert p.ok() and p.data() == "cached answer"
+        assert provider.await_count == 1
+
+        # bypassed, or a different request
+        await llms.llm_complete(
+            DEFAULT_PROJECT_ID,
+            prompt,
+            temperature=0.2,
+            prompt_id="test_stage",
+            no_cache=True,
+        )
+        await llms.llm_complete(
+            DEFAULT_PROJECT_ID, prompt, temperature=0.5, prompt_id="test_stage"
+        )
+        assert provider.await_count == 3
+        # stages without a TTL are never cached
+        for _ in range(2):
+            await llms.llm_complete(DEFAULT_PROJECT_ID, prompt, prompt_id="other")
+        assert provider.await_count == 5
+
+
+@pytest.mark.asyncio
+async def test_write_behind_token_billing(db_env, monkeypatch):
+    from memobase_server.controllers import billing
+    from memobase_server.telemetry.capture_key import get_int_key, date_key
+    from memobase_server.env import TelemetryKeyName
+
+    monkeypatch.setattr(CONFIG, "billing_flush_interval_s", 60)
+    await billing.flush_token_billing()
+    before = await controllers.project.get_project_usage(DEFAULT_PROJECT_ID, 1)
+    assert before.ok()
+    before = before.data()[0]
+
+    with patch(
+        "memobase_server.controllers.billing.charge_project_usage",
+        AsyncMock(return_value=Promise.resolve(None)),
+    ) as mock_charge:
+        for _ in range(3):
+            billing.record_token_billing(DEFAULT_PROJECT_ID, 10, 2)
+        # nothing is written until the flush
+        assert (
+            await get_int_key(
+                TelemetryKeyName.llm_input_tokens,
+                DEFAULT_PROJECT_ID,
+                use_date=date_key(),
+            )
+            == before.total_input_token
+        )
+        await billing.flush_token_billing()
+        mock_charge.assert_awaited_once_with(DEFAULT_PROJECT_ID, 30, 6)
+
+        # a failed charge is retried at the next flush
+        billing.record_token_billing(DEFAULT_PROJECT_ID, 1, 1)
+        mock_charge.return_value = Promise.reject(res.CODE.SERVICE_UNAVAILABLE, "down")
+        await billing.flush_token_billing()
+        mock_charge.return_value = Promise.resolve(None)
+        await billing.flush_token_billing()
+        assert mock_charge.await_args.args == (DEFAULT_PROJECT_ID, 1, 1)
+
+        # a charge failing every flush is dropped after the retries
+        monkeypatch.setattr(CONFIG, "billing_flush_max_retries", 2)
+        billing.record_token_billing(DEFAULT_PROJECT_ID, 0, 0)
+        mock_charge.reset_mock()
+        mock_charge.return_value = Promise.reject(res.CODE.SERVICE_UNAVAILABLE, "down")
+        for _ in range(5):
+            await billing.flush_token_billing()
+        assert mock_charge.await_count == 3
+        assert DEFAULT_PROJECT_ID not in billing._uncharged_tokens
+
+    # a project without billing is not retried
+    project_id = f"no_billing_{random.random()}"
+    p = await billing.charge_project_usage(project_id, 1, 1)
+    assert p.code() == res.CODE.NOT_FOUND
+    billing.record_token_billing(project_id, 1, 1)
+    await billing.flush_token_billing()
+    assert project_id not in billing._uncharged_tokens
+
+    after = await controllers.project.get_project_usage(DEFAULT_PROJECT_ID, 1)
+    assert after.ok()
+    after = after.data()[0]
+    assert after.total_input_token == before.total_input_token + 31
+    assert after.total_output_token == before.total_output_token + 7
+
+
+def test_local_ttl_cache():
+    from memobase_server.local_cache import LocalTTLCache, MISSING
+
+    cache = LocalTTLCache("test", max_size=2, ttl_s=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    # "b" is the least recently used one
+    assert cache.get("b") is MISSING
+    assert cache.get("a") == 1 and cache.get("c") == 3
+
+    cache = LocalTTLCache("test", max_size=2, ttl_s=0)
+    cache.set("a", None)
+    assert cache.get("a") is MISSING
+
+
+@pytest.mark.asyncio
+async def test_token_length_cache(monkeypatch):
+    from memobase_server import utils
+    from memobase_server.env import ENCODER
+
+    monkeypatch.setattr(CONFIG, "token_length_cache_size", 3)
+    monkeypatch.setattr(CONFIG, "token_length_offload_chars", 16)
+    utils.TOKEN_LENGTHS.clear()
+
+    contents = ["hello world", "你好，世界", "", "a long content " * 10]
+    expected = [len(ENCODER.encode(c)) for c in contents]
+    assert [utils.get_token_length(c) for c in contents] == expected
+    # the oldest entry is dropped
+    assert len(utils.TOKEN_LENGTHS) == 3
+    assert utils.get_token_lengths(contents) == expected
+    assert await utils.aget_token_lengths(contents) == expected
+    assert await utils.aget_token_length(contents[-1]) == expected[-1]
+
+    # cache hits don't encode again
+    with patch.object(utils, "ENCODER") as mock_encoder:
+        assert utils.get_token_lengths(contents[1:]) == expected[1:]
+        assert await utils.aget_token_length(contents[-1]) == expected[-1]
+        mock_encoder.encode.assert_not_called()
+        mock_encoder.encode_batch.assert_not_called()
+    utils.TOKEN_LENGTHS.clear()
+
+
+@pytest.mark.asyncio
+async def test_project_profile_config_local_cache(db_env):
+    from memobase_server.local_cache import PROJECT_PROFILE_CONFIGS, MISSING
+
+    p = await controllers.project.update_project_profile_config(
+        DEFAULT_PROJECT_ID, "language: zh"
+    )
+    assert p.ok()
+    p = await controllers.project.get_project_profile_config(DEFAULT_PROJECT_ID)
+    assert p.ok() and p.data().language == "zh"
+    assert PROJECT_PROFILE_CONFIGS.get(DEFAULT_PROJECT_ID) is p.data()
+
+    # updates drop the local copy, the next read sees the new config
+    p = await controllers.project.update_project_profile_config(
+        DEFAULT_PROJECT_ID, None
+    )
+    assert p.ok()
+    assert PROJECT_PROFILE_CONFIGS.get(DEFAULT_PROJECT_ID) is MISSING
+    p = await controllers.project.get_project_profile_config(DEFAULT_PROJECT_ID)
+    assert p.ok() and p.data().language is None
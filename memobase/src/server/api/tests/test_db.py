@@ -1,10 +1,29 @@
+import asyncio
 import pytest
+import numpy as np
+from datetime import datetime, timezone
+from sqlalchemy import text
 from sqlalchemy.inspection import inspect
-from memobase_server.models.database import User, GeneralBlob, UserProfile
+from memobase_server.env import CONFIG
+from memobase_server.models.database import (
+    User,
+    GeneralBlob,
+    UserProfile,
+    UserEvent,
+    UserEventGist,
+)
 from memobase_server.models.blob import BlobType
 from memobase_server.connectors import (
     Session,
     DB_ENGINE,
+    AsyncSession,
+    add_months,
+    maintain_event_partitions,
+)
+
+# only when the test DB was created with `event_partitioning`
+partitioned_events = pytest.mark.skipif(
+    not CONFIG.event_partitioning, reason="event tables are not partitioned"
 )
 
 
@@ -49,3 +68,104 @@ def test_general_blob_model(db_env):
         user = session.query(User).filter_by(id=test_user_id).first()
         session.delete(user)
         session.commit()
+
+
+@pytest.mark.asyncio
+async def test_async_sessions_own_their_connections(db_env):
+    async def read_in_session():
+        async with AsyncSession() as session:
+            pid = (await session.execute(text("SELECT pg_backend_pid()"))).scalar_one()
+            vector = (
+                await session.execute(text("SELECT '[1,2,3]'::vector"))
+            ).scalar_one()
+            # keep the connection checked out while the other sessions run
+            await asyncio.sleep(0.2)
+        return pid, vector
+
+    results = await asyncio.gather(*[read_in_session() for _ in range(5)])
+    assert len({pid for pid, _ in results}) == 5
+    for _, vector in results:
+        # decoded by the pgvector codec registered on connect, not a string
+        assert isinstance(vector, np.ndarray)
+        assert vector.tolist() == [1, 2, 3]
+
+
+def event_partition_of(session, table: str, row_id) -> str:
+    return session.execute(
+        text(f"SELECT tableoid::regclass::text FROM {table} WHERE id = :id"),
+        {"id": row_id},
+    ).scalar_one()
+
+
+@partitioned_events
+def test_event_partitions(db_env, monkeypatch):
+    this_month = datetime.now(timezone.utc).date().replace(day=1)
+    maintain_event_partitions()
+    with Session() as session:
+        partitions = set(
+            session.execute(
+                text(
+                    "SELECT c.relname FROM pg_inherits i "
+                    "JOIN pg_class c ON c.oid = i.inhrelid "
+                    "WHERE i.inhparent = 'user_events'::regclass"
+                )
+            ).scalars()
+        )
+    assert {
+        "user_events_default",
+        *[
+            f"user_events_p{add_months(this_month, i):%Y_%m}"
+            for i in range(CONFIG.event_partition_premake_months + 1)
+        ],
+    } <= partitions
+
+    # the months older than the retention are dropped
+    with Session() as session:
+        session.execute(
+            text(
+                "CREATE TABLE user_events_p1991_01 PARTITION OF user_events "
+                "FOR VALUES FROM ('1991-01-01 00:00:00+00') TO ('1991-02-01 00:00:00+00')"
+            )
+        )
+        session.commit()
+    monkeypatch.setattr(CONFIG, "event_partition_retention_months", 12 * 30)
+    assert maintain_event_partitions() == ["user_events_p1991_01"]
+
+
+@partitioned_events
+def test_event_rows_routing_and_gist_cascade(db_env):
+    this_month = datetime.now(timezone.utc).date().replace(day=1)
+    with Session() as session:
+        user = User()
+        session.add(user)
+        session.commit()
+        events = [
+            UserEvent(event_data={}, user_id=user.id),
+            UserEvent(event_data={}, user_id=user.id),
+        ]
+        # before every monthly partition
+        events[1].created_at = datetime(1980, 1, 1, tzinfo=timezone.utc)
+        session.add_all(events)
+        session.commit()
+        assert (
+            event_partition_of(session, "user_events", events[0].id)
+            == f"user_events_p{this_month:%Y_%m}"
+        )
+        assert (
+            event_partition_of(session, "user_events", events[1].id)
+            == "user_events_default"
+        )
+
+        # no foreign key to a partitioned table, the ORM deletes the gists
+        gist = UserEventGist(
+            gist_data={"content": "- gist"}, event_id=events[0].id, user_id=user.id
+        )
+        session.add(gist)
+        session.commit()
+        gist_id = gist.id
+        session.delete(events[0])
+        session.commit()
+        assert session.query(UserEventGist).filter_by(id=gist_id).first() is None
+
+        session.delete(user)
+        session.commit()